@@ -0,0 +1,247 @@
+#! /usr/bin/env python
+# Headless benchmark of recognizer training and prediction on synthetic
+# embeddings
+
+import argparse
+import json
+import multiprocessing as mp
+import platform
+import queue
+import resource
+import subprocess
+import time
+
+import numpy as np
+
+fn_report = 'benchmark_recognition.json'
+modes = ('svc', 'centroid', 'knn')
+
+
+def synthetic_embeddings(n_guests, n_images, spread=0.3, n_unknown=0, dim=128,
+                         seed=0):
+    """
+    Return (X, guest_ids, centers): n_images unit embeddings around each of
+    n_guests random unit centers, noise of norm about spread, plus
+    n_unknown embeddings of distinct random faces labelled unknown.
+    """
+    from embeddings_train import unknown_guest_id
+
+    rng = np.random.RandomState(seed)
+    centers = rng.normal(size=(n_guests, dim))
+    centers /= np.linalg.norm(centers, axis=1, keepdims=True)
+    X = (np.repeat(centers, n_images, axis=0)
+         + rng.normal(scale=spread / np.sqrt(dim), size=(n_guests * n_images, dim)))
+    guest_ids = ['{:08d}-0000-4000-8000-{:012d}'.format(i, i + 1)
+                 for i in range(n_guests) for _ in range(n_images)]
+    if n_unknown:
+        X = np.concatenate([X, rng.normal(size=(n_unknown, dim))])
+        guest_ids += [unknown_guest_id] * n_unknown
+    X /= np.linalg.norm(X, axis=1, keepdims=True)
+    return X, np.array(guest_ids, dtype=object), centers
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def train(mode, X, guest_ids, case):
+    """
+    Train a recognizer as train_model does, returns (recognizer,
+    label_encoder).
+    """
+    from sklearn.preprocessing import LabelEncoder
+
+    from embeddings_train import train_svc
+    from embeddings_train import unknown_guest_id
+    from gallery_pruning import prune_gallery
+    from recognizers import CentroidRecognizer
+    from recognizers import KNNRecognizer
+
+    label_encoder = LabelEncoder()
+    if mode in ('svc', 'knn'):
+        keep = prune_gallery(X, guest_ids, case['max_per_guest'],
+                             max_unknown=case['max_unknown'],
+                             unknown_id=unknown_guest_id)
+        (X, guest_ids) = (X[keep], guest_ids[keep])
+    if mode == 'svc':
+        labels = label_encoder.fit_transform(guest_ids)
+        return train_svc(X, labels), label_encoder
+    if mode == 'knn':
+        recognizer = KNNRecognizer(index_mode=case['knn_index'])
+    else:
+        recognizer = CentroidRecognizer()
+    recognizer.fit(X, guest_ids)
+    label_encoder.fit(recognizer.classes_)
+    return recognizer, label_encoder
+
+
+def run_case(case):
+    """
+    Benchmark one recognizer mode on one gallery size, returns a result
+    dict. Meant to run in its own process so peak RSS is its own.
+    """
+    from face_pipeline import predict_guests
+
+    (X, guest_ids, centers) = synthetic_embeddings(case['n_guests'],
+                                                   case['n_images'],
+                                                   case['spread'],
+                                                   case['n_unknown'],
+                                                   seed=case['seed'])
+    # Queries: new images of known guests
+    rng = np.random.RandomState(case['seed'] + 1)
+    query_guests = rng.randint(case['n_guests'], size=case['n_queries'])
+    Q = centers[query_guests] + rng.normal(scale=case['spread'] / np.sqrt(X.shape[1]),
+                                           size=(case['n_queries'], X.shape[1]))
+    Q /= np.linalg.norm(Q, axis=1, keepdims=True)
+    rss_before = peak_rss_mb()
+
+    start = time.perf_counter()
+    (recognizer, label_encoder) = train(case['mode'], X, guest_ids, case)
+    train_seconds = time.perf_counter() - start
+    rss_train = peak_rss_mb()
+
+    # One face at a time, as faces are identified from the camera
+    latencies = []
+    predicted = []
+    for q in Q:
+        start = time.perf_counter()
+        (ids, _) = predict_guests(recognizer, label_encoder, q[None, :])
+        latencies.append(time.perf_counter() - start)
+        predicted.append(ids[0])
+    start = time.perf_counter()
+    predict_guests(recognizer, label_encoder, Q)
+    batch_seconds = time.perf_counter() - start
+
+    expected = guest_ids[query_guests * case['n_images']]
+    latencies_ms = np.array(latencies) * 1000.0
+    return dict(case,
+                status='ok',
+                n_embeddings=len(X),
+                train_seconds=round(train_seconds, 4),
+                latency_ms={'mean': round(float(latencies_ms.mean()), 4),
+                            'p50': round(float(np.percentile(latencies_ms, 50)), 4),
+                            'p95': round(float(np.percentile(latencies_ms, 95)), 4),
+                            'p99': round(float(np.percentile(latencies_ms, 99)), 4)},
+                batch_ms_per_face=round(batch_seconds * 1000.0 / len(Q), 4),
+                accuracy=round(float(np.mean(np.array(predicted, dtype=object) == expected)), 4),
+                rss_mb={'data': round(rss_before, 1),
+                        'peak': round(rss_train, 1),
+                        'train': round(rss_train - rss_before, 1)})
+
+
+def _run_case_main(case, results):
+    try:
+        results.put(run_case(case))
+    except Exception as e:
+        results.put(dict(case, status='error', error=repr(e)))
+
+
+def run_isolated(case, timeout=None):
+    """
+    run_case in a fresh process, or a timeout result if it takes longer
+    than timeout seconds.
+    """
+    ctx = mp.get_context('spawn')
+    results = ctx.Queue()
+    process = ctx.Process(target=_run_case_main, args=(case, results))
+    process.start()
+    deadline = time.monotonic() + timeout if timeout else None
+    while True:
+        try:
+            result = results.get(timeout=1.0)
+            break
+        except queue.Empty:
+            pass
+        if not process.is_alive():  # e.g. killed for running out of memory
+            # The result may have arrived between the get and the check
+            try:
+                result = results.get_nowait()
+            except queue.Empty:
+                result = dict(case, status='crashed',
+                              error='exit code {}'.format(process.exitcode))
+            break
+        if deadline is not None and time.monotonic() > deadline:
+            process.terminate()
+            result = dict(case, status='timeout')
+            break
+    process.join()
+    return result
+
+
+def git_version():
+    try:
+        out = subprocess.run(['git', 'describe', '--always', '--dirty'],
+                             capture_output=True, timeout=10)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    return out.stdout.decode().strip() or None
+
+
+def library_versions():
+    versions = {'python': platform.python_version(), 'numpy': np.__version__}
+    try:
+        import sklearn
+        versions['sklearn'] = sklearn.__version__
+    except ImportError:
+        pass
+    return versions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Benchmark recognizer training time, prediction latency and '
+                    'memory on synthetic embeddings.')
+    parser.add_argument('--modes', nargs='+', choices=modes, default=list(modes))
+    parser.add_argument('--guests', nargs='+', type=int, default=[10, 50, 200],
+                        help='gallery sizes, in guests')
+    parser.add_argument('--images', type=int, default=20, help='images per guest')
+    parser.add_argument('--spread', type=float, default=0.3,
+                        help='norm of the noise around each guest')
+    parser.add_argument('--unknown', type=int, default=200,
+                        help='embeddings of the unknown class')
+    parser.add_argument('--queries', type=int, default=200,
+                        help='faces to time prediction on')
+    parser.add_argument('--max-per-guest', type=int, default=20)
+    parser.add_argument('--max-unknown', type=int, default=500)
+    parser.add_argument('--knn-index', default='auto', choices=('auto', 'exact', 'ivfpq'))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--timeout', type=float, default=1800,
+                        help='seconds before a case is abandoned')
+    parser.add_argument('--out', default=fn_report, help='JSON report')
+    args = parser.parse_args()
+
+    report = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'git': git_version(),
+              'machine': platform.machine(),
+              'platform': platform.platform(),
+              'versions': library_versions(),
+              'results': []}
+    for n_guests in args.guests:
+        for mode in args.modes:
+            case = {'mode': mode,
+                    'n_guests': n_guests,
+                    'n_images': args.images,
+                    'n_unknown': args.unknown,
+                    'spread': args.spread,
+                    'n_queries': args.queries,
+                    'max_per_guest': args.max_per_guest,
+                    'max_unknown': args.max_unknown,
+                    'knn_index': args.knn_index,
+                    'seed': args.seed}
+            print("[INFO] Benchmarking {} on {} guests...".format(mode, n_guests))
+            result = run_isolated(case, timeout=args.timeout)
+            if result['status'] == 'ok':
+                print("[INFO] {}: train {:.2f}s, {:.3f}ms/face (p95 {:.3f}ms), "
+                      "peak RSS {:.0f}MB, accuracy {:.3f}".format(
+                          mode, result['train_seconds'], result['latency_ms']['p50'],
+                          result['latency_ms']['p95'], result['rss_mb']['peak'],
+                          result['accuracy']))
+            else:
+                print("[ERROR] {} on {} guests: {} {}".format(
+                    mode, n_guests, result['status'], result.get('error', '')))
+            report['results'].append(result)
+            # Written after each case so a long run leaves a partial report
+            with open(args.out, 'w') as f:
+                json.dump(report, f, indent=2)
+    print("[INFO] Report written to {}.".format(args.out))
@@ -6,86 +6,210 @@ import time
 
 from PIL import Image
 import cv2
-import imutils
 import numpy as np
 
+from capture_writer import CaptureWriter
 from encrypt_archive import p7zip
+from face_pipeline import detect_faces
+from face_pipeline import embed_faces
+from face_pipeline import load_detector
+from face_pipeline import load_embedder
+from face_pipeline import load_recognition_models
+from face_pipeline import predict_guests
+from face_pipeline import warm_up
+from frame_source import FrameGrabber
+from frame_source import FrameRecorder
+from frame_source import open_frame_source
+from inference_worker import InferenceWorker
+from metrics import configure_metrics
+from motion import MotionGate
+from preprocess import DetectorBlob
+from preprocess import DisplayConverter
+from preprocess import FramePreprocessor
+from tracker import FaceTracker
 
 fn_config = 'biometric.cfg'
 
 
 class FacialCamera:
-    def __init__(self, pn_output="./"):
+    def __init__(self, pn_output="./", source=None, max_speed=False,
+                 inference_worker=None):
         """
         Initialize application which uses OpenCV + Tkinter. It displays
         a video stream in a Tkinter window and stores current snapshot on
         disk.
+        source overrides the configured camera_source and can be a device
+        index, a video file, a directory of images, a frame recording or
+        a synthetic source. With max_speed non-live sources are read as
+        fast as frames are queried, without dropping any.
+        inference_worker overrides the configured inference_worker.
         """
-        # Initialize the video stream, then allow the camera sensor to warm up
-        print("[INFO] starting video stream...")
-        self.vs = cv2.VideoCapture(0)  # Capture video frames, 0 is default video camera
-        time.sleep(2.0)
-
         # Load config
         config = configparser.ConfigParser()
         config.read(fn_config)
+        # Stage latency metrics, no-ops unless metrics_enabled
+        self.metrics = configure_metrics(config)
         self.pn_guest_images = config['DEFAULT']['pn_guest_images_archive']
         self.guest_archive = p7zip(self.pn_guest_images)
+        self.capture_writer = CaptureWriter(self.guest_archive,
+                                            config['DEFAULT'].get('pn_capture_staging'))
         self.camera_rot = int(config['DEFAULT']['camera_rot'])
         self.image_width = int(config['DEFAULT']['image_width'])
         self.max_capture_interval = float(config['DEFAULT']['capture_interval'])
         self.max_capture_length = int(config['DEFAULT']['max_capture_length'])
         self.max_images = int(config['DEFAULT']['max_images'])
+        if source is None:
+            source = config['DEFAULT'].get('camera_source', '0')
+        frame_buffer_size = int(config['DEFAULT'].get('frame_buffer_size', '2'))
+        source_fps = float(config['DEFAULT'].get('source_fps', '30'))
 
         # Capture Vars
         self.curr_pic = None  # Current image from the camera
         self.gst_capture = None
         self.start_time = time.time()
-        self.save_time = time.time()
         self.pic_num = None
         self.pn_gstcap_out = None
 
         # Face Detection Model
         self.min_detec_conf = float(config['DEFAULT']['min_detec_conf'])
         self.min_face_px = make_tuple(config['DEFAULT']['min_face_px'])
-        pn_detector_model = config['DEFAULT']['pn_detector_model']
+        self.pn_detector_model = pn_detector_model = config['DEFAULT']['pn_detector_model']
         self.trainRBGavg = make_tuple(config['DEFAULT']['detector_trainrgbavg'])
-        print("[INFO] loading face detector and embedding model...")
-        protoPath = os.path.sep.join([pn_detector_model, "deploy.prototxt"])
-        modelPath = os.path.sep.join([pn_detector_model,
-                                      "res10_300x300_ssd_iter_140000.caffemodel"])
-        self.detector = cv2.dnn.readNetFromCaffe(protoPath, modelPath)
-        self.detector.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
 
         # Face Recognition (extract/recognize embeddings) Model
         self.min_recog_prob = float(config['DEFAULT']['min_recog_prob'])
-        fn_embedding_model = config['DEFAULT']['fn_embedding_model']
-        self.embedder = cv2.dnn.readNetFromTorch(fn_embedding_model)
-        self.embedder.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+        self.fn_embedding_model = fn_embedding_model = config['DEFAULT']['fn_embedding_model']
+        # (recognizer, label_encoder), swapped as one so a new model can be
+        # loaded while identifying
+        self.models = (None, None)
+
+        # Detection and recognition run in a separate process if enabled,
+        # the display keeps drawing the latest result in the meantime.
+        # The worker loads and warms up its models while the camera starts
+        self.worker = None
+        self.detector = None
+        self.embedder = None
+        if inference_worker is None:
+            inference_worker = config['DEFAULT'].get('inference_worker', 'True') == 'True'
+        if inference_worker:
+            print("[INFO] starting inference worker...")
+            # Room for frames up to twice as tall as they are wide
+            frame_bytes = self.image_width * self.image_width * 2 * 3
+            self.worker = InferenceWorker(
+                {'pn_detector_model': pn_detector_model,
+                 'fn_embedding_model': fn_embedding_model,
+                 'trainRBGavg': self.trainRBGavg,
+                 'min_detec_conf': self.min_detec_conf,
+                 'min_face_px': self.min_face_px,
+                 'image_width': self.image_width},
+                frame_bytes).start()
+
+        # Initialize the video stream on a background thread
+        print("[INFO] starting video stream...")
+        self.preprocessor = FramePreprocessor(self.camera_rot, self.image_width)
+        self.display_converter = DisplayConverter()
+        self.recorder = None
+        self.vs, fps = open_frame_source(source, source_fps)
+        if max_speed and fps:
+            (fps, frame_buffer_size) = (float('inf'), 1)
+        self.grabber = FrameGrabber(self.vs,
+                                    process=self.preprocess_frame,
+                                    buffer_size=frame_buffer_size,
+                                    fps=fps,
+                                    block=max_speed).start()
+        if config['DEFAULT'].get('fn_frame_recording'):
+            self.start_recording(config['DEFAULT']['fn_frame_recording'])
+
+        if self.worker is None:
+            print("[INFO] loading face detector and embedding model...")
+            self.detector = load_detector(pn_detector_model)
+            self.embedder = load_embedder(fn_embedding_model)
+            warm_up(self.detector, self.embedder, self.trainRBGavg, self.image_width)
+        # Allow the camera sensor to warm up, until its first frame
+        if not fps and not self.grabber.wait_first_frame(timeout=2.0):
+            print("[ERROR] No frame from the camera yet.")
+        self.detector_blob = DetectorBlob(self.trainRBGavg)
+        self.capture_boxes = np.empty((0, 4), dtype=int)  # Latest capture detection
+        self.capture_face_present = False
         self.gst_identify = False
         self.guest_ids = {}
 
+        # Face tracking between detections
+        self.detect_interval = max(1, int(config['DEFAULT'].get('detect_interval', '5')))
+        self.tracker = FaceTracker(
+            iou_thresh=float(config['DEFAULT'].get('track_iou_thresh', '0.3')),
+            max_misses=int(config['DEFAULT'].get('track_max_misses', '2')),
+            vote_len=int(config['DEFAULT'].get('track_vote_len', '5')),
+            vote_min=int(config['DEFAULT'].get('track_vote_min', '3')),
+            min_recog_prob=self.min_recog_prob)
+        self.signed_in_ids = set()  # Guests already signed in, never re-embedded
+
+        # Drop to a low detection rate while nothing moves
+        self.motion_gate = MotionGate(
+            scale_width=int(config['DEFAULT'].get('motion_width', '64')),
+            pixel_thresh=int(config['DEFAULT'].get('motion_pixel_thresh', '25')),
+            area_thresh=float(config['DEFAULT'].get('motion_area_thresh', '0.01')),
+            idle_timeout=float(config['DEFAULT'].get('idle_timeout', '10')),
+            idle_detect_interval=float(config['DEFAULT'].get('idle_detect_interval', '2.0')))
+        self.detect_requested = True
+
         # Guest Info (update outside of function)
         self.known_guest_meta = None
 
-    def query_camera(self):
+    def wait_ready(self, timeout=None):
+        """
+        Wait until the detector and embedder are loaded and warmed up.
+        Returns whether they are.
+        """
+        if self.worker is not None:
+            return self.worker.wait_ready(timeout)
+        return self.detector is not None
+
+    def preprocess_frame(self, orig_pic, slot=0):
+        """
+        Rotate and resize a raw camera frame; runs on the capture thread.
+        The full size frame is only kept while capturing guests.
+        """
+        if self.recorder is not None:
+            self.recorder.add(orig_pic)
+        with self.metrics.timer('preprocess'):
+            return self.preprocessor.process(orig_pic,
+                                             slot,
+                                             keep_orig=bool(self.gst_capture))
+
+    def query_camera(self, timeout=0):
         """
-        Query camera for current image.
+        Query camera for the newest image, without waiting on the sensor.
+        Returns (None, None) if no new image arrived since the last query.
+        Images are reused buffers, valid until the next query.
         """
-        ok, orig_pic = self.vs.read()  # Read video stream
-        if ok:  # If no errors
-            orig_pic = imutils.rotate(orig_pic, angle=self.camera_rot)
-            curr_pic = imutils.resize(orig_pic, width=self.image_width)
-            return curr_pic, orig_pic
+        frame = self.grabber.read(timeout=timeout)
+        if frame is not None:
+            return frame
         else:
             return None, None
 
+    def start_recording(self, fn_recording):
+        """
+        Record raw camera frames with timestamps for offline replay.
+        """
+        self.stop_recording()
+        print("[INFO] Recording frames to {}...".format(fn_recording))
+        self.recorder = FrameRecorder(fn_recording)
+
+    def stop_recording(self):
+        recorder, self.recorder = self.recorder, None
+        if recorder is not None:
+            recorder.close()
+
     def convert_imgpil(self, pic):
         """
-        Convert image to something that can be saved.
+        Convert image to something that can be saved. RGB is enough for
+        display, and the conversion reuses one buffer.
         """
-        curr_pic = cv2.cvtColor(pic, cv2.COLOR_BGR2RGBA)
-        return Image.fromarray(curr_pic)  # Convert image for PIL
+        with self.metrics.timer('display_convert'):
+            curr_pic = self.display_converter(pic)
+            return Image.fromarray(curr_pic)  # Convert image for PIL
 
     def save_pic(self, path_pic, pic):
         """
@@ -101,9 +225,30 @@ class FacialCamera:
 
     def save_pic_archive(self, path_pic, pic):
         """
-        Save image to archive on disk.
+        Queue image to be saved to archive on disk when the capture
+        session ends.
+        """
+        self.capture_writer.add_image(path_pic, pic)
+
+    def start_capture(self, guest_id):
+        """
+        Start capturing images of a new guest.
         """
-        self.guest_archive.add_image(path_pic, pic)
+        self.capture_writer.start_session()
+        self.start_time = time.time()
+        self.pic_num = 0
+        self.capture_time_prev = time.time()
+        self.capture_face_present = False
+        self.pn_gstcap_out = guest_id
+        self.gst_capture = True
+
+    def stop_capture(self, discard=False):
+        """
+        Stop capturing and save the session's images to the archive in one
+        append, or discard them.
+        """
+        self.gst_capture = False
+        self.capture_writer.finish_session(commit=not discard)
 
     def guest_capture_func(self, pic_save, pic_display):
         """
@@ -111,34 +256,30 @@ class FacialCamera:
         separate step).
         """
         capture_time_curr = time.time()
-        (pic_height, pic_width) = pic_display.shape[:2]
-        image_blob = cv2.dnn.blobFromImage(
-            cv2.resize(pic_display, (300, 300)),
-            1.0,
-            (300, 300),
-            self.trainRBGavg,
-            swapRB=False,
-            crop=False)
-
-        # Use previously loaded face detector on the blob
-        self.detector.setInput(image_blob)
-        detections = self.detector.forward()
-
-        # Loop over detected faces
-        for i in range(0, detections.shape[2]):
-            curr_conf = detections[0, 0, i, 2]
-            if curr_conf > self.min_detec_conf:
-                bound_box = detections[0, 0, i, 3:7] * np.array([pic_width,
-                                                                 pic_height,
-                                                                 pic_width,
-                                                                 pic_height])
-                (x_start, y_start, x_end, y_end) = bound_box.astype("int")
-                # Only detect faces fully in the frame
-                if x_start < 0 or y_start < 0:
-                    continue
-                if x_end > self.image_width or y_end > self.image_width:
-                    continue
-                # Draw face bounding box
+
+        self.check_worker()
+        if self.worker is not None:
+            # Draw the latest worker detection and request the next
+            result = self.worker.poll()
+            if result is not None and result['mode'] == 'detect':
+                self.capture_boxes = result['bound_boxes']
+                self.capture_face_present = result['face_present']
+            self.worker.submit(pic_display, 'detect')
+        else:
+            # Use previously loaded face detector on the blob
+            with self.metrics.timer('detect'):
+                self.capture_boxes, _, self.capture_face_present = detect_faces(
+                    self.detector,
+                    pic_display,
+                    self.trainRBGavg,
+                    self.min_detec_conf,
+                    max_x=self.image_width,
+                    max_y=self.image_width,
+                    blob=self.detector_blob)
+
+        # Draw bounding boxes of faces fully in the frame
+        with self.metrics.timer('draw'):
+            for (x_start, y_start, x_end, y_end) in self.capture_boxes:
                 cv2.rectangle(pic_display,
                               (x_start, y_start),
                               (x_end, y_end),
@@ -147,7 +288,7 @@ class FacialCamera:
 
         elap_seconds = capture_time_curr - self.capture_time_prev
         if elap_seconds >= self.max_capture_interval and \
-                np.any(detections[0, 0, :, 2] > self.min_detec_conf):
+                self.capture_face_present and pic_save is not None:
             # Capture image and save to file
             pn_pic = os.path.sep.join([self.pn_gstcap_out, "{}.png".format(
                 str(self.pic_num).zfill(5))])
@@ -159,12 +300,12 @@ class FacialCamera:
             if capture_time_curr - self.start_time > self.max_capture_length:
                 print('[INFO] {} seconds elapsed, completed capturing images.'
                       .format(self.max_capture_length))
-                self.gst_capture = False
+                self.stop_capture()
 
             if self.pic_num >= self.max_images:
                 print('[INFO] Max of {} images captured, completed capturing images.'
                       .format(self.max_images))
-                self.gst_capture = False
+                self.stop_capture()
 
         return pic_display
 
@@ -186,108 +327,206 @@ class FacialCamera:
             guest_info = 'Guest Data Load Error'
         return guest_info
 
+    def reset_tracking(self):
+        """
+        Forget all face tracks and detect on the next identify frame.
+        """
+        self.tracker.reset()
+        self.motion_gate.reset()
+        self.signed_in_ids = set()
+        self.detect_requested = True
+
+    def request_detection(self):
+        """
+        Run full detection on the next identify frame.
+        """
+        self.detect_requested = True
+
+    def detection_due(self, pic_display):
+        """
+        Detect on request or while a track is still collecting votes.
+        Otherwise detect every detect_interval frames while the scene is
+        active, and at the low idle rate once nothing has moved for a while.
+        """
+        awake = self.motion_gate.update(pic_display)
+        if self.detect_requested or any(track.voting for track in self.tracker.tracks):
+            return True
+        if not awake:
+            return self.motion_gate.idle_detection_due()
+        return self.tracker.frame_num % self.detect_interval == 0
+
     def guest_identify_func(self, pic_display):
         """
         Identify guests within a picture.
+        Faces are tracked between detections and only faces on tracks
+        that are not yet identified are embedded.
         """
-        (pic_height, pic_width) = pic_display.shape[:2]
-
-        # Create OpenCV image blob
-        image_blob = cv2.dnn.blobFromImage(
-            cv2.resize(pic_display, (300, 300)),
-            1.0,
-            (300, 300),
-            self.trainRBGavg,
-            swapRB=False,
-            crop=False)
+        self.tracker.step()
+
+        self.check_worker()
+        if self.worker is not None:
+            self.identify_async(pic_display)
+        elif self.detection_due(pic_display):
+            self.detect_requested = False
+
+            # Use previously loaded face detector on the blob,
+            # threshold confidence via configuration file and keep faces
+            # of a min size fully in the frame
+            with self.metrics.timer('detect'):
+                bound_boxes, _, _ = detect_faces(self.detector,
+                                                 pic_display,
+                                                 self.trainRBGavg,
+                                                 self.min_detec_conf,
+                                                 max_x=self.image_width,
+                                                 max_y=self.image_width,
+                                                 min_face_px=self.min_face_px,
+                                                 blob=self.detector_blob)
+            self.metrics.count('faces_detected', len(bound_boxes))
+            tracks = self.tracker.update(bound_boxes)
+            if len(bound_boxes):
+                self.motion_gate.wake()
+
+            # Embed faces not yet identified in one forward pass, return
+            # 128-D describing vectors, and recognize them with one call
+            # to the recognizer
+            embed_inds = [i for (i, track) in enumerate(tracks)
+                          if track.needs_embedding]
+            embed_start = time.perf_counter()
+            face_vecs = embed_faces(self.embedder,
+                                    pic_display,
+                                    bound_boxes[embed_inds])
+            if embed_inds:
+                self.metrics.observe('embed_face',
+                                     (time.perf_counter() - embed_start) / len(embed_inds))
+                self.metrics.count('faces_embedded', len(embed_inds))
+            (recognizer, label_encoder) = self.models
+            with self.metrics.timer('predict'):
+                guest_ids, probs = predict_guests(recognizer,
+                                                  label_encoder,
+                                                  face_vecs)
+            for (i, guest_id, prob) in zip(embed_inds, guest_ids, probs):
+                self.tracker.add_vote(tracks[i], guest_id, prob,
+                                      self.signed_in_ids)
+
+        # Store guest_id info as dict of {guest_id:prob}
+        self.guest_ids = self.tracker.identities()
+        return self.draw_identities(pic_display)  # Show the output frame
+
+    def identify_async(self, pic_display):
+        """
+        Apply the latest inference worker result to the face tracks and
+        submit the current frame when a detection is due and the worker
+        is free.
+        """
+        result = self.worker.poll()
+        if result is not None and result['mode'] == 'identify':
+            tracks = self.tracker.update(result['bound_boxes'])
+            if len(result['bound_boxes']):
+                self.motion_gate.wake()
+            for (i, guest_id, prob) in zip(result['embed_inds'],
+                                           result['guest_ids'],
+                                           result['probs']):
+                if tracks[i].needs_embedding:
+                    self.tracker.add_vote(tracks[i], guest_id, prob,
+                                          self.signed_in_ids)
+
+        if not self.worker.busy and self.detection_due(pic_display):
+            skip_boxes = [track.bound_box for track in self.tracker.tracks
+                          if not track.needs_embedding]
+            if self.worker.submit(pic_display,
+                                  'identify',
+                                  skip_boxes=skip_boxes,
+                                  iou_thresh=self.tracker.iou_thresh):
+                self.detect_requested = False
+
+    def check_worker(self):
+        """
+        Run detection and recognition in this process from now on if the
+        inference worker failed for good.
+        """
+        if self.worker is None or not self.worker.failed:
+            return
+        print("[INFO] loading face detector and embedding model in process...")
+        models = self.worker.models
+        self.worker.stop()
+        self.worker = None
+        self.detector = load_detector(self.pn_detector_model)
+        self.embedder = load_embedder(self.fn_embedding_model)
+        if models is not None:
+            try:
+                self.models = load_recognition_models(*models)
+            except Exception as e:
+                print("[ERROR] Unable to load the recognition models:")
+                print(e)
+
+    def load_recognition_models(self, pn_model_store, version=None):
+        """
+        Load the guest specific recognizer and label encoder from the model
+        store, in the inference worker if there is one.
+        """
+        if self.worker is not None:
+            self.worker.load_models(pn_model_store, version)
+        else:
+            self.models = load_recognition_models(pn_model_store, version)
 
-        # Use previously loaded face detector on the blob
-        self.detector.setInput(image_blob)
-        detections = self.detector.forward()
+    def swap_recognition_models(self, pn_model_store, version=None):
+        """
+        Replace the recognition models while identifying. Tracks are
+        dropped so faces are recognized again with the new models, guests
+        already signed in stay signed in.
+        """
+        self.load_recognition_models(pn_model_store, version)
+        self.tracker.reset()
+        self.request_detection()
 
-        self.guest_ids = {}
-        for i in range(0, detections.shape[2]):
-            # Determine detection confidence
-            curr_confidence = detections[0, 0, i, 2]
-
-            # Threshold confidence via configuration file
-            if curr_confidence > self.min_detec_conf:
-                # Return bounding box (x,y)-coordinates
-                bound_box = detections[0, 0, i, 3:7] * np.array([pic_width,
-                                                                 pic_height,
-                                                                 pic_width,
-                                                                 pic_height])
-                (x_start, y_start, x_end, y_end) = bound_box.astype("int")
-
-                # Return face region of interest dimensions
-                face = pic_display[y_start:y_end, x_start:x_end]
-
-                # Skip faces below a min size
-                (face_height, face_width) = face.shape[:2]
-                if face_height < self.min_face_px[0] \
-                   or face_width < self.min_face_px[1]:
-                    continue
-                # Only detect faces fully in the frame
-                if x_start < 0 or y_start < 0:
-                    continue
-                if x_end > self.image_width or y_end > self.image_width:
-                    continue
-
-                # Create OpenCV blob for face region of interest
-                face_blob = cv2.dnn.blobFromImage(cv2.resize(face, (96, 96)),
-                                                  1.0 / 255,
-                                                  (96, 96),
-                                                  (0, 0, 0),
-                                                  swapRB=True,
-                                                  crop=False)
-                # Pass face blob into embedder,
-                # return 128-D describing vector
-                self.embedder.setInput(face_blob)
-                face_vec = self.embedder.forward()
-
-                # Use previously loaded recognizer on the face blob
-                # to recognize the face
-                preds = self.recognizer.predict_proba(face_vec)[0]
-                max_pred_ind = np.argmax(preds)
-                prob = preds[max_pred_ind]
-                guest_id = self.label_encoder.classes_[max_pred_ind]
-
-                # Filter out low classification probabilies
-                # I.e. camera images must have a facial detection
-                # of min_detect_conf and facial recognition
-                # classification probability of min_recog_prob
-
-                #print(curr_confidence,  # Keep for optimizing the detect/recog %
-                #      prob,
-                #      self.determine_guest_info(self.known_guest_meta,
-                #                                guest_id))
-                if prob >= self.min_recog_prob:
-                    # Store guest_id info as dict of {guest_id:prob}
-                    self.guest_ids[guest_id] = round(prob, 4)
-
-                    # Print guest_info from known_guest_meta data
-                    guest_info = self.determine_guest_info(self.known_guest_meta,
-                                                           guest_id)
-
-                    # Write out guest_info and recog probability
-                    text = "{:.2f}%: {}".format(round(prob*100, 2), guest_info)
-                    y = y_start - 15 if y_start - 15 > 15 else y_start + 15
-                    cv2.rectangle(pic_display,
-                                  (x_start, y_start),
-                                  (x_end, y_end),
-                                  (17, 190, 252),
-                                  2)
-                    cv2.putText(pic_display,
-                                text,
-                                (x_start, y),
-                                cv2.FONT_HERSHEY_SIMPLEX,
-                                0.45,
-                                (17, 190, 252),
-                                2)
-        return pic_display  # Show the output frame
+    def draw_identities(self, pic_display):
+        """
+        Draw identified face tracks onto a picture.
+        """
+        with self.metrics.timer('draw'):
+            return self._draw_identities(pic_display)
+
+    def _draw_identities(self, pic_display):
+        for track in self.tracker.tracks:
+            # Filter out low classification probabilies
+            # I.e. camera images must have a facial detection
+            # of min_detect_conf and facial recognition
+            # classification probability of min_recog_prob
+            if track.guest_id is None or track.prob < self.min_recog_prob:
+                continue
+            (x_start, y_start, x_end, y_end) = track.bound_box.astype("int")
+
+            # Print guest_info from known_guest_meta data
+            guest_info = self.determine_guest_info(self.known_guest_meta,
+                                                   track.guest_id)
+
+            # Write out guest_info and recog probability
+            text = "{:.2f}%: {}".format(round(track.prob*100, 2), guest_info)
+            y = y_start - 15 if y_start - 15 > 15 else y_start + 15
+            cv2.rectangle(pic_display,
+                          (x_start, y_start),
+                          (x_end, y_end),
+                          (17, 190, 252),
+                          2)
+            cv2.putText(pic_display,
+                        text,
+                        (x_start, y),
+                        cv2.FONT_HERSHEY_SIMPLEX,
+                        0.45,
+                        (17, 190, 252),
+                        2)
+        return pic_display
 
     def destructor(self):
         """
         Destroy the root object and release all resources.
         """
-        cv2.destroyAllWindows()
+        self.grabber.stop()
+        self.stop_recording()
+        self.capture_writer.close()
+        if self.worker is not None:
+            self.worker.stop()
+        try:
+            cv2.destroyAllWindows()
+        except cv2.error:  # Headless OpenCV builds have no windows
+            pass
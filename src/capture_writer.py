@@ -0,0 +1,141 @@
+# Background, batched writer for guest capture images
+
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import uuid
+
+from encrypt_archive import encode_png
+from metrics import metrics
+
+
+def default_staging_dir():
+    """
+    Stage captures in tmpfs when available so they stay in memory.
+    """
+    pn_base = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(pn_base, 'biometric_capture')
+
+
+class CaptureWriter:
+    def __init__(self, guest_archive, pn_staging=None):
+        """
+        PNG encode captured images on a background thread into a staging
+        directory, then commit each capture session to the encrypted archive
+        in a single append. Sessions left behind by a crash are committed
+        by recover().
+        """
+        self.guest_archive = guest_archive
+        self.pn_staging = pn_staging or default_staging_dir()
+        os.makedirs(self.pn_staging, mode=0o700, exist_ok=True)
+        self.pn_session = None
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run,
+                                       name='CaptureWriter',
+                                       daemon=True)
+        self.thread.start()
+
+    def start_session(self):
+        """
+        Start staging images for a new capture session.
+        """
+        self.finish_session()
+        self.pn_session = os.path.join(self.pn_staging,
+                                       'session_{}'.format(uuid.uuid4()))
+        os.makedirs(self.pn_session, mode=0o700)
+
+    def add_image(self, path, image_array):
+        """
+        Queue an image to be staged at path, relative to the archive root.
+        The image is copied as camera buffers are reused.
+        """
+        if self.pn_session is None:
+            print("[ERROR] No capture session started, image {} not saved."
+                  .format(path))
+            return
+        self.queue.put(('image', self.pn_session, path, image_array.copy()))
+
+    def finish_session(self, commit=True):
+        """
+        Commit the current session to the archive, or discard it.
+        """
+        if self.pn_session is None:
+            return
+        self.queue.put(('commit' if commit else 'discard', self.pn_session))
+        self.pn_session = None
+
+    def recover(self):
+        """
+        Commit sessions left in the staging directory by a previous run.
+        """
+        pns_session = [os.path.join(self.pn_staging, pn) for pn
+                       in sorted(os.listdir(self.pn_staging))
+                       if pn.startswith('session_')]
+        pns_session = [pn for pn in pns_session if pn != self.pn_session]
+        if pns_session:
+            print('[INFO] Recovering {} unsaved capture session(s)...'
+                  .format(len(pns_session)))
+        for pn_session in pns_session:
+            self.queue.put(('commit', pn_session))
+
+    def flush(self):
+        """
+        Wait until every queued image and commit has been written.
+        """
+        self.queue.join()
+
+    def close(self):
+        """
+        Commit any open session and wait for all writes to finish.
+        """
+        self.finish_session()
+        self.queue.put(('stop',))
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item[0] == 'stop':
+                    break
+                elif item[0] == 'image':
+                    with metrics.timer('archive_stage'):
+                        self._stage_image(*item[1:])
+                    metrics.count('images_captured')
+                elif item[0] == 'commit':
+                    with metrics.timer('archive_commit'):
+                        self._commit(item[1])
+                elif item[0] == 'discard':
+                    shutil.rmtree(item[1], ignore_errors=True)
+            except Exception as e:
+                print("[ERROR] Capture writer failed on {}:".format(item[0]))
+                print(e)
+            finally:
+                self.queue.task_done()
+
+    def _stage_image(self, pn_session, path, image_array):
+        fn_image = os.path.join(pn_session, path)
+        os.makedirs(os.path.dirname(fn_image), exist_ok=True)
+        # Write then rename so a crash never leaves a partial image
+        with open(fn_image + '.tmp', 'wb') as f:
+            f.write(encode_png(image_array))
+        os.replace(fn_image + '.tmp', fn_image)
+
+    def _commit(self, pn_session):
+        if not os.path.isdir(pn_session):
+            return
+        fns_image = sorted(os.path.relpath(os.path.join(pn, fn), pn_session)
+                           for (pn, _, fns) in os.walk(pn_session)
+                           for fn in fns if not fn.endswith('.tmp'))
+        if fns_image:
+            print('[INFO] Saving {} captured images to archive...'
+                  .format(len(fns_image)))
+            stdout, stderr = self.guest_archive.add_file(fns_image, cwd=pn_session)
+            if b'Everything is Ok' not in stdout:
+                print('[ERROR] Saving captured images failed, keeping {} '
+                      'to retry on next start:'.format(pn_session))
+                print(stderr.decode('utf-8', errors='replace'))
+                return
+        shutil.rmtree(pn_session, ignore_errors=True)
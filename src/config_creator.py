@@ -12,6 +12,18 @@ config['DEFAULT'] = {}
 
 # System PW:
 #config['DEFAULT']['pw_guestdb'] = 'ChangEmEPleasE'  # Uncomment to enable automatic entry
+# Or read it from a file (first line), e.g. for signin_service.py; the
+# BIOMETRIC_PW and BIOMETRIC_PW_FILE environment variables take precedence
+#config['DEFAULT']['pw_guestdb_file'] = '/run/secrets/biometric_pw'
+# Guest db encryption, changing these makes an existing db unreadable
+config['DEFAULT']['db_cipher'] = 'aes-256--cfb'
+config['DEFAULT']['db_kdf_iter'] = '64000'
+# Write-ahead log, sign ins commit without blocking reads
+config['DEFAULT']['db_journal_mode'] = 'WAL'
+# Keyed db connections kept open, each derives the key once when opened
+config['DEFAULT']['db_pool_size'] = '2'
+# Seconds between writes of identified guests to the db
+config['DEFAULT']['signin_flush_interval'] = '10'
 
 # Camera Settings
 config['DEFAULT']['camera_rot'] = '90'
@@ -19,6 +31,24 @@ config['DEFAULT']['capture_interval'] = '0.5'
 config['DEFAULT']['max_capture_length'] = '120'  # Max capture guest seconds
 config['DEFAULT']['max_images'] = '60'  # Max capture guest images?
 config['DEFAULT']['image_width'] = '600'
+# Device index, video file or directory of images to read frames from
+config['DEFAULT']['camera_source'] = '0'
+# Newest frames kept by the capture thread, older frames are dropped
+config['DEFAULT']['frame_buffer_size'] = '2'
+# Playback rate for video file and image directory sources
+config['DEFAULT']['source_fps'] = '30'
+# Per stage latency histograms and counters: served in Prometheus format at
+# http://metrics_host:metrics_port/metrics if metrics_port is not 0, and
+# logged every metrics_log_interval seconds if that is not 0
+config['DEFAULT']['metrics_enabled'] = 'False'
+config['DEFAULT']['metrics_host'] = '127.0.0.1'
+config['DEFAULT']['metrics_port'] = '0'
+config['DEFAULT']['metrics_log_interval'] = '60'
+# Record raw frames with timestamps to this file for replay.py, unencrypted,
+# so keep empty unless profiling
+config['DEFAULT']['fn_frame_recording'] = ''
+# Run detection and recognition in a separate process from the display
+config['DEFAULT']['inference_worker'] = 'True'
 
 # Sign-in Options
 # Display db clients table row entry when recognized
@@ -29,6 +59,61 @@ config['DEFAULT']['min_detec_conf'] = '0.50'
 config['DEFAULT']['min_recog_prob'] = '0.70'
 config['DEFAULT']['min_face_px'] = '(20, 20)'
 
+# Face Tracking
+# Run full detection every n identify frames, faces are tracked in between
+config['DEFAULT']['detect_interval'] = '5'
+# Min overlap to match a detection to an existing track
+config['DEFAULT']['track_iou_thresh'] = '0.3'
+# Detections a track may miss before it is dropped
+config['DEFAULT']['track_max_misses'] = '2'
+# A track is identified once track_vote_min of its last track_vote_len
+# recognitions agree
+config['DEFAULT']['track_vote_len'] = '5'
+config['DEFAULT']['track_vote_min'] = '3'
+
+# Idle Mode
+# Frames are compared downscaled to motion_width pixels wide; motion is a
+# change of over motion_pixel_thresh gray levels in motion_area_thresh of them
+config['DEFAULT']['motion_width'] = '64'
+config['DEFAULT']['motion_pixel_thresh'] = '25'
+config['DEFAULT']['motion_area_thresh'] = '0.01'
+# Seconds without motion or faces before going idle
+config['DEFAULT']['idle_timeout'] = '10'
+# Seconds between detections while idle
+config['DEFAULT']['idle_detect_interval'] = '2.0'
+
+# Training
+# Embedding worker processes, 0 for one per core
+config['DEFAULT']['embed_workers'] = '0'
+# Images per detector/embedder forward pass while training
+config['DEFAULT']['embed_batch_size'] = '8'
+# Checkpoint embeddings to disk every embed_checkpoint_images images or
+# embed_checkpoint_seconds, so an interrupted training resumes from there
+config['DEFAULT']['embed_checkpoint_images'] = '500'
+config['DEFAULT']['embed_checkpoint_seconds'] = '120'
+# Recognizer: svc grid searches a SVM over every guest on each training,
+# centroid and knn add and remove guests incrementally in milliseconds
+config['DEFAULT']['recognizer_mode'] = 'svc'
+# Softmax temperature of centroid similarities, and how many times a
+# guest's embedding spread a face may lie from their centroid
+config['DEFAULT']['centroid_temperature'] = '0.05'
+config['DEFAULT']['centroid_radius_scale'] = '2.0'
+# knn votes among the knn_k most similar embeddings, damped below
+# knn_min_sim. knn_index is exact, ivfpq (approximate, for large galleries)
+# or auto; knn_int8 stores exact vectors as int8. ivfpq scans knn_n_probe lists
+config['DEFAULT']['knn_k'] = '5'
+config['DEFAULT']['knn_temperature'] = '0.05'
+config['DEFAULT']['knn_min_sim'] = '0.5'
+config['DEFAULT']['knn_index'] = 'auto'
+config['DEFAULT']['knn_int8'] = 'False'
+config['DEFAULT']['knn_n_probe'] = '8'
+# Embeddings svc and knn train on: at most max_train_per_guest diverse
+# exemplars per guest, and max_train_unknown of the unknown class spread
+# over unknown_strata clusters; 0 keeps all
+config['DEFAULT']['max_train_per_guest'] = '20'
+config['DEFAULT']['max_train_unknown'] = '500'
+config['DEFAULT']['unknown_strata'] = '16'
+
 # Path and filenames:
 config['DEFAULT']['fn_meal_log_default'] = os.path.join(biometric_dir,
                                                         'meal_logs',
@@ -42,6 +127,9 @@ config['DEFAULT']['fn_datadict'] = os.path.join(biometric_dir,
 config['DEFAULT']['pn_guest_images_archive'] = os.path.join(biometric_dir,
                                                             'data',
                                                             'guest_images.7z')
+# Captured images are staged here until a capture session is saved,
+# tmpfs keeps them in memory
+config['DEFAULT']['pn_capture_staging'] = '/dev/shm/biometric_capture'
 
 # Pretrained OpenCV caffe model for localizing faces
 # Build instructions are here:
@@ -60,11 +148,25 @@ config['DEFAULT']['fn_embedding_model'] = os.path.join(biometric_dir,
                                                        'openface_nn4.small2.v1.t7')
 
 # Guest-specific datastore and models:
-# Serialized faces with names
-config['DEFAULT']['fn_serialized_embeddings'] = os.path.join(biometric_dir,
-                                                             'models',
-                                                             'guest_specific',
-                                                             'embeddings.pickle')
+# Memory-mapped face embeddings with names
+config['DEFAULT']['pn_embedding_store'] = os.path.join(biometric_dir,
+                                                       'models',
+                                                       'guest_specific',
+                                                       'embedding_store')
+# float32, or float16 to halve the store size
+config['DEFAULT']['embedding_dtype'] = 'float32'
+# Encrypted cache of face detections and embeddings per archived image,
+# so only new images are embedded
+config['DEFAULT']['fn_embedding_cache'] = os.path.join(biometric_dir,
+                                                       'models',
+                                                       'guest_specific',
+                                                       'embedding_cache.7z')
+# Versioned recognizer and label encoder models
+config['DEFAULT']['pn_model_store'] = os.path.join(biometric_dir,
+                                                   'models',
+                                                   'guest_specific',
+                                                   'model_versions')
+# Pickled models of earlier versions, imported into the model store
 # Label encoder
 config['DEFAULT']['fn_label_encoder'] = os.path.join(biometric_dir,
                                                      'models',
@@ -1,6 +1,7 @@
 import configparser
 import datetime
 import json
+import time
 
 import pandas as pd
 from sqlalchemy import Column
@@ -14,6 +15,9 @@ from sqlalchemy import func
 from sqlalchemy.exc import DatabaseError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+
+from metrics import metrics
 
 Base = declarative_base()
 fn_config = 'biometric.cfg'
@@ -87,6 +91,18 @@ class Clients(Base):
     date_deleted = Column(DateTime)
 
 
+def sqlcipher_dbapi():
+    """
+    DB-API module of SQLCipher, as packaged for sqlalchemy's pysqlcipher
+    dialect.
+    """
+    try:
+        from sqlcipher3 import dbapi2
+    except ImportError:
+        from pysqlcipher3 import dbapi2
+    return dbapi2
+
+
 def hmisv17_newguestdiag(guest_meta, datadict_menu_rev):
     """
     Translate guest metadata from the new guest dialog into
@@ -195,24 +211,81 @@ class db:
         fn_datadict = config['DEFAULT']['fn_datadict']
 
         dbtype = dbtype.lower()
-        self.db_engine = create_engine(
-                '{0}://:{1}@/{2}?'
-                'cipher=aes-256--cfb&kdf_iter=64000'.format(dbtype,
-                                                            password,
-                                                            dbname))
+        if dbtype == 'sqlite+pysqlcipher':
+            # Keying a SQLCipher connection derives the key from the password
+            # (kdf_iter rounds of PBKDF2), so a few keyed connections are kept
+            # open and shared by every query instead of one per query
+            self.dbname = dbname
+            self.password = password or ''
+            self.cipher = config['DEFAULT'].get('db_cipher', 'aes-256--cfb')
+            self.kdf_iter = int(config['DEFAULT'].get('db_kdf_iter', '64000'))
+            self.pool_size = int(config['DEFAULT'].get('db_pool_size', '2'))
+            self.journal_mode = config['DEFAULT'].get('db_journal_mode', 'WAL')
+            self.dbapi = sqlcipher_dbapi()
+            # module lets sqlalchemy wrap sqlcipher errors as its own
+            self.db_engine = create_engine('sqlite://',
+                                           module=self.dbapi,
+                                           creator=self.connect,
+                                           poolclass=QueuePool,
+                                           pool_size=self.pool_size,
+                                           max_overflow=0,
+                                           pool_timeout=60)
+        else:
+            self.dbapi = None
+            self.pool_size = 1
+            self.db_engine = create_engine('{0}:///{1}'.format(dbtype, dbname))
         Session = sessionmaker(bind=self.db_engine)
         self.session = Session()
 
         with open(fn_datadict) as f:
             self.datadict = json.load(f)
 
+    def connect(self):
+        """
+        New SQLCipher connection keyed with the password, checked with a
+        read of the schema as the key is only derived on first use.
+        """
+        start = time.perf_counter()
+        connection = self.dbapi.connect(self.dbname, check_same_thread=False)
+        try:
+            connection.execute("PRAGMA key = '{}'".format(self.password.replace("'", "''")))
+            connection.execute("PRAGMA cipher = '{}'".format(self.cipher))
+            connection.execute("PRAGMA kdf_iter = {:d}".format(self.kdf_iter))
+            connection.execute("SELECT count(*) FROM sqlite_master").fetchone()
+            # WAL lets sign in writes commit without blocking readers
+            connection.execute("PRAGMA journal_mode = {}".format(self.journal_mode)).fetchone()
+        except Exception:
+            connection.close()
+            raise
+        metrics.observe('db_connect', time.perf_counter() - start)
+        metrics.count('db_connections')
+        return connection
+
     def test_db_connection(self):
+        """
+        Whether the password opens the db, on a connection then kept in
+        the pool.
+        """
         try:
-            self.db_engine.table_names()
+            with self.db_engine.connect() as connection:
+                connection.execute('SELECT count(*) FROM sqlite_master').fetchone()
             return True
         except DatabaseError:
             return False
 
+    def warm_pool(self):
+        """
+        Open the rest of the pool's connections ahead of use, e.g. on a
+        startup thread once test_db_connection passed.
+        """
+        connections = [self.db_engine.connect() for _ in range(self.pool_size)]
+        for connection in connections:
+            connection.close()
+
+    def close(self):
+        self.session.close()
+        self.db_engine.dispose()
+
     def create_db_tables(self):
         try:
             Base.metadata.create_all(self.db_engine)
@@ -275,6 +348,14 @@ class db:
                          index=False,
                          if_exists='append')
 
+    def record_sign_ins(self, sign_ins):
+        """
+        Insert sign in rows, dicts of signin table columns, in one
+        transaction with a single executemany.
+        """
+        with self.db_engine.begin() as connection:
+            connection.execute(SignLog.__table__.insert(), sign_ins)
+
     def record_startstop(self, dictionary):
         self.session.merge(SignSS(**dictionary))
         self.session.commit()
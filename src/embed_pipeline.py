@@ -0,0 +1,237 @@
+# Parallel face embedding of archived guest images
+
+from collections import deque
+import multiprocessing as mp
+import os
+import queue
+import threading
+import time
+
+import cv2
+import imutils
+import numpy as np
+
+from face_pipeline import embed_crops
+from face_pipeline import load_detector
+from face_pipeline import load_embedder
+
+# Models loaded once per worker process by _init_worker
+_worker = {}
+
+
+def _init_worker(settings, n_threads=None):
+    """
+    Pool initializer: load the detector and embedder once per process.
+    """
+    if n_threads is not None:
+        cv2.setNumThreads(n_threads)  # Don't oversubscribe the cores
+    _worker['detector'] = load_detector(settings['pn_detector_model'])
+    _worker['embedder'] = load_embedder(settings['fn_embedding_model'])
+    _worker['settings'] = settings
+
+
+def _embed_batch(batch):
+    """
+    Detect the largest face in each (path, image) of batch and embed them
+    all, detection and embedding each run as a single forward pass.
+    Returns [(path, box, conf, face_vec), ...] in batch order, box and
+    face_vec being None when no usable face was found.
+    """
+    detector = _worker['detector']
+    embedder = _worker['embedder']
+    settings = _worker['settings']
+    if not batch:
+        return []
+
+    size = settings['detector_size']
+    blob = cv2.dnn.blobFromImages([cv2.resize(image, (size, size))
+                                   for (_, image) in batch],
+                                  1.0,
+                                  (size, size),
+                                  settings['trainRBGavg'],
+                                  swapRB=False,
+                                  crop=False)
+    detector.setInput(blob)
+    detections = detector.forward()[0, 0]
+
+    # Batched SSD output rows are (image_id, class, conf, x0, y0, x1, y1)
+    faces, face_inds = [], []
+    boxes, confs = [None] * len(batch), [0.0] * len(batch)
+    for (i, (_, image)) in enumerate(batch):
+        image_dets = detections[detections[:, 0] == i]
+        if len(image_dets) == 0:
+            continue
+        # Assume one face per image; use bounding box with largest confidence
+        best_det = image_dets[np.argmax(image_dets[:, 2])]
+        confs[i] = float(best_det[2])
+        if best_det[2] <= settings['min_detec_conf']:
+            continue
+        (image_height, image_width) = image.shape[:2]
+        bound_box = best_det[3:7] * np.array([image_width,
+                                              image_height,
+                                              image_width,
+                                              image_height])
+        (x_start, y_start, x_end, y_end) = bound_box.astype("int")
+        face = image[y_start:y_end, x_start:x_end]
+
+        # Skip faces below a min size
+        (face_height, face_width) = face.shape[:2]
+        if face_height < settings['min_face_px'][0] \
+           or face_width < settings['min_face_px'][1]:
+            continue
+        faces.append(face)
+        face_inds.append(i)
+        boxes[i] = (x_start, y_start, x_end, y_end)
+
+    face_vecs = [None] * len(batch)
+    for (i, face_vec) in zip(face_inds, embed_crops(embedder, faces)):
+        face_vecs[i] = face_vec.flatten()
+    return [(path, boxes[i], confs[i], face_vecs[i])
+            for (i, (path, _)) in enumerate(batch)]
+
+
+class EmbeddingPipeline:
+    def __init__(self, settings, n_workers=0, batch_size=8):
+        """
+        Embed archived images with a producer/consumer pipeline: a reader
+        thread streams and decodes images out of the archive into batches,
+        a pool of worker processes, each holding its own detector and
+        embedder, detects and embeds the batches, and results are collected
+        in archive order. Images are resized to settings['resize_width']
+        before detection. n_workers of 0 uses every core, with 1 worker
+        everything runs in this process.
+        """
+        self.settings = settings
+        self.n_workers = n_workers if n_workers > 0 else (os.cpu_count() or 1)
+        self.batch_size = max(1, batch_size)
+
+    @staticmethod
+    def _put(batches, batch, stop):
+        """
+        Queue a batch, returns False instead if stop is set meanwhile.
+        """
+        while not stop.is_set():
+            try:
+                batches.put(batch, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _read_batches(self, image_iter, batches, stop):
+        """
+        Reader stage: decode and resize images and queue them in batches,
+        until image_iter ends or stop is set. image_iter is closed here, in
+        the thread iterating it, so the archive stream is released.
+        """
+        batch = []
+        try:
+            for (image_path, image) in image_iter:
+                if stop.is_set():
+                    break
+                if image is None:
+                    print("[ERROR] Unable to decode {}, skipping...".format(image_path))
+                    continue
+                try:
+                    image = imutils.resize(image, width=self.settings['resize_width'])
+                except Exception as e:
+                    print("Error in {}:".format(image_path))
+                    print(e)
+                    print("Skipping...")
+                    continue
+                batch.append((image_path, image))
+                if len(batch) == self.batch_size:
+                    if not self._put(batches, batch, stop):
+                        break
+                    batch = []
+            if batch:
+                self._put(batches, batch, stop)
+        except Exception as e:
+            print("[ERROR] Reading images from archive failed:")
+            print(e)
+        finally:
+            if hasattr(image_iter, 'close'):
+                image_iter.close()
+            self._put(batches, None, stop)
+
+    def run(self, image_iter, n_images, progress=None):
+        """
+        Yield (image_path, box, conf, face_vec) for every decodable image
+        of image_iter, in order, reporting throughput as it goes.
+        progress(n_done, n_images) is called after every batch.
+        """
+        # Bounded so decoded images don't pile up ahead of the workers
+        batches = queue.Queue(maxsize=2 * self.n_workers)
+        stop = threading.Event()
+        reader = threading.Thread(target=self._read_batches,
+                                  args=(image_iter, batches, stop),
+                                  name='EmbeddingReader',
+                                  daemon=True)
+        reader.start()
+        try:
+            yield from self._embed(batches, n_images, progress)
+        finally:
+            # Also when closed early or a batch failed: unblock the reader
+            # so it closes image_iter, and its 7z process, and exits
+            stop.set()
+            while True:
+                try:
+                    batches.get_nowait()
+                except queue.Empty:
+                    break
+            reader.join()
+
+    def _embed(self, batches, n_images, progress):
+        progress = _Progress(n_images, callback=progress)
+        if self.n_workers == 1:
+            _init_worker(self.settings)
+            for batch in iter(batches.get, None):
+                results = _embed_batch(batch)
+                progress.update(len(results))
+                yield from results
+        else:
+            ctx = mp.get_context('spawn')  # Workers only need the models
+            with ctx.Pool(self.n_workers,
+                          initializer=_init_worker,
+                          initargs=(self.settings, 1)) as pool:
+                in_flight = deque()
+                for batch in iter(batches.get, None):
+                    in_flight.append(pool.apply_async(_embed_batch, (batch,)))
+                    # Collect in order, keeping every worker busy
+                    while len(in_flight) >= 2 * self.n_workers:
+                        results = in_flight.popleft().get()
+                        progress.update(len(results))
+                        yield from results
+                while in_flight:
+                    results = in_flight.popleft().get()
+                    progress.update(len(results))
+                    yield from results
+        progress.finish()
+
+
+class _Progress:
+    def __init__(self, n_images, interval=5.0, callback=None):
+        """
+        Periodic images per second report. callback(n_done, n_images) is
+        called on every update.
+        """
+        self.n_images = n_images
+        self.interval = interval
+        self.callback = callback
+        self.n_done = 0
+        self.start = self.last_report = time.monotonic()
+
+    def update(self, n):
+        self.n_done += n
+        if self.callback is not None:
+            self.callback(self.n_done, self.n_images)
+        now = time.monotonic()
+        if now - self.last_report >= self.interval:
+            self.last_report = now
+            print("[INFO] Processed {}/{} images, {:.1f} images/s".format(
+                self.n_done, self.n_images, self.n_done / (now - self.start)))
+
+    def finish(self):
+        elapsed = max(time.monotonic() - self.start, 1e-9)
+        print("[INFO] Processed {} images in {:.1f}s, {:.1f} images/s".format(
+            self.n_done, elapsed, self.n_done / elapsed))
@@ -0,0 +1,176 @@
+# Content addressed cache of face detections and embeddings
+
+import glob
+import io
+import json
+import os
+
+import numpy as np
+
+
+def entry_key(size, crc):
+    """
+    Cache key of an archive entry from its size and CRC32, or None if the
+    entry has no CRC to address it by.
+    """
+    if not crc:
+        return None
+    return '{}:{}'.format(crc, size)
+
+
+class EmbeddingCache:
+    def __init__(self, archive, fn_cache, settings):
+        """
+        Detected face box, confidence and 128-d embedding of archived
+        images, keyed by the content of each archive entry so only new or
+        changed images need embedding. Images without a usable face are
+        cached too. The cache is stored encrypted with the archive's
+        password, and is discarded if the detection settings change.
+        checkpoint() durably writes only the entries added since the last
+        write as a numbered part file next to the cache, so an interrupted
+        run resumes from its last checkpoint; save() folds the parts back
+        into the cache.
+        """
+        self.archive = archive
+        self.fn_cache = fn_cache
+        self.settings = json.dumps(settings, sort_keys=True)
+        self.entries = {}  # key: (box, conf, face_vec or None)
+        self.pending = set()  # Keys added since the last write
+        self.fns_part = []  # Part files whose entries are in entries
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def add(self, key, box, conf, face_vec):
+        if key is not None:
+            self.entries[key] = (box, conf, face_vec)
+            self.pending.add(key)
+
+    def retain(self, keys):
+        """
+        Drop entries not in keys, e.g. for images of deleted guests.
+        Returns the number of entries dropped.
+        """
+        keys = set(keys)
+        stale = [key for key in self.entries if key not in keys]
+        for key in stale:
+            del self.entries[key]
+        return len(stale)
+
+    def part_files(self):
+        return sorted(glob.glob(glob.escape(self.fn_cache) + '.*.part'))
+
+    def _read(self, fn):
+        """
+        Add the entries of a cache or part file, returns whether it could
+        be used.
+        """
+        data = self.archive.read_bytes(fn, 'embeddings.npz')
+        if not data:
+            return False
+        try:
+            arrays = np.load(io.BytesIO(data), allow_pickle=False)
+            if str(arrays['settings']) != self.settings:
+                return False
+            for (key, box, conf, face_vec, has_face) in zip(arrays['keys'],
+                                                           arrays['boxes'],
+                                                           arrays['confs'],
+                                                           arrays['face_vecs'],
+                                                           arrays['has_face']):
+                self.entries[str(key)] = (box, float(conf),
+                                          face_vec if has_face else None)
+        except (OSError, ValueError, KeyError) as e:
+            print("[ERROR] Unable to read embedding cache {}:".format(fn))
+            print(e)
+            return False
+        return True
+
+    def load(self):
+        """
+        Read the cache and any checkpoints from disk, skipping those that
+        can't be decrypted or were made with other settings. Checkpoints
+        are read even if the cache isn't, so a re-embed after a settings
+        change resumes too.
+        """
+        self.entries = {}
+        self.pending = set()
+        self.fns_part = []
+        if os.path.isfile(self.fn_cache) and not self._read(self.fn_cache):
+            print("[INFO] Embedding cache unusable or settings changed, "
+                  "re-embedding all images...")
+            self.entries = {}
+        n_cached = len(self.entries)
+        for fn_part in self.part_files():
+            if self._read(fn_part):
+                self.fns_part.append(fn_part)
+        if self.fns_part:
+            # Already durable in the part files, save() folds them in
+            print("[INFO] Resuming from {} checkpointed images.".format(
+                len(self.entries) - n_cached))
+
+    def _write(self, fn, keys):
+        n_dims = 128
+        for (_, _, face_vec) in self.entries.values():
+            if face_vec is not None:
+                n_dims = len(face_vec)
+                break
+        boxes = np.zeros((len(keys), 4), dtype=np.int32)
+        confs = np.zeros(len(keys), dtype=np.float32)
+        face_vecs = np.zeros((len(keys), n_dims), dtype=np.float32)
+        has_face = np.zeros(len(keys), dtype=bool)
+        for (i, key) in enumerate(keys):
+            (box, conf, face_vec) = self.entries[key]
+            confs[i] = conf
+            if box is not None:
+                boxes[i] = box
+            if face_vec is not None:
+                face_vecs[i] = face_vec
+                has_face[i] = True
+
+        data = io.BytesIO()
+        np.savez(data,
+                 settings=np.array(self.settings),
+                 keys=np.array(keys, dtype=str),
+                 boxes=boxes,
+                 confs=confs,
+                 face_vecs=face_vecs,
+                 has_face=has_face)
+        os.makedirs(os.path.dirname(self.fn_cache) or '.', exist_ok=True)
+        return self.archive.write_bytes(fn, 'embeddings.npz', data.getvalue())
+
+    def checkpoint(self):
+        """
+        Durably write the entries added since the last write.
+        """
+        keys = [key for key in self.pending if key in self.entries]
+        if not keys:
+            return True
+        fns_part = self.part_files()
+        n_part = int(fns_part[-1].split('.')[-2]) + 1 if fns_part else 0
+        fn_part = '{}.{:06d}.part'.format(self.fn_cache, n_part)
+        if not self._write(fn_part, keys):
+            return False
+        self.fns_part.append(fn_part)
+        self.pending = set()
+        return True
+
+    def save(self):
+        """
+        Atomically write the whole cache to disk, encrypted, replacing the
+        checkpoints folded into it. Checkpoints made with other settings
+        are left alone.
+        """
+        if not self._write(self.fn_cache, list(self.entries)):
+            return False
+        for fn_part in self.fns_part:
+            if os.path.exists(fn_part):
+                os.remove(fn_part)
+        self.fns_part = []
+        self.pending = set()
+        return True
@@ -0,0 +1,280 @@
+# Nearest-neighbour search over face embeddings
+
+import numpy as np
+
+
+def normalize_rows(X):
+    """
+    Scale rows to unit length, zero rows are left as they are.
+    """
+    X = np.asarray(X, dtype=np.float64)
+    norms = np.linalg.norm(X, axis=1, keepdims=True)
+    return X / np.maximum(norms, 1e-12)
+
+
+def kmeans(X, n_clusters, n_iter=20, max_samples=20000, seed=0):
+    """
+    Plain Lloyd's k-means on at most max_samples rows of X, initialized
+    with k-means++. Returns the (n_clusters, dim) centers.
+    """
+    rng = np.random.RandomState(seed)
+    X = np.asarray(X, dtype=np.float32)
+    if len(X) > max_samples:
+        X = X[rng.choice(len(X), max_samples, replace=False)]
+    n_clusters = min(n_clusters, len(X))
+
+    # k-means++ seeding
+    centers = np.empty((n_clusters, X.shape[1]), dtype=np.float32)
+    centers[0] = X[rng.randint(len(X))]
+    dists = ((X - centers[0]) ** 2).sum(axis=1)
+    for i in range(1, n_clusters):
+        probs = dists / dists.sum() if dists.sum() > 0 else None
+        centers[i] = X[rng.choice(len(X), p=probs)]
+        dists = np.minimum(dists, ((X - centers[i]) ** 2).sum(axis=1))
+
+    sq_norms = (X ** 2).sum(axis=1)
+    for _ in range(n_iter):
+        assign = nearest_centers(X, centers, sq_norms)
+        sums = np.zeros_like(centers)
+        np.add.at(sums, assign, X)
+        counts = np.bincount(assign, minlength=n_clusters)
+        filled = counts > 0  # Empty clusters keep their center
+        centers[filled] = sums[filled] / counts[filled, None]
+    return centers
+
+
+def nearest_centers(X, centers, sq_norms=None):
+    """
+    Index of the nearest center, by euclidean distance, of each row of X.
+    """
+    if sq_norms is None:
+        sq_norms = (X ** 2).sum(axis=1)
+    dists = (sq_norms[:, None] - 2 * X @ centers.T
+             + (centers ** 2).sum(axis=1)[None, :])
+    return np.argmin(dists, axis=1)
+
+
+def top_k(scores, k):
+    """
+    Return (scores, columns) of the k largest scores per row, best first.
+    """
+    k = min(k, scores.shape[1])
+    if k == 0:
+        return (np.empty((len(scores), 0), dtype=scores.dtype),
+                np.empty((len(scores), 0), dtype=np.int64))
+    cols = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    top = np.take_along_axis(scores, cols, axis=1)
+    order = np.argsort(-top, axis=1)
+    return (np.take_along_axis(top, order, axis=1),
+            np.take_along_axis(cols, order, axis=1))
+
+
+class EmbeddingIndex:
+    def __init__(self, mode='exact', int8=False, n_lists=None, n_probe=8,
+                 n_subvectors=16, block_size=8192):
+        """
+        Cosine similarity search over unit normalized embeddings, each
+        stored with an integer label.
+        mode 'exact' scores queries against every vector with blocked
+        matrix products and argpartition, vectors are kept as float32, or
+        int8 with int8. mode 'ivfpq' clusters vectors into n_lists
+        inverted lists (sqrt(n) by default) and stores each as its list
+        plus a product quantized residual of n_subvectors bytes; queries
+        only scan the n_probe nearest lists, using per query lookup tables.
+        """
+        self.mode = mode
+        self.int8 = int8
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.n_subvectors = n_subvectors
+        self.block_size = block_size
+        self.dim = None
+        self.labels = np.empty(0, dtype=np.int32)
+        self.vectors = None  # exact: (n, dim) float32 or int8
+        self.coarse = None  # ivfpq: (n_lists, dim) list centroids
+        self.codebooks = None  # ivfpq: (n_subvectors, 256, sub_dim)
+        self.lists = None  # ivfpq: (n,) list of each vector
+        self.codes = None  # ivfpq: (n, n_subvectors) uint8
+        self.n_trained = 0
+        self._inverted = None  # ivfpq: (rows sorted by list, list offsets)
+        self._dequantized = None  # exact int8: vectors as float32
+
+    def __len__(self):
+        return len(self.labels)
+
+    def nbytes(self):
+        arrays = [self.labels, self.vectors, self.coarse, self.codebooks,
+                  self.lists, self.codes]
+        return sum(array.nbytes for array in arrays if array is not None)
+
+    def _encode_exact(self, X):
+        if self.int8:
+            return np.clip(np.round(X * 127), -127, 127).astype(np.int8)
+        return X.astype(np.float32)
+
+    def _encode_pq(self, X):
+        """
+        Return (lists, codes) of unit vectors X.
+        """
+        lists = nearest_centers(X, self.coarse)
+        residuals = X - self.coarse[lists]
+        sub_dim = self.dim // self.n_subvectors
+        codes = np.empty((len(X), self.n_subvectors), dtype=np.uint8)
+        for j in range(self.n_subvectors):
+            codes[:, j] = nearest_centers(residuals[:, j * sub_dim:(j + 1) * sub_dim],
+                                          self.codebooks[j])
+        return lists.astype(np.int32), codes
+
+    def build(self, X, labels):
+        """
+        Index vectors X with labels from scratch, training the ivfpq
+        quantizers on them.
+        """
+        X = normalize_rows(X).astype(np.float32)
+        self.dim = X.shape[1]
+        self.labels = np.asarray(labels, dtype=np.int32)
+        if self.mode == 'exact':
+            self.vectors = self._encode_exact(X)
+            self._dequantized = None
+        elif self.mode == 'ivfpq' and len(X) == 0:
+            self.dim = None  # Quantizers are trained on the first vectors added
+        elif self.mode == 'ivfpq':
+            if self.dim % self.n_subvectors:
+                raise ValueError('Embedding size {} is not divisible into {} subvectors'
+                                 .format(self.dim, self.n_subvectors))
+            n_lists = self.n_lists or max(1, int(np.sqrt(len(X))))
+            self.coarse = kmeans(X, n_lists)
+            residuals = X - self.coarse[nearest_centers(X, self.coarse)]
+            sub_dim = self.dim // self.n_subvectors
+            self.codebooks = np.stack([
+                kmeans(residuals[:, j * sub_dim:(j + 1) * sub_dim], 256, n_iter=10)
+                for j in range(self.n_subvectors)])
+            if self.codebooks.shape[1] < 256:  # Fewer vectors than codes
+                self.codebooks = np.pad(self.codebooks,
+                                        ((0, 0), (0, 256 - self.codebooks.shape[1]), (0, 0)),
+                                        mode='edge')
+            self.lists, self.codes = self._encode_pq(X)
+            self.n_trained = len(X)
+            self._inverted = None
+        else:
+            raise ValueError('Unknown index mode {}'.format(self.mode))
+        return self
+
+    def add(self, X, labels):
+        """
+        Add vectors X with labels, ivfpq reuses the trained quantizers.
+        """
+        if self.dim is None:
+            return self.build(X, labels)
+        X = normalize_rows(X).astype(np.float32)
+        self.labels = np.concatenate([self.labels, np.asarray(labels, dtype=np.int32)])
+        if self.mode == 'exact':
+            self.vectors = np.concatenate([self.vectors, self._encode_exact(X)])
+            self._dequantized = None
+        else:
+            lists, codes = self._encode_pq(X)
+            self.lists = np.concatenate([self.lists, lists])
+            self.codes = np.concatenate([self.codes, codes])
+            self._inverted = None
+        return self
+
+    def remove(self, labels):
+        """
+        Drop all vectors with any of labels.
+        """
+        keep = ~np.isin(self.labels, labels)
+        self.labels = self.labels[keep]
+        if self.mode == 'exact' and self.vectors is not None:
+            self.vectors = self.vectors[keep]
+            self._dequantized = None
+        elif self.codes is not None:
+            self.lists = self.lists[keep]
+            self.codes = self.codes[keep]
+            self._inverted = None
+        return self
+
+    def search(self, Q, k=5):
+        """
+        Return (sims, labels), the cosine similarities and labels of the k
+        nearest vectors to each query, best first. Missing neighbours have
+        similarity -inf and label -1.
+        """
+        Q = normalize_rows(Q).astype(np.float32)
+        sims = np.full((len(Q), k), -np.inf, dtype=np.float32)
+        labels = np.full((len(Q), k), -1, dtype=np.int32)
+        if len(self.labels) == 0 or len(Q) == 0:
+            return sims, labels
+        if self.mode == 'exact':
+            found_sims, rows = self._search_exact(Q, k)
+        else:
+            found_sims, rows = self._search_ivfpq(Q, k)
+        n_found = found_sims.shape[1]
+        sims[:, :n_found] = found_sims
+        labels[:, :n_found] = np.where(rows >= 0, self.labels[np.maximum(rows, 0)], -1)
+        return sims, labels
+
+    def float_vectors(self):
+        """
+        Exact vectors as float32 without copying, int8 vectors dequantized
+        once and kept until the index changes.
+        """
+        if not self.int8:
+            return self.vectors.astype(np.float32, copy=False)
+        if self._dequantized is None:
+            self._dequantized = self.vectors.astype(np.float32) / 127
+        return self._dequantized
+
+    def _search_exact(self, Q, k):
+        best_sims = np.empty((len(Q), 0), dtype=np.float32)
+        best_rows = np.empty((len(Q), 0), dtype=np.int64)
+        vectors = self.float_vectors()
+        for start in range(0, len(vectors), self.block_size):
+            block = vectors[start:start + self.block_size]
+            block_sims = Q @ block.T
+            block_sims, block_rows = top_k(block_sims, k)
+            # Merge with the best so far
+            merged_sims = np.concatenate([best_sims, block_sims], axis=1)
+            merged_rows = np.concatenate([best_rows, block_rows + start], axis=1)
+            best_sims, cols = top_k(merged_sims, k)
+            best_rows = np.take_along_axis(merged_rows, cols, axis=1)
+        return best_sims, best_rows
+
+    def inverted_lists(self):
+        """
+        Return (rows, offsets): vector rows sorted by list, list i holding
+        rows[offsets[i]:offsets[i + 1]].
+        """
+        if self._inverted is None:
+            rows = np.argsort(self.lists, kind='stable')
+            offsets = np.searchsorted(self.lists[rows], np.arange(len(self.coarse) + 1))
+            self._inverted = (rows, offsets)
+        return self._inverted
+
+    def _search_ivfpq(self, Q, k):
+        n_probe = min(self.n_probe, len(self.coarse))
+        _, probes = top_k(Q @ self.coarse.T, n_probe)
+        (list_rows, offsets) = self.inverted_lists()
+        sub_dim = self.dim // self.n_subvectors
+        sub_inds = np.arange(self.n_subvectors)
+        best_sims = np.full((len(Q), k), -np.inf, dtype=np.float32)
+        best_rows = np.full((len(Q), k), -1, dtype=np.int64)
+        for (i, q) in enumerate(Q):
+            # Squared distance of q to each vector is that of its residual
+            # to the quantized residual, summed over subvectors via tables
+            rows, dists = [], []
+            for list_ind in probes[i]:
+                probe_rows = list_rows[offsets[list_ind]:offsets[list_ind + 1]]
+                if len(probe_rows) == 0:
+                    continue
+                residual = (q - self.coarse[list_ind]).reshape(self.n_subvectors, 1, sub_dim)
+                tables = ((self.codebooks - residual) ** 2).sum(axis=2)
+                rows.append(probe_rows)
+                dists.append(tables[sub_inds, self.codes[probe_rows]].sum(axis=1))
+            if not rows:
+                continue
+            rows, dists = np.concatenate(rows), np.concatenate(dists)
+            # Unit vectors: cos = 1 - |q - x|^2 / 2
+            (sims, cols) = top_k((1.0 - dists / 2.0)[None, :], k)
+            best_sims[i, :sims.shape[1]] = sims[0]
+            best_rows[i, :cols.shape[1]] = rows[cols[0]]
+        return best_sims, best_rows
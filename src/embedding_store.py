@@ -0,0 +1,187 @@
+# Memory-mapped columnar store of guest face embeddings
+
+import json
+import os
+import shutil
+
+import numpy as np
+
+fn_meta = 'meta.json'
+fn_vectors = 'vectors.bin'
+fn_labels = 'labels.bin'
+fn_deleted = 'deleted.bin'
+
+
+class EmbeddingStore:
+    def __init__(self, pn_store, dtype='float32', dim=128):
+        """
+        Face embeddings kept as columns in a directory: a contiguous
+        (count, dim) float32 or float16 matrix, an int32 label per row
+        indexing the guest id list and a tombstone byte per row. The
+        columns are memory-mapped, so reading them copies nothing.
+        Rows are appended to the column files and only become visible once
+        meta.json, which holds the row count and guest ids, is replaced, so
+        a crash mid-append leaves the previous store intact. Deletes set
+        tombstones, compact() rewrites the store without them.
+        """
+        self.pn_store = pn_store
+        self.meta = {'dtype': np.dtype(dtype).name,
+                     'dim': dim,
+                     'count': 0,
+                     'guest_ids': [],
+                     'guest_digests': {}}
+        self._mmaps = None
+        self.load()
+
+    @property
+    def count(self):
+        return self.meta['count']
+
+    @property
+    def dtype(self):
+        return np.dtype(self.meta['dtype'])
+
+    @property
+    def dim(self):
+        return self.meta['dim']
+
+    def _path(self, fn):
+        return os.path.join(self.pn_store, fn)
+
+    def load(self):
+        """
+        Read the store's metadata, an empty store is used if there is none.
+        """
+        self._mmaps = None
+        try:
+            with open(self._path(fn_meta), 'r') as f:
+                self.meta.update(json.load(f))
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            print("[ERROR] Unable to read embedding store {}:".format(self.pn_store))
+            print(e)
+        return self
+
+    def _write_meta(self):
+        os.makedirs(self.pn_store, exist_ok=True)
+        fn_tmp = self._path(fn_meta + '.tmp')
+        with open(fn_tmp, 'w') as f:
+            json.dump(self.meta, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(fn_tmp, self._path(fn_meta))
+        self._mmaps = None
+
+    def _column(self, fn, dtype, shape):
+        if shape[0] == 0:
+            return np.empty(shape, dtype=dtype)
+        return np.memmap(self._path(fn), dtype=dtype, mode='r', shape=shape)
+
+    def columns(self):
+        """
+        Return (vectors, labels, deleted) memory-mapped read only.
+        """
+        if self._mmaps is None:
+            self._mmaps = (self._column(fn_vectors, self.dtype, (self.count, self.dim)),
+                           self._column(fn_labels, np.int32, (self.count,)),
+                           self._column(fn_deleted, np.uint8, (self.count,)))
+        return self._mmaps
+
+    def arrays(self):
+        """
+        Return (vectors, guest_ids) of the live rows. Without tombstones
+        vectors is the memory map itself.
+        """
+        (vectors, labels, deleted) = self.columns()
+        guest_ids = np.array(self.meta['guest_ids'], dtype=object)
+        if deleted.any():
+            live = deleted == 0
+            vectors, labels = vectors[live], labels[live]
+        return vectors, guest_ids[labels] if len(labels) else guest_ids[:0]
+
+    def n_deleted(self):
+        return int(np.count_nonzero(self.columns()[2]))
+
+    def guest_digest(self, guest_id):
+        return self.meta['guest_digests'].get(guest_id)
+
+    def append(self, guest_ids, vectors, guest_digests=None):
+        """
+        Append rows of vectors labelled with guest_ids. guest_digests
+        records, per guest, what the rows were built from.
+        """
+        vectors = np.asarray(vectors, dtype=self.dtype).reshape(-1, self.dim)
+        if len(vectors) != len(guest_ids):
+            raise ValueError('Got {} guest ids for {} vectors'.format(
+                len(guest_ids), len(vectors)))
+        os.makedirs(self.pn_store, exist_ok=True)
+
+        id_labels = {guest_id: i for (i, guest_id) in enumerate(self.meta['guest_ids'])}
+        for guest_id in guest_ids:
+            if guest_id not in id_labels:
+                id_labels[guest_id] = len(self.meta['guest_ids'])
+                self.meta['guest_ids'].append(guest_id)
+        labels = np.array([id_labels[guest_id] for guest_id in guest_ids],
+                          dtype=np.int32)
+
+        # Rows past count are leftovers of an interrupted append
+        for (fn, data, row_bytes) in ((fn_vectors, vectors, self.dtype.itemsize * self.dim),
+                                      (fn_labels, labels, 4),
+                                      (fn_deleted, np.zeros(len(labels), dtype=np.uint8), 1)):
+            with open(self._path(fn), 'ab') as f:
+                f.truncate(self.count * row_bytes)
+                f.write(data.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+
+        self.meta['count'] += len(labels)
+        self.meta['guest_digests'].update(guest_digests or {})
+        self._write_meta()
+
+    def delete_guests(self, guest_ids):
+        """
+        Tombstone all rows of the guests, writing the metadata once and
+        only if anything changed. Returns the number of rows deleted.
+        """
+        id_labels = {guest_id: i for (i, guest_id) in enumerate(self.meta['guest_ids'])}
+        labels = [id_labels[guest_id] for guest_id in guest_ids if guest_id in id_labels]
+        n_digests = len(self.meta['guest_digests'])
+        for guest_id in guest_ids:
+            self.meta['guest_digests'].pop(guest_id, None)
+        rows = np.empty(0, dtype=np.int64)
+        if labels and self.count:
+            rows = np.flatnonzero(np.isin(self.columns()[1], labels))
+        if len(rows):
+            self._mmaps = None
+            deleted = np.memmap(self._path(fn_deleted), dtype=np.uint8,
+                                mode='r+', shape=(self.count,))
+            deleted[rows] = 1
+            deleted.flush()
+            del deleted
+        if len(rows) or len(self.meta['guest_digests']) != n_digests:
+            self._write_meta()
+        return len(rows)
+
+    def compact(self, dtype=None):
+        """
+        Rewrite the store without deleted rows or unused guest ids,
+        converting the vectors to dtype if given.
+        """
+        (vectors, guest_ids) = self.arrays()
+        pn_tmp = self.pn_store.rstrip(os.sep) + '.tmp'
+        shutil.rmtree(pn_tmp, ignore_errors=True)
+        store = EmbeddingStore(pn_tmp, dtype=dtype or self.dtype, dim=self.dim)
+        store.append(list(guest_ids), vectors,
+                     guest_digests=self.meta['guest_digests'])
+        self._mmaps = None
+
+        # Swap the directories, the old store is kept until the new one is in
+        pn_old = self.pn_store.rstrip(os.sep) + '.old'
+        shutil.rmtree(pn_old, ignore_errors=True)
+        if os.path.isdir(self.pn_store):
+            os.rename(self.pn_store, pn_old)
+        os.rename(pn_tmp, self.pn_store)
+        shutil.rmtree(pn_old, ignore_errors=True)
+        self.meta = store.meta
+        return self
@@ -1,19 +1,63 @@
 # Imports
 from ast import literal_eval as make_tuple
 import configparser
+import hashlib
 import os
 import pickle
+import time
 
 from sklearn.model_selection import GridSearchCV
 from sklearn.preprocessing import LabelEncoder
 from sklearn.svm import SVC
-import cv2
-import imutils
 import numpy as np
 
+from embed_pipeline import EmbeddingPipeline
+from embedding_cache import EmbeddingCache
+from embedding_cache import entry_key
+from embedding_store import EmbeddingStore
 from encrypt_archive import p7zip
+from gallery_pruning import prune_gallery
+from model_store import default_model_store
+from model_store import ModelStore
+from recognizers import CentroidRecognizer
+from recognizers import KNNRecognizer
 
 fn_config = 'biometric.cfg'
+unknown_guest_id = '00000000-0000-0000-0000-000000000000'
+
+
+class TrainCancelled(Exception):
+    """
+    Embedding or training was cancelled.
+    """
+
+
+def train_svc(guest_embeddings, labels):
+    """
+    Grid search a SVM over the embeddings.
+    """
+    params = {"C": [10**x for x in range(-3, 6)],
+              "gamma": [10**x for x in range(2, -6, -1)]}
+    model = GridSearchCV(SVC(kernel="rbf",
+                             gamma="auto",
+                             probability=True),
+                         params,
+                         cv=4,
+                         n_jobs=-1)
+    model.fit(guest_embeddings, labels)
+    print("[INFO] Best hyperparameters: {}".format(model.best_params_))
+    return model.best_estimator_
+
+
+def probe_sample(guest_embeddings, guest_ids, max_guests=100):
+    """
+    One embedding per guest, of at most max_guests guests spread over the
+    guest ids, to check a stored recognizer against.
+    """
+    (_, rows) = np.unique(guest_ids, return_index=True)
+    if len(rows) > max_guests:
+        rows = rows[np.linspace(0, len(rows) - 1, max_guests).astype(int)]
+    return np.asarray(guest_embeddings[np.sort(rows)], dtype=np.float64)
 
 
 class ModelTrain:
@@ -35,157 +79,294 @@ class ModelTrain:
         self.trainRBGavg = make_tuple(config['DEFAULT']['detector_trainrgbavg'])
         self.fn_embedding_model = config['DEFAULT']['fn_embedding_model']
 
+        # Embedding worker processes, 0 for one per core, and images per batch
+        self.embed_workers = int(config['DEFAULT'].get('embed_workers', '0'))
+        self.embed_batch_size = int(config['DEFAULT'].get('embed_batch_size', '8'))
+        # Embeddings are checkpointed every so many images or seconds
+        self.embed_checkpoint_images = int(config['DEFAULT'].get('embed_checkpoint_images', '500'))
+        self.embed_checkpoint_seconds = float(config['DEFAULT'].get('embed_checkpoint_seconds', '120'))
+
         # Paramerters determined from specific users trained with this system
-        self.fn_serialized_embeddings = config['DEFAULT']['fn_serialized_embeddings']
         self.fn_recognizer_model = config['DEFAULT']['fn_recognizer_model']
+        pn_guest_models = os.path.dirname(self.fn_recognizer_model)
+        # Memory-mapped store of face embeddings with guest_ids
+        self.pn_embedding_store = config['DEFAULT'].get(
+            'pn_embedding_store',
+            os.path.join(pn_guest_models, 'embedding_store'))
+        self.embedding_dtype = config['DEFAULT'].get('embedding_dtype', 'float32')
+        # Encrypted cache of detections and embeddings per archived image
+        self.fn_embedding_cache = config['DEFAULT'].get(
+            'fn_embedding_cache',
+            os.path.join(pn_guest_models, 'embedding_cache.7z'))
         self.fn_label_encoder = config['DEFAULT']['fn_label_encoder']
+        # Versioned recognizer and label encoder
+        self.pn_model_store = default_model_store(config)
+
+        # svc grid searches a SVM over all guests, centroid and knn update a
+        # cosine nearest-centroid or nearest-neighbour model with only the
+        # guests that changed
+        self.recognizer_mode = config['DEFAULT'].get('recognizer_mode', 'svc')
+        self.centroid_temperature = float(config['DEFAULT'].get('centroid_temperature', '0.05'))
+        self.centroid_radius_scale = float(config['DEFAULT'].get('centroid_radius_scale', '2.0'))
+        self.knn_k = int(config['DEFAULT'].get('knn_k', '5'))
+        self.knn_temperature = float(config['DEFAULT'].get('knn_temperature', '0.05'))
+        self.knn_min_sim = float(config['DEFAULT'].get('knn_min_sim', '0.5'))
+        self.knn_index = config['DEFAULT'].get('knn_index', 'auto')
+        self.knn_int8 = config['DEFAULT'].get('knn_int8', 'False') == 'True'
+        self.knn_n_probe = int(config['DEFAULT'].get('knn_n_probe', '8'))
 
-    def extract_embeddings(self):
+        # Training exemplars kept per guest and of the unknown class, 0 for all
+        self.max_train_per_guest = int(config['DEFAULT'].get('max_train_per_guest', '20'))
+        self.max_train_unknown = int(config['DEFAULT'].get('max_train_unknown', '500'))
+        self.unknown_strata = int(config['DEFAULT'].get('unknown_strata', '16'))
+
+    def embed_settings(self):
         """
-        Determine and embed {guest_id: embedding} in a pickle file.
-        Embeddings are drawn from a ROI determined via facial detection.
+        Settings the embedding worker processes need, kept picklable.
         """
-        # Load serialized face detector from disk
-        print("[INFO] Loading face detector...")
-        protoPath = os.path.sep.join([self.pn_detector_model,
-                                      "deploy.prototxt"])
-        modelPath = os.path.sep.join([self.pn_detector_model,
-                                      "res10_300x300_ssd_iter_140000.caffemodel"])
-        detector = cv2.dnn.readNetFromCaffe(protoPath, modelPath)
-        detector.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
-
-        # Load serialized face embedding model, set the
-        # preferable target to CPU for raspberry Pi
-        print("[INFO] Loading face recognizer...")
-        embedder = cv2.dnn.readNetFromTorch(self.fn_embedding_model)
-        embedder.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+        return {'pn_detector_model': self.pn_detector_model,
+                'fn_embedding_model': self.fn_embedding_model,
+                'trainRBGavg': self.trainRBGavg,
+                'detector_size': int(self.image_width/2),
+                'min_detec_conf': self.min_detec_conf,
+                'min_face_px': self.min_face_px,
+                'resize_width': 600}
 
+    def extract_embeddings(self, progress=None, cancel=None):
+        """
+        Determine and embed {guest_id: embedding} in the embedding store.
+        Embeddings are drawn from a ROI determined via facial detection.
+        Only images not yet in the embedding cache are detected and
+        embedded, cache entries of removed images are dropped.
+        progress(n_done, n_images) is called as images are embedded, and
+        TrainCancelled is raised once the cancel event is set; images
+        embedded until then are kept in the cache. New embeddings are
+        checkpointed periodically, so an interrupted run resumes where its
+        last checkpoint left off.
+        """
         # Determine image paths to the input images
         print("[INFO] Quantifying faces...")
         image_paths = self.guest_archive.list_files()
         image_ext = ['.jpg', '.jpeg', '.png']
         image_paths = [x for x in image_paths if
                        any([ext in x for ext in image_ext])]
-        # Init extracted facial embeddings and
-        # corresponding guest_ids
-        guest_embeddings = []
-        guest_ids = []
+        image_keys = {path: entry_key(*self.guest_archive.entry_info(path))
+                      for path in image_paths}
 
-        # Total processed faces
-        total_proc_faces = 0
+        cache = EmbeddingCache(self.guest_archive,
+                               self.fn_embedding_cache,
+                               self.embed_settings())
+        cache.load()
+        n_dropped = cache.retain(image_keys.values())
+        new_paths = [path for path in image_paths
+                     if image_keys[path] not in cache]
+        print("[INFO] {} cached images, {} to embed, {} removed from cache."
+              .format(len(image_paths) - len(new_paths), len(new_paths), n_dropped))
 
         # Resize, detect largest face, and embed the largest
-        # face in each image.
-        for (i, image_path) in enumerate(image_paths):
-            print("[INFO] Processing image {}/{}".format(i + 1,
-                                                         len(image_paths)))
-            guest_id = os.path.dirname(image_path)
-            image = self.guest_archive.read_image(image_path)
-            try:
-                image = imutils.resize(image, width=600)
-            except Exception as e:
-                print("Error in {}:".format(image_path))
-                print(e)
-                print("Skipping...")
-                continue
-            (image_height, image_width) = image.shape[:2]
-
-            # Create OpenCV image blob
-            image_blob = cv2.dnn.blobFromImage(cv2.resize(image,
-                                                          (int(self.image_width/2),
-                                                           int(self.image_width/2))),
-                                               1.0,
-                                               (int(self.image_width/2), int(self.image_width/2)),
-                                               self.trainRBGavg,
-                                               swapRB=False,
-                                               crop=False)
-
-            # Use previously loaded face detector on the blob
-            detector.setInput(image_blob)
-            detections = detector.forward()
-
-            # If at least one face
-            if len(detections) > 0:
-                # Assume one face per image;
-                # use bounding box with largest confidence
-                max_conf_ind = np.argmax(detections[0, 0, :, 2])
-                confidence = detections[0, 0, max_conf_ind, 2]
-
-                # Threshold confidence via configuration file
-                if confidence > self.min_detec_conf:
-                    # Return bounding box (x, y)-coordinates
-                    bound_box = detections[0, 0, max_conf_ind, 3:7] * np.array([image_width,
-                                                                                image_height,
-                                                                                image_width,
-                                                                                image_height])
-                    (x_start, y_start, x_end, y_end) = bound_box.astype("int")
-
-                    # Return face region of interest dimensions
-                    face = image[y_start: y_end, x_start: x_end]
-
-                    # Skip faces below a min size
-                    (face_height, face_width) = face.shape[:2]
-                    if face_height < self.min_face_px[0] \
-                       or face_width < self.min_face_px[1]:
-                        continue
-
-                    # Create OpenCV blob for face ROI
-                    face_blob = cv2.dnn.blobFromImage(face,
-                                                      1.0 / 255,
-                                                      (96, 96),
-                                                      (0, 0, 0),
-                                                      swapRB=True,
-                                                      crop=False)
-                    # Pass face blob into embedder,
-                    # return 128-D describing vector
-                    embedder.setInput(face_blob)
-                    face_vec = embedder.forward()
-
-                    # Append guest_id and embedding
-                    guest_ids.append(guest_id)
-                    guest_embeddings.append(face_vec.flatten())
-                    total_proc_faces += 1
-
-        # Save embedding and guest_id to disk
-        print("[INFO] Serializing {} encodings...".format(total_proc_faces))
-        os.makedirs(os.path.dirname(self.fn_serialized_embeddings),
-                    exist_ok=True)
-        data = {"guest_embeddings": guest_embeddings, "guest_ids": guest_ids}
-        with open(self.fn_serialized_embeddings, "wb") as f:
-            f.write(pickle.dumps(data))
-
-    def train_model(self):
-        """
-        Train a SVM to classify faces based on their enodings, output a label
+        # face in each new image.
+        # Images are streamed out of the archive in one pass and
+        # embedded in batches by a pool of worker processes
+        uncached = {}  # Results of entries without a CRC to key them by
+        if new_paths:
+            print("[INFO] Embedding with {} worker(s)...".format(self.embed_workers or os.cpu_count()))
+            pipeline = EmbeddingPipeline(self.embed_settings(),
+                                         n_workers=self.embed_workers,
+                                         batch_size=self.embed_batch_size)
+            image_iter = self.guest_archive.iter_images(new_paths)
+            results = pipeline.run(image_iter, len(new_paths), progress=progress)
+            n_since_checkpoint = 0
+            checkpoint_time = time.monotonic()
+            for (image_path, box, conf, face_vec) in results:
+                if image_keys[image_path] is None:
+                    uncached[image_path] = (box, conf, face_vec)
+                cache.add(image_keys[image_path], box, conf, face_vec)
+                n_since_checkpoint += 1
+                if (n_since_checkpoint >= self.embed_checkpoint_images
+                        or time.monotonic() - checkpoint_time >= self.embed_checkpoint_seconds):
+                    if cache.checkpoint():
+                        print("[INFO] Checkpointed {} embedded images.".format(n_since_checkpoint))
+                    n_since_checkpoint = 0
+                    checkpoint_time = time.monotonic()
+                if cancel is not None and cancel.is_set():
+                    results.close()  # Stops the workers
+                    cache.save()
+                    raise TrainCancelled()
+        if new_paths or n_dropped or cache.pending or cache.fns_part:
+            cache.save()
+
+        # Group extracted facial embeddings by guest_id, with a digest of
+        # the images they came from to find guests that changed
+        guest_rows = {}
+        guest_hashes = {}
+        for path in image_paths:
+            guest_id = os.path.dirname(path)
+            guest_hashes.setdefault(guest_id, hashlib.sha1()).update(
+                (image_keys[path] or path).encode('utf-8') + b'\n')
+            rows = guest_rows.setdefault(guest_id, [])
+            result = cache.get(image_keys[path]) or uncached.get(path)
+            if result is not None and result[2] is not None:
+                rows.append(result[2])
+        guest_digests = {guest_id: guest_hash.hexdigest()
+                         for (guest_id, guest_hash) in guest_hashes.items()}
+        self.update_embedding_store(guest_rows, guest_digests)
+
+    def update_embedding_store(self, guest_rows, guest_digests):
+        """
+        Bring the embedding store in line with {guest_id: [embedding]},
+        replacing only guests whose digest changed and tombstoning removed
+        guests.
+        """
+        store = EmbeddingStore(self.pn_embedding_store, dtype=self.embedding_dtype)
+        if store.dtype != np.dtype(self.embedding_dtype):
+            store.compact(dtype=self.embedding_dtype)
+
+        removed = [guest_id for guest_id in store.meta['guest_digests']
+                   if guest_id not in guest_rows]
+        changed = [guest_id for guest_id in guest_rows
+                   if store.guest_digest(guest_id) != guest_digests[guest_id]]
+        n_deleted = store.delete_guests(removed + changed)
+
+        guest_ids = [guest_id for guest_id in changed
+                     for _ in guest_rows[guest_id]]
+        vectors = [vec for guest_id in changed for vec in guest_rows[guest_id]]
+        print("[INFO] Storing {} encodings of {} changed guests, {} removed..."
+              .format(len(vectors), len(changed), n_deleted))
+        if changed:
+            store.append(guest_ids, vectors,
+                         guest_digests={guest_id: guest_digests[guest_id]
+                                        for guest_id in changed})
+
+        # Reclaim space once most rows are tombstones
+        if store.n_deleted() > store.count / 2:
+            store.compact()
+        print("[INFO] Embedding store holds {} encodings.".format(
+            store.count - store.n_deleted()))
+
+    def new_recognizer(self):
+        """
+        Untrained incremental recognizer for recognizer_mode.
+        """
+        if self.recognizer_mode == 'knn':
+            return KNNRecognizer(k=self.knn_k,
+                                 temperature=self.knn_temperature,
+                                 min_sim=self.knn_min_sim,
+                                 index_mode=self.knn_index,
+                                 int8=self.knn_int8,
+                                 n_probe=self.knn_n_probe)
+        return CentroidRecognizer(temperature=self.centroid_temperature,
+                                  radius_scale=self.centroid_radius_scale)
+
+    def train_incremental(self, store):
+        """
+        Update the previous centroid or knn recognizer, if any, with only
+        the guests whose embeddings changed since it was trained.
+        """
+        model_store = ModelStore(self.pn_model_store)
+        model_store.import_pickles(self.fn_recognizer_model, self.fn_label_encoder)
+        try:
+            (recognizer, _) = model_store.load()
+        except (OSError, ValueError, KeyError, AttributeError, ImportError,
+                EOFError, pickle.UnpicklingError) as e:
+            print("[ERROR] Unable to load the previous model, training from scratch:")
+            print(e)
+            recognizer = None
+        new_recognizer = self.new_recognizer()
+        if type(recognizer) is not type(new_recognizer) \
+           or getattr(recognizer, 'int8', None) != getattr(new_recognizer, 'int8', None) \
+           or getattr(recognizer, 'index_mode', None) != getattr(new_recognizer, 'index_mode', None):
+            recognizer = new_recognizer
+        else:
+            # Settings only used at prediction can change in place
+            for attr in ('temperature', 'radius_scale', 'k', 'min_sim', 'n_probe'):
+                if hasattr(new_recognizer, attr):
+                    setattr(recognizer, attr, getattr(new_recognizer, attr))
+            if getattr(recognizer, 'index', None) is not None:
+                recognizer.index.n_probe = self.knn_n_probe
+
+        digests = store.meta['guest_digests']
+        removed = [guest_id for guest_id in recognizer.digests_
+                   if guest_id not in digests]
+        changed = [guest_id for guest_id in digests
+                   if recognizer.digests_.get(guest_id) != digests[guest_id]]
+        print("[INFO] Updating {} changed and removing {} guests...".format(
+            len(changed), len(removed)))
+        recognizer.remove(removed + changed)
+
+        (guest_embeddings, guest_ids) = store.arrays()
+        changed_rows = np.isin(guest_ids, np.array(changed, dtype=object))
+        (guest_embeddings, guest_ids) = (guest_embeddings[changed_rows],
+                                         guest_ids[changed_rows])
+        if isinstance(recognizer, KNNRecognizer):
+            (guest_embeddings, guest_ids) = self.prune(guest_embeddings, guest_ids)
+        recognizer.partial_fit(guest_embeddings, guest_ids)
+        recognizer.digests_.update({guest_id: digests[guest_id] for guest_id in changed})
+        return recognizer
+
+    def prune(self, guest_embeddings, guest_ids):
+        """
+        Keep at most max_train_per_guest diverse embeddings per guest and
+        max_train_unknown of the unknown class.
+        """
+        keep = prune_gallery(guest_embeddings,
+                             guest_ids,
+                             self.max_train_per_guest,
+                             max_unknown=self.max_train_unknown,
+                             unknown_id=unknown_guest_id,
+                             n_strata=self.unknown_strata)
+        if len(keep) < len(guest_ids):
+            print("[INFO] Pruned {} embeddings to {} diverse exemplars.".format(
+                len(guest_ids), len(keep)))
+        return guest_embeddings[keep], guest_ids[keep]
+
+    def train_model(self, cancel=None):
+        """
+        Train a SVM, or update a nearest-centroid or k nearest neighbour
+        model, to classify faces based on their enodings, output a label
         encoder model.
+        Models are published as a new version of the model store, unless
+        the cancel event is set during training. Returns the version.
         """
-        # Load prev embedded faces
+        start_time = time.monotonic()
+        # Load prev embedded faces, memory-mapped
         print("[INFO] Loading face embeddings...")
-        data = pickle.loads(open(self.fn_serialized_embeddings, "rb").read())
-
-        # Encode the labels per guest_id
-        print("[INFO] Encoding labels...")
-        label_encoder = LabelEncoder()
-        labels = label_encoder.fit_transform(data["guest_ids"])
+        store = EmbeddingStore(self.pn_embedding_store)
 
         # Train on the 128-d embeddings of the faces
         # to produce actual face recognition
-        print("[INFO] Training model...")
-        params = {"C": [10**x for x in range(-3, 6)],
-                  "gamma": [10**x for x in range(2, -6, -1)]}
-        model = GridSearchCV(SVC(kernel="rbf",
-                                 gamma="auto",
-                                 probability=True),
-                             params,
-                             cv=4,
-                             n_jobs=-1)
-        model.fit(data["guest_embeddings"], labels)
-        print("[INFO] Best hyperparameters: {}".format(model.best_params_))
-
-        # Save face recognition model to disk
-        with open(self.fn_recognizer_model, "wb") as f:
-            f.write(pickle.dumps(model.best_estimator_))
-
-        # Save the label encoder to disk
-        with open(self.fn_label_encoder, "wb") as f:
-            f.write(pickle.dumps(label_encoder))
+        print("[INFO] Training {} model...".format(self.recognizer_mode))
+        label_encoder = LabelEncoder()
+        if self.recognizer_mode in ('centroid', 'knn'):
+            recognizer = self.train_incremental(store)
+            # Recognizer classes are the sorted guest ids, as encoded
+            label_encoder.fit(recognizer.classes_)
+        else:
+            (guest_embeddings, guest_ids) = store.arrays()
+            n_embeddings = len(guest_ids)
+            (guest_embeddings, guest_ids) = self.prune(guest_embeddings, guest_ids)
+            # Encode the labels per guest_id
+            print("[INFO] Encoding labels...")
+            labels = label_encoder.fit_transform(guest_ids)
+            fit_start = time.monotonic()
+            recognizer = train_svc(guest_embeddings, labels)
+            if 0 < len(guest_ids) < n_embeddings:
+                # SVM training scales roughly with the square of the samples
+                fit_seconds = time.monotonic() - fit_start
+                print("[INFO] Trained in {:.1f}s, pruning saved an estimated {:.1f}s."
+                      .format(fit_seconds,
+                              fit_seconds * ((n_embeddings / len(guest_ids)) ** 2 - 1)))
+
+        if cancel is not None and cancel.is_set():
+            raise TrainCancelled()
+
+        # Save face recognition model and label encoder to disk, checking
+        # the stored recognizer on an embedding of each of a sample of guests
+        (guest_embeddings, guest_ids) = store.arrays()
+        version = ModelStore(self.pn_model_store).publish(
+            recognizer,
+            label_encoder,
+            len(label_encoder.classes_),
+            train_seconds=round(time.monotonic() - start_time, 3),
+            probe=probe_sample(guest_embeddings, guest_ids))
+        print("[INFO] Published model version {}.".format(version))
+        return version
@@ -3,35 +3,267 @@
 from subprocess import TimeoutExpired
 import subprocess
 import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import zlib
 
 from PIL import Image
 from PIL import UnidentifiedImageError
 import numpy as np
 
+image_ext = ['.jpg', '.jpeg', '.png']
+
+
+def encode_png(image_array):
+    """
+    Encode an OpenCV compatible numpy array image as PNG bytes.
+    """
+    image = Image.fromarray(image_array)
+    image_byte = io.BytesIO()
+    image.save(image_byte, format='PNG')
+    return image_byte.getvalue()
+
+
+def parse_slt(stdout):
+    """
+    Parse the technical listing of 7z l -slt into [(path, size, crc)]
+    for files, in archive order.
+    """
+    lines = stdout.decode('utf-8', errors='replace').splitlines()
+    if '----------' not in lines:
+        return []
+    entries = []
+    block = {}
+    for line in lines[lines.index('----------') + 1:] + ['']:
+        if ' = ' in line:
+            key, value = line.split(' = ', 1)
+            block[key] = value
+        elif line.strip() == '' and block:
+            is_dir = (block.get('Folder') == '+'
+                      or block.get('Attributes', '').startswith('D'))
+            if 'Path' in block and not is_dir:
+                entries.append((block['Path'],
+                                int(block.get('Size') or 0),
+                                block.get('CRC', '').upper()))
+            block = {}
+    return entries
+
+
+def decode_image(data):
+    """
+    Decode image bytes into a numpy array compatible with OpenCV, or None.
+    """
+    try:
+        image = Image.open(io.BytesIO(data))
+    except UnidentifiedImageError:
+        return None
+    return np.array(image)
+
+
+def crc_hex(data):
+    """
+    CRC32 of bytes formatted as in 7z listings.
+    """
+    return '{:08X}'.format(zlib.crc32(data) & 0xffffffff)
+
 
 class p7zip:
     def __init__(self, fn_archive):
         self.fn_archive = fn_archive
         self.pw = None
         self.zipfile = None
+        self.fn_index = fn_archive + '.index'
+        self.index = None  # {path: (size, crc)} in archive order
+        self.guest_index = None  # {guest_id: [path]}
+        self.index_key = None  # Archive (mtime, size) the index describes
+        self.index_ordered = False  # Index order matches the archive
+        self.lock = threading.RLock()
 
-    def list_files(self):
+    def archive_key(self):
+        """
+        Return the archive's (mtime, size), or None if it doesn't exist.
+        """
+        try:
+            stat = os.stat(self.fn_archive)
+        except OSError:
+            return None
+        return [stat.st_mtime_ns, stat.st_size]
+
+    def write_bytes(self, fn_blob, name, data):
+        """
+        Atomically write data as the single entry name of an encrypted
+        7z file, with encrypted headers. Requires 7z.
+        """
+        # 7z creates the file itself, so it goes in a directory of its own
+        # as other processes may write the same blob concurrently
+        pn_tmp = tempfile.mkdtemp(dir=os.path.dirname(fn_blob) or '.',
+                                  prefix=os.path.basename(fn_blob) + '.',
+                                  suffix='.tmp')
+        fn_tmp = os.path.join(pn_tmp, os.path.basename(fn_blob))
+        try:
+            cmd_lst = ['7z', 'a', '-t7z']
+            if self.pw:
+                cmd_lst += ['-mhe=on', '-p' + self.pw]
+            cmd_lst += ['-si' + name, fn_tmp]
+            out = subprocess.run(cmd_lst,
+                                 input=data,
+                                 capture_output=True)
+            if b'Everything is Ok' not in out.stdout:
+                print("[ERROR] Unable to write {}.".format(fn_blob))
+                return False
+            # Make sure the data is on disk before it replaces the old file
+            with open(fn_tmp, 'rb') as f:
+                os.fsync(f.fileno())
+            os.replace(fn_tmp, fn_blob)
+            return True
+        finally:
+            shutil.rmtree(pn_tmp, ignore_errors=True)
+
+    def read_bytes(self, fn_blob, name):
         """
-        List contents of an archive.
-        Parses 7zip output.
+        Read entry name of an encrypted 7z file written by write_bytes.
+        Returns None if it is missing or can't be decrypted.
         """
-        cmd_lst = ['7z', 'l']
+        if not os.path.isfile(fn_blob):
+            return None
+        cmd_lst = ['7z', 'x']
         if self.pw:
             cmd_lst += ['-p' + self.pw]
-        cmd_lst += [self.fn_archive]
-        out = subprocess.run(cmd_lst,
-                             capture_output=True)
-        srch_str = b'------------------- ----- ------------ ------------  ------------------------'
-        start_ind = out.stdout.splitlines().index(srch_str) + 1
-        end_ind = out.stdout.splitlines()[start_ind+1:].index(srch_str) + 1
-        file_lines = out.stdout.splitlines()[start_ind:start_ind+end_ind]
-        files = [x.split()[-1].decode('utf-8') for x in file_lines]
-        return files
+        cmd_lst += [fn_blob, '-so', name]
+        try:
+            out = subprocess.run(cmd_lst,
+                                 timeout=60,
+                                 stdin=subprocess.DEVNULL,
+                                 capture_output=True)
+        except TimeoutExpired:
+            return None
+        if out.returncode != 0:
+            return None
+        return out.stdout
+
+    def _set_index(self, entries, key, ordered):
+        self.index = {path: (size, crc) for (path, size, crc) in entries}
+        self.guest_index = {}
+        for path in self.index:
+            self.guest_index.setdefault(os.path.dirname(path), []).append(path)
+        self.index_key = key
+        self.index_ordered = ordered
+
+    def _save_index(self):
+        data = {'archive_key': self.index_key,
+                'ordered': self.index_ordered,
+                'entries': [[path, size, crc] for (path, (size, crc))
+                            in self.index.items()]}
+        self.write_bytes(self.fn_index, 'index.json',
+                         json.dumps(data).encode('utf-8'))
+
+    def rebuild_index(self):
+        """
+        Rebuild the archive index from 7z's technical listing.
+        """
+        with self.lock:
+            key = self.archive_key()
+            entries = []
+            if key is not None:
+                cmd_lst = ['7z', 'l', '-slt']
+                if self.pw:
+                    cmd_lst += ['-p' + self.pw]
+                cmd_lst += [self.fn_archive]
+                out = subprocess.run(cmd_lst,
+                                     capture_output=True)
+                if out.returncode != 0:
+                    # Likely a wrong password, don't keep or save an empty
+                    # index so it is listed again next time
+                    print("[ERROR] Unable to list {}. Is the correct archive "
+                          "password set?".format(self.fn_archive))
+                    self._set_index([], None, True)
+                    return
+                entries = parse_slt(out.stdout)
+            self._set_index(entries, key, True)
+            if key is not None:
+                self._save_index()
+
+    def load_index(self):
+        """
+        Make sure the in-memory index describes the archive on disk, reading
+        the encrypted sidecar index and rebuilding it only when stale.
+        """
+        with self.lock:
+            key = self.archive_key()
+            if self.index is not None and self.index_key == key:
+                return
+            if key is None:
+                self._set_index([], None, True)
+                return
+
+            data = self.read_bytes(self.fn_index, 'index.json')
+            if data:
+                try:
+                    data = json.loads(data.decode('utf-8'))
+                except ValueError:
+                    data = None
+            if data and data['archive_key'] == key:
+                self._set_index(data['entries'], key, data['ordered'])
+            else:
+                print("[INFO] Indexing {}...".format(self.fn_archive))
+                self.rebuild_index()
+
+    def _update_index(self, stdout, added=(), removed=()):
+        """
+        Update the index in place after the archive was changed, or drop it
+        to be rebuilt if 7z reported a problem.
+        added is [(path, size, crc)], removed is folder names.
+        """
+        with self.lock:
+            if self.index is None:
+                return
+            if b'Everything is Ok' not in stdout:
+                self.index = None
+                return
+            entries = [(path, size, crc) for (path, (size, crc)) in self.index.items()
+                       if not any(path == pn or path.startswith(pn + '/')
+                                  for pn in removed)]
+            added_paths = {path for (path, _, _) in added}
+            entries = [entry for entry in entries if entry[0] not in added_paths]
+            self._set_index(entries + list(added),
+                            self.archive_key(),
+                            self.index_ordered and not added)
+            self._save_index()
+
+    def list_files(self):
+        """
+        List contents of an archive from its index.
+        """
+        with self.lock:
+            self.load_index()
+            return list(self.index)
+
+    def guest_ids(self):
+        """
+        List top level folders (guest ids) with files in the archive.
+        """
+        with self.lock:
+            self.load_index()
+            return [guest_id for guest_id in self.guest_index if guest_id != '']
+
+    def guest_files(self, guest_id):
+        """
+        List files within a guest's folder.
+        """
+        with self.lock:
+            self.load_index()
+            return list(self.guest_index.get(guest_id, []))
+
+    def entry_info(self, path):
+        """
+        Return (size, crc) for a file in the archive, or None.
+        """
+        with self.lock:
+            self.load_index()
+            return self.index.get(path)
 
     def read_image(self, pn_img):
         """
@@ -51,14 +283,65 @@ class p7zip:
             print("[ERROR] Archive read timeout met. Is a password set?")
             return None
 
-        try:
-            image = Image.open(io.BytesIO(out.stdout))
-        except UnidentifiedImageError:
+        image = decode_image(out.stdout)
+        if image is None:
             print("[ERROR] Can't read image from archive. "
                   "Is the correct archive password set?")
-            return None
+        return image
+
+    def iter_images(self, paths=None, max_path_args=500):
+        """
+        Stream images out of the archive in a single decompression pass,
+        yielding (path, image) in archive order; image is None if it can't
+        be decoded. paths limits the images read, by default all images are.
+        Entries are split out of 7z's stdout by the sizes in the index and
+        checked against their CRCs, so decrypted bytes stay in memory.
+        Small selections are passed to 7z so only their blocks are read.
+        """
+        with self.lock:
+            self.load_index()
+            if not self.index_ordered:  # Appends may not be in archive order
+                self.rebuild_index()
+            entries = list(self.index.items())
+
+        wanted = None if paths is None else set(paths)
+        if wanted is not None and not wanted:
+            return
+        cmd_lst = ['7z', 'x']
+        if self.pw:
+            cmd_lst += ['-p' + self.pw]
+        cmd_lst += [self.fn_archive, '-so']
+        if wanted is not None and len(wanted) <= max_path_args:
+            entries = [entry for entry in entries if entry[0] in wanted]
+            cmd_lst += [path for (path, _) in entries]
 
-        return np.array(image)
+        proc = subprocess.Popen(cmd_lst,
+                                stdin=subprocess.DEVNULL,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL)
+        try:
+            for (path, (size, crc)) in entries:
+                data = proc.stdout.read(size)
+                if len(data) < size:
+                    print("[ERROR] Archive stream ended early at {}. "
+                          "Is the correct archive password set?".format(path))
+                    break
+                if crc and crc_hex(data) != crc:
+                    print("[ERROR] Archive stream out of sync with the index "
+                          "at {}, the index will be rebuilt.".format(path))
+                    with self.lock:
+                        self.index = None
+                    break
+                if wanted is not None and path not in wanted:
+                    continue
+                if os.path.splitext(path)[1].lower() not in image_ext:
+                    continue
+                yield path, decode_image(data)
+        finally:
+            proc.stdout.close()
+            if proc.poll() is None:
+                proc.kill()
+            proc.wait()
 
     def add_image(self, path, image_array):
         """
@@ -68,35 +351,57 @@ class p7zip:
         only for xz, lzma, tar, gzip and bzip2 archives.
         tar, xz, gzip, bzip2, lzma don't directly support compression.
         """
-        image = Image.fromarray(image_array)
-        image_byte = io.BytesIO()
-        image.save(image_byte, format='PNG')
-        image_byte = image_byte.getvalue()
+        image_byte = encode_png(image_array)
 
         cmd_lst = ['7z', 'a']
         if self.pw:
             cmd_lst += ['-p' + self.pw]
         cmd_lst += ['-si'+path, self.fn_archive]
 
-        out = subprocess.run(cmd_lst,
-                             input=image_byte,
-                             capture_output=True)
+        with self.lock:
+            self.load_index()
+            out = subprocess.run(cmd_lst,
+                                 input=image_byte,
+                                 capture_output=True)
+            self._update_index(out.stdout,
+                               added=[(path, len(image_byte), crc_hex(image_byte))])
         return out.stdout, out.stderr
 
-    def add_file(self, fn_file):
+    def add_file(self, fn_file, cwd=None):
         """
         Add a file to an encrypted archive.
+        Paths are stored relative to cwd, if given.
         Requries 7z.
         """
         if not isinstance(fn_file, list):
             fn_file = [fn_file]
 
-        cmd_lst = ['7z', 'a', self.fn_archive]
+        cmd_lst = ['7z', 'a', os.path.abspath(self.fn_archive)]
         if self.pw:
             cmd_lst += ['-p' + self.pw]
         cmd_lst += fn_file
-        out = subprocess.run(cmd_lst,
-                             capture_output=True)
+
+        # Paths and checksums as 7z will store them, for the index
+        added = []
+        for fn in fn_file:
+            fn_abs = os.path.join(cwd or '', fn)
+            if os.path.isdir(fn_abs):
+                fns_sub = [os.path.join(pn, x) for (pn, _, xs) in os.walk(fn_abs)
+                           for x in xs]
+            else:
+                fns_sub = [fn_abs]
+            for fn_sub in fns_sub:
+                with open(fn_sub, 'rb') as f:
+                    data = f.read()
+                path = os.path.normpath(os.path.relpath(fn_sub, cwd or os.curdir))
+                added.append((path.replace(os.sep, '/'), len(data), crc_hex(data)))
+
+        with self.lock:
+            self.load_index()
+            out = subprocess.run(cmd_lst,
+                                 cwd=cwd,
+                                 capture_output=True)
+            self._update_index(out.stdout, added=added)
         return out.stdout, out.stderr
 
     def remove_folder(self, pn_folder):
@@ -111,6 +416,9 @@ class p7zip:
         if self.pw:
             cmd_lst += ['-p' + self.pw]
         cmd_lst += ['-r'] + pn_folder
-        out = subprocess.run(cmd_lst,
-                             capture_output=True)
+        with self.lock:
+            self.load_index()
+            out = subprocess.run(cmd_lst,
+                                 capture_output=True)
+            self._update_index(out.stdout, removed=pn_folder)
         return out.stdout, out.stderr
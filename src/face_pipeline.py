@@ -0,0 +1,162 @@
+# Face detection and embedding helpers shared by camera and training code
+
+import os
+
+import cv2
+import numpy as np
+
+from model_store import ModelStore
+
+
+def load_detector(pn_detector_model):
+    """
+    Load the pretrained OpenCV caffe face detector.
+    """
+    protoPath = os.path.sep.join([pn_detector_model, "deploy.prototxt"])
+    modelPath = os.path.sep.join([pn_detector_model,
+                                  "res10_300x300_ssd_iter_140000.caffemodel"])
+    detector = cv2.dnn.readNetFromCaffe(protoPath, modelPath)
+    detector.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+    return detector
+
+
+def load_embedder(fn_embedding_model):
+    """
+    Load the pretrained OpenFace Torch embedding model, set the
+    preferable target to CPU for raspberry Pi.
+    """
+    embedder = cv2.dnn.readNetFromTorch(fn_embedding_model)
+    embedder.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+    return embedder
+
+
+def detector_blob(pic, trainRBGavg, size=300):
+    """
+    Create the OpenCV image blob the face detector expects.
+    """
+    return cv2.dnn.blobFromImage(cv2.resize(pic, (size, size)),
+                                 1.0,
+                                 (size, size),
+                                 trainRBGavg,
+                                 swapRB=False,
+                                 crop=False)
+
+
+def filter_detections(detections, pic_width, pic_height, min_detec_conf,
+                      max_x=None, max_y=None, min_face_px=None):
+    """
+    Threshold SSD detections and scale them to bounding boxes with NumPy
+    masks rather than a loop over all detection slots.
+    Boxes must start inside the frame and, if given, end before
+    (max_x, max_y) and be at least min_face_px (height, width).
+    Returns (boxes, confs), boxes being integer rows of
+    (x_start, y_start, x_end, y_end).
+    """
+    curr_dets = detections[0, 0]
+    curr_dets = curr_dets[curr_dets[:, 2] > min_detec_conf]
+    bound_boxes = (curr_dets[:, 3:7]
+                   * np.array([pic_width, pic_height, pic_width, pic_height])
+                   ).astype("int")
+
+    # Only detect faces fully in the frame
+    keep = (bound_boxes[:, 0] >= 0) & (bound_boxes[:, 1] >= 0)
+    if max_x is not None:
+        keep &= bound_boxes[:, 2] <= max_x
+    if max_y is not None:
+        keep &= bound_boxes[:, 3] <= max_y
+
+    # Skip faces below a min size, measured on the region actually cropped
+    if min_face_px is not None:
+        face_height = np.minimum(bound_boxes[:, 3], pic_height) - bound_boxes[:, 1]
+        face_width = np.minimum(bound_boxes[:, 2], pic_width) - bound_boxes[:, 0]
+        keep &= (face_height >= min_face_px[0]) & (face_width >= min_face_px[1])
+    return bound_boxes[keep], curr_dets[keep, 2]
+
+
+def detect_faces(detector, pic, trainRBGavg, min_detec_conf,
+                 max_x=None, max_y=None, min_face_px=None, blob=None):
+    """
+    Run the face detector on a picture. blob is an optional callable
+    returning a reusable detector blob, e.g. preprocess.DetectorBlob.
+    Returns (boxes, confs, face_present), face_present being whether any
+    detection passed min_detec_conf, wherever it is in the frame.
+    """
+    (pic_height, pic_width) = pic.shape[:2]
+    if blob is not None:
+        detector.setInput(blob(pic))
+    else:
+        detector.setInput(detector_blob(pic, trainRBGavg))
+    detections = detector.forward()
+    bound_boxes, confs = filter_detections(detections,
+                                           pic_width,
+                                           pic_height,
+                                           min_detec_conf,
+                                           max_x=max_x,
+                                           max_y=max_y,
+                                           min_face_px=min_face_px)
+    face_present = bool(np.any(detections[0, 0, :, 2] > min_detec_conf))
+    return bound_boxes, confs, face_present
+
+
+def warm_up(detector, embedder, trainRBGavg, image_width):
+    """
+    Run the detector and embedder once on a blank frame, as the first
+    forward passes are much slower than later ones.
+    """
+    pic = np.zeros((image_width, image_width, 3), dtype=np.uint8)
+    detect_faces(detector, pic, trainRBGavg, 1.0)
+    embed_crops(embedder, [pic[:96, :96]])
+
+
+def embed_faces(embedder, pic, bound_boxes):
+    """
+    Stack all face regions of interest into one OpenCV blob and embed them
+    in a single forward pass.
+    Returns an (n_faces, 128) array of describing vectors.
+    """
+    faces = [pic[y_start:y_end, x_start:x_end]
+             for (x_start, y_start, x_end, y_end) in bound_boxes]
+    return embed_crops(embedder, faces)
+
+
+def embed_crops(embedder, faces):
+    """
+    Embed face regions of interest, possibly from different images, in a
+    single forward pass.
+    Returns an (n_faces, 128) array of describing vectors.
+    """
+    if len(faces) == 0:
+        return np.empty((0, 128), dtype=np.float32)
+
+    faces = [cv2.resize(face, (96, 96)) for face in faces]
+    face_blob = cv2.dnn.blobFromImages(faces,
+                                       1.0 / 255,
+                                       (96, 96),
+                                       (0, 0, 0),
+                                       swapRB=True,
+                                       crop=False)
+    embedder.setInput(face_blob)
+    return embedder.forward()
+
+
+def predict_guests(recognizer, label_encoder, face_vecs):
+    """
+    Classify a batch of face embeddings with one predict_proba call.
+    Returns (guest_ids, probs) with one entry per face.
+    """
+    if len(face_vecs) == 0:
+        return np.empty(0, dtype=object), np.empty(0)
+
+    preds = recognizer.predict_proba(face_vecs)
+    max_pred_inds = np.argmax(preds, axis=1)
+    probs = preds[np.arange(len(preds)), max_pred_inds]
+    guest_ids = label_encoder.classes_[max_pred_inds]
+    return guest_ids, probs
+
+
+def load_recognition_models(pn_model_store, version=None):
+    """
+    Load the guest specific face recognizer and label encoder from the
+    model store, the latest version by default.
+    """
+    return ModelStore(pn_model_store).load(version)
@@ -0,0 +1,356 @@
+# Frame sources, a threaded frame grabber and a frame recorder
+
+from collections import deque
+import math
+import os
+import queue
+import struct
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from metrics import metrics
+
+image_ext = ['.jpg', '.jpeg', '.png', '.bmp']
+recording_ext = '.frames'
+recording_magic = b'BIOMFRM1'
+# Per frame: capture timestamp (time.time()), PNG size
+record_header = struct.Struct('<dI')
+
+
+class ImageDirSource:
+    """
+    Read a directory of images as if it were a video stream.
+    Mirrors the parts of the cv2.VideoCapture interface that are used here.
+    """
+    def __init__(self, pn_images, loop=False):
+        self.fns_image = sorted(os.path.join(pn_images, fn) for fn
+                                in os.listdir(pn_images)
+                                if os.path.splitext(fn)[1].lower() in image_ext)
+        self.loop = loop
+        self.ind = 0
+
+    def isOpened(self):
+        return len(self.fns_image) > 0
+
+    def read(self):
+        if self.ind >= len(self.fns_image):
+            if not self.loop or not self.fns_image:
+                return False, None
+            self.ind = 0
+        image = cv2.imread(self.fns_image[self.ind])
+        self.ind += 1
+        return image is not None, image
+
+    def release(self):
+        self.fns_image = []
+
+
+class RecordingSource:
+    """
+    Read frames recorded by FrameRecorder as if they were a video stream.
+    fps is the mean rate they were recorded at.
+    """
+    def __init__(self, fn_recording):
+        self.f = open(fn_recording, 'rb')
+        if self.f.read(len(recording_magic)) != recording_magic:
+            print("[ERROR] {} is not a frame recording.".format(fn_recording))
+            self.f.close()
+        self.timestamps = []
+        self.n_read = 0
+        if not self.f.closed:
+            self._index()
+        self.timestamp = None  # Of the last frame read
+
+    def _index(self):
+        """
+        Read the frame timestamps, a truncated last frame is ignored.
+        """
+        start = self.f.tell()
+        while True:
+            header = self.f.read(record_header.size)
+            if len(header) < record_header.size:
+                break
+            (timestamp, n_bytes) = record_header.unpack(header)
+            self.f.seek(n_bytes, os.SEEK_CUR)
+            if self.f.tell() > os.fstat(self.f.fileno()).st_size:
+                break
+            self.timestamps.append(timestamp)
+        self.f.seek(start)
+        self.n_read = 0
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FPS and len(self.timestamps) > 1 \
+           and self.timestamps[-1] > self.timestamps[0]:
+            return (len(self.timestamps) - 1) / (self.timestamps[-1] - self.timestamps[0])
+        if prop == cv2.CAP_PROP_FRAME_COUNT:
+            return len(self.timestamps)
+        return 0
+
+    def isOpened(self):
+        return not self.f.closed and len(self.timestamps) > 0
+
+    def read(self):
+        if self.f.closed or self.n_read >= len(self.timestamps):
+            return False, None
+        (self.timestamp, n_bytes) = record_header.unpack(self.f.read(record_header.size))
+        data = np.frombuffer(self.f.read(n_bytes), dtype=np.uint8)
+        self.n_read += 1
+        image = cv2.imdecode(data, cv2.IMREAD_COLOR)
+        return image is not None, image
+
+    def release(self):
+        self.f.close()
+
+
+class SyntheticSource:
+    """
+    Generated frames of a face sized ellipse drifting over a textured
+    background, for running the pipeline without a camera or video.
+    """
+    def __init__(self, width=640, height=480, n_frames=300, fps=30, seed=0):
+        self.width = width
+        self.height = height
+        self.n_frames = n_frames
+        self.fps = fps
+        rng = np.random.RandomState(seed)
+        self.background = rng.randint(0, 64, size=(height, width, 3)).astype(np.uint8)
+        self.ind = 0
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FPS:
+            return self.fps
+        if prop == cv2.CAP_PROP_FRAME_COUNT:
+            return self.n_frames
+        return 0
+
+    def isOpened(self):
+        return self.n_frames > 0
+
+    def read(self):
+        if self.ind >= self.n_frames:
+            return False, None
+        phase = 2 * math.pi * self.ind / max(self.n_frames, 1)
+        center = (int(self.width * (0.5 + 0.3 * math.sin(phase))),
+                  int(self.height * (0.5 + 0.2 * math.sin(2 * phase))))
+        axes = (self.width // 10, self.height // 6)
+        frame = self.background.copy()
+        cv2.ellipse(frame, center, axes, 0, 0, 360, (150, 170, 200), -1)
+        self.ind += 1
+        return True, frame
+
+    def release(self):
+        self.n_frames = 0
+
+
+def parse_synthetic(source):
+    """
+    SyntheticSource from a 'synthetic[:WIDTHxHEIGHT[:FRAMES]]' source.
+    """
+    parts = source.split(':')
+    kwargs = {}
+    if len(parts) > 1 and parts[1]:
+        (kwargs['width'], kwargs['height']) = (int(x) for x in parts[1].lower().split('x'))
+    if len(parts) > 2 and parts[2]:
+        kwargs['n_frames'] = int(parts[2])
+    return SyntheticSource(**kwargs)
+
+
+def open_frame_source(source, source_fps=0):
+    """
+    Open a frame source from a device index, a video file, a directory
+    of images, a frame recording or a synthetic source (see
+    parse_synthetic).
+    Returns (capture, fps), where fps is the rate to pace non-live sources
+    at and 0 means the source is live and paces itself. Video files and
+    recordings are paced at their own frame rate if it is known,
+    otherwise at source_fps.
+    """
+    if isinstance(source, int) or str(source).strip().isdigit():
+        return cv2.VideoCapture(int(source)), 0
+
+    if str(source).startswith('synthetic'):
+        capture = parse_synthetic(str(source))
+        return capture, capture.fps
+
+    if os.path.isdir(source):
+        return ImageDirSource(source), source_fps
+
+    if str(source).endswith(recording_ext):
+        capture = RecordingSource(source)
+        return capture, capture.get(cv2.CAP_PROP_FPS) or source_fps
+
+    capture = cv2.VideoCapture(source)
+    if not capture.isOpened():
+        print("[ERROR] Unable to open frame source {}.".format(source))
+    return capture, capture.get(cv2.CAP_PROP_FPS) or source_fps
+
+
+class FrameGrabber:
+    def __init__(self, capture, process=None, buffer_size=2, fps=0, block=False):
+        """
+        Read frames from a capture on a background thread, keeping only the
+        newest buffer_size frames in a ring buffer. process is an optional
+        callable process(frame, slot) applied to each raw frame on the
+        capture thread. slot is never one held by the ring buffer or the
+        last frame read, so process may reuse one output buffer per slot;
+        a frame stays valid until the next read.
+        Non-live sources are paced at fps, or read as fast as frames are
+        consumed with an fps of inf. With block the capture thread waits
+        for the reader instead of dropping frames.
+        """
+        self.capture = capture
+        self.process = process
+        self.fps = fps
+        self.block = block
+        self.frames = deque(maxlen=max(1, buffer_size))  # (slot, frame)
+        self.n_slots = self.frames.maxlen + 2
+        self.read_slot = None
+        self.cond = threading.Condition()
+        self.frame_num = 0  # Frames read from the source
+        self.dropped = 0  # Frames discarded without being read
+        self.ended = False
+        self.stopped = False
+        self.thread = threading.Thread(target=self._run,
+                                       name='FrameGrabber',
+                                       daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def _run(self):
+        frame_interval = 1.0 / self.fps if self.fps else 0
+        next_time = time.monotonic()
+        while not self.stopped:
+            with metrics.timer('camera_read'):
+                ok, frame = self.capture.read()
+            if not ok:
+                if self.fps:  # Non-live source is exhausted
+                    break
+                time.sleep(0.01)  # Live camera hiccup, retry
+                continue
+
+            with self.cond:
+                if self.block:
+                    self.cond.wait_for(lambda: (len(self.frames) < self.frames.maxlen
+                                                or self.stopped))
+                used_slots = {slot for (slot, _) in self.frames}
+                used_slots.add(self.read_slot)
+            slot = min(set(range(self.n_slots)) - used_slots)
+
+            if self.process is not None:
+                frame = self.process(frame, slot)
+
+            with self.cond:
+                if len(self.frames) == self.frames.maxlen:
+                    self.dropped += 1
+                    metrics.count('frames_dropped')
+                self.frames.append((slot, frame))
+                self.frame_num += 1
+                self.cond.notify_all()
+
+            if frame_interval:
+                next_time += frame_interval
+                sleep_time = next_time - time.monotonic()
+                if sleep_time > 0:
+                    time.sleep(sleep_time)
+                else:
+                    next_time = time.monotonic()
+
+        with self.cond:
+            self.ended = True
+            self.cond.notify_all()
+
+    def wait_first_frame(self, timeout=None):
+        """
+        Wait until the source delivered a frame, returns whether it did.
+        """
+        with self.cond:
+            return self.cond.wait_for(lambda: self.frame_num > 0 or self.ended, timeout) \
+                and self.frame_num > 0
+
+    def read(self, timeout=0):
+        """
+        Return the newest frame and discard older ones.
+        Returns None if no new frame arrived within timeout seconds.
+        """
+        with self.cond:
+            if not self.frames and timeout:
+                self.cond.wait_for(lambda: self.frames or self.ended, timeout)
+            if not self.frames:
+                return None
+            (self.read_slot, frame) = self.frames.pop()
+            self.dropped += len(self.frames)
+            if self.frames:
+                metrics.count('frames_dropped', len(self.frames))
+            self.frames.clear()
+            return frame
+
+    def stop(self):
+        """
+        Stop the capture thread and release the source.
+        """
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        if self.thread.is_alive():
+            self.thread.join(timeout=2.0)
+        self.capture.release()
+
+
+class FrameRecorder:
+    def __init__(self, fn_recording, max_queue=60):
+        """
+        Append raw frames with their capture timestamps to a local
+        recording, for replaying a session offline with RecordingSource.
+        Frames are PNG encoded and written on a background thread; when it
+        falls more than max_queue frames behind, new frames are dropped
+        rather than stalling the camera. Recordings are not encrypted.
+        """
+        self.fn_recording = fn_recording
+        os.makedirs(os.path.dirname(fn_recording) or '.', exist_ok=True)
+        self.f = open(fn_recording, 'wb')
+        self.f.write(recording_magic)
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.n_frames = 0
+        self.dropped = 0
+        self.thread = threading.Thread(target=self._run,
+                                       name='FrameRecorder',
+                                       daemon=True)
+        self.thread.start()
+
+    def add(self, frame, timestamp=None):
+        """
+        Queue a copy of frame, camera buffers are reused.
+        """
+        try:
+            self.queue.put_nowait((time.time() if timestamp is None else timestamp,
+                                   frame.copy()))
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            (timestamp, frame) = item
+            ok, data = cv2.imencode('.png', frame)
+            if not ok:
+                continue
+            self.f.write(record_header.pack(timestamp, len(data)))
+            self.f.write(data.tobytes())
+            self.n_frames += 1
+
+    def close(self):
+        """
+        Write the queued frames and close the recording.
+        """
+        self.queue.put(None)
+        self.thread.join()
+        self.f.close()
+        print("[INFO] Recorded {} frames to {} ({} dropped)."
+              .format(self.n_frames, self.fn_recording, self.dropped))
@@ -0,0 +1,77 @@
+# Diverse subsampling of guest embeddings for training
+
+import numpy as np
+
+from embedding_index import kmeans
+from embedding_index import nearest_centers
+from embedding_index import normalize_rows
+
+
+def farthest_point_sample(X, k):
+    """
+    Indices of k diverse rows of X by farthest-point sampling on unit
+    embeddings: start from the row nearest the mean, then repeatedly add
+    the row farthest from everything chosen so far. Stops early, with
+    fewer than k rows, once only duplicates of chosen rows are left.
+    """
+    if len(X) <= k:
+        return np.arange(len(X))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    X = normalize_rows(X)
+    chosen = [int(np.argmax(X @ X.mean(axis=0)))]
+    # Cosine distance to the nearest chosen row
+    dists = 1.0 - X @ X[chosen[0]]
+    dists[chosen[0]] = -np.inf
+    for _ in range(k - 1):
+        ind = int(np.argmax(dists))
+        if dists[ind] <= 1e-6:  # Allowing for rounding
+            break
+        chosen.append(ind)
+        dists = np.minimum(dists, 1.0 - X @ X[ind])
+        dists[chosen] = -np.inf
+    return np.array(chosen)
+
+
+def stratified_sample(X, k, n_strata=16):
+    """
+    Indices of k rows of X spread over n_strata k-means clusters, each
+    cluster contributing in proportion to its size, and sampled diversely
+    within.
+    """
+    if len(X) <= k:
+        return np.arange(len(X))
+    X = normalize_rows(X)
+    centers = kmeans(X, min(n_strata, k))
+    strata = nearest_centers(X, centers)
+    counts = np.bincount(strata, minlength=len(centers))
+    quotas = np.floor(counts * k / len(X)).astype(int)
+    # Hand out the rows lost to rounding to the largest remainders
+    remainders = counts * k / len(X) - quotas
+    for i in np.argsort(-remainders)[:k - quotas.sum()]:
+        quotas[i] += 1
+    chosen = [np.flatnonzero(strata == i)[farthest_point_sample(X[strata == i], quota)]
+              for (i, quota) in enumerate(quotas) if quota > 0]
+    return np.sort(np.concatenate(chosen))
+
+
+def prune_gallery(X, guest_ids, max_per_guest, max_unknown=None, unknown_id=None,
+                  n_strata=16):
+    """
+    Row indices of X to train on: at most max_per_guest diverse embeddings
+    per guest, and at most max_unknown embeddings of the unknown_id class
+    stratified over its clusters. A cap of 0 or None keeps every row.
+    """
+    guest_ids = np.asarray(guest_ids, dtype=object)
+    keep = []
+    for guest_id in np.unique(guest_ids):
+        rows = np.flatnonzero(guest_ids == guest_id)
+        if guest_id == unknown_id and max_unknown:
+            keep.append(rows[stratified_sample(X[rows], max_unknown, n_strata)])
+        elif guest_id != unknown_id and max_per_guest:
+            keep.append(rows[farthest_point_sample(X[rows], max_per_guest)])
+        else:
+            keep.append(rows)
+    if not keep:
+        return np.empty(0, dtype=np.int64)
+    return np.sort(np.concatenate(keep))
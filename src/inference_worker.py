@@ -0,0 +1,284 @@
+# Out-of-process face detection and recognition
+
+import multiprocessing as mp
+import queue
+import threading
+import time
+
+import numpy as np
+
+from face_pipeline import detect_faces
+from face_pipeline import embed_faces
+from face_pipeline import load_detector
+from face_pipeline import load_embedder
+from face_pipeline import load_recognition_models
+from face_pipeline import predict_guests
+from face_pipeline import warm_up
+from metrics import metrics
+from preprocess import DetectorBlob
+from tracker import box_iou
+
+
+def _worker_main(shared_frame, requests, results, settings):
+    """
+    Inference process: load and warm up the detector and embedder once,
+    then answer frame requests read from shared memory until told to stop.
+    A failed request is answered with an 'error' message, models that
+    fail to load leave the previous ones in place.
+    """
+    detector = load_detector(settings['pn_detector_model'])
+    embedder = load_embedder(settings['fn_embedding_model'])
+    warm_up(detector, embedder, settings['trainRBGavg'], settings['image_width'])
+    blob = DetectorBlob(settings['trainRBGavg'])
+    recognizer, label_encoder = None, None
+    results.put({'mode': 'ready'})
+
+    while True:
+        msg = requests.get()
+        if msg['mode'] == 'stop':
+            break
+
+        if msg['mode'] == 'models':
+            try:
+                recognizer, label_encoder = load_recognition_models(*msg['models'])
+            except Exception as e:
+                results.put({'mode': 'error', 'request': 'models', 'error': repr(e)})
+            continue
+
+        try:
+            results.put(_answer_frame(shared_frame, msg, settings, detector,
+                                      embedder, blob, recognizer, label_encoder))
+        except Exception as e:
+            results.put({'mode': 'error', 'request': msg['mode'], 'seq': msg['seq'],
+                         'error': repr(e)})
+
+
+def _answer_frame(shared_frame, msg, settings, detector, embedder, blob,
+                  recognizer, label_encoder):
+    """
+    Detect, and for 'identify' recognize, faces in the frame of a request.
+    """
+    # View the frame in shared memory, it is only read while the
+    # request is in flight so no copy is needed
+    frame_shape = msg['shape']
+    pic = np.frombuffer(shared_frame,
+                        dtype=np.uint8,
+                        count=int(np.prod(frame_shape))).reshape(frame_shape)
+    # Stage timings go back with the result, for the main process metrics
+    timings = {}
+    start = time.perf_counter()
+    bound_boxes, confs, face_present = detect_faces(
+        detector,
+        pic,
+        settings['trainRBGavg'],
+        settings['min_detec_conf'],
+        max_x=settings['image_width'],
+        max_y=settings['image_width'],
+        min_face_px=settings['min_face_px'] if msg['mode'] == 'identify' else None,
+        blob=blob)
+    timings['detect'] = time.perf_counter() - start
+
+    result = {'mode': msg['mode'],
+              'seq': msg['seq'],
+              'bound_boxes': bound_boxes,
+              'confs': confs,
+              'face_present': face_present,
+              'embed_inds': [],
+              'guest_ids': [],
+              'probs': [],
+              'timings': timings}
+
+    if msg['mode'] == 'identify' and recognizer is not None and len(bound_boxes):
+        # Skip faces overlapping tracks that are already identified
+        embed_inds = list(range(len(bound_boxes)))
+        if len(msg['skip_boxes']):
+            ious = box_iou(bound_boxes, msg['skip_boxes'])
+            embed_inds = [i for i in embed_inds
+                          if ious[i].max() < msg['iou_thresh']]
+        start = time.perf_counter()
+        face_vecs = embed_faces(embedder, pic, bound_boxes[embed_inds])
+        timings['embed'] = time.perf_counter() - start
+        start = time.perf_counter()
+        guest_ids, probs = predict_guests(recognizer, label_encoder, face_vecs)
+        timings['predict'] = time.perf_counter() - start
+        result.update({'embed_inds': embed_inds,
+                       'guest_ids': list(guest_ids),
+                       'probs': list(probs)})
+    return result
+
+
+def observe_timings(result):
+    """
+    Record the stage timings of a worker result: detect, predict and the
+    embedding time per face.
+    """
+    if not metrics.enabled:
+        return
+    timings = result.get('timings', {})
+    if 'detect' in timings:
+        metrics.observe('detect', timings['detect'])
+        metrics.count('faces_detected', len(result['bound_boxes']))
+    n_faces = len(result['embed_inds'])
+    if n_faces and 'embed' in timings:
+        metrics.observe('embed_face', timings['embed'] / n_faces)
+        metrics.observe('predict', timings['predict'])
+        metrics.count('faces_embedded', n_faces)
+
+
+class InferenceWorker:
+    def __init__(self, settings, frame_bytes):
+        """
+        Run face detection, embedding and recognition in a separate process.
+        Frames are passed through a shared memory buffer of frame_bytes,
+        results come back asynchronously through poll().
+        A multiprocessing RawArray is used for the buffer so it works on
+        python 3.7 as well, which has no multiprocessing.shared_memory.
+        A worker process that dies is restarted up to max_restarts times,
+        after that failed is set.
+        """
+        self.ctx = mp.get_context('spawn')  # Don't fork the Tk/camera threads
+        self.settings = settings
+        self.frame_bytes = frame_bytes
+        self.shared_frame = self.ctx.RawArray('B', frame_bytes)
+        self.frame_buf = np.frombuffer(self.shared_frame, dtype=np.uint8)
+        self.seq = 0
+        self.busy = False
+        self.ready = False
+        self.models = None  # Last recognition models requested
+        self.max_restarts = 3
+        self.restarts = 0
+        self.failed = False
+        self.stopped = False
+        # wait_ready may read results from a startup thread
+        self.results_lock = threading.Lock()
+        self._new_process()
+
+    def _new_process(self):
+        self.requests = self.ctx.Queue()
+        self.results = self.ctx.Queue()
+        self.process = self.ctx.Process(target=_worker_main,
+                                        args=(self.shared_frame,
+                                              self.requests,
+                                              self.results,
+                                              self.settings),
+                                        name='InferenceWorker',
+                                        daemon=True)
+
+    def start(self):
+        self.process.start()
+        return self
+
+    def restart(self):
+        """
+        Replace a dead worker process with a new one that loads the last
+        requested recognition models, or give up after max_restarts.
+        """
+        self.busy = False
+        self.ready = False
+        if self.restarts >= self.max_restarts:
+            print("[ERROR] Inference worker exited {} times, giving up."
+                  .format(self.restarts + 1))
+            self.failed = True
+            return
+        self.restarts += 1
+        print("[ERROR] Inference worker exited unexpectedly, restarting...")
+        self._new_process()
+        self.start()
+        if self.models is not None:
+            self.requests.put({'mode': 'models', 'models': self.models})
+
+    def wait_ready(self, timeout=None):
+        """
+        Wait until the worker loaded and warmed up its models, returns
+        whether it did.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.ready and self.process.is_alive():
+            wait = 1.0 if deadline is None else min(1.0, deadline - time.monotonic())
+            if wait <= 0:
+                break
+            if not self.results_lock.acquire(timeout=wait):
+                continue
+            try:
+                if not self.ready:
+                    msg = self.results.get(timeout=wait)
+                    if msg['mode'] == 'ready':  # Nothing else is sent before ready
+                        self.ready = True
+            except queue.Empty:
+                pass
+            finally:
+                self.results_lock.release()
+        return self.ready
+
+    def load_models(self, *models):
+        """
+        Have the worker load recognition models, see load_recognition_models.
+        """
+        self.models = models
+        self.requests.put({'mode': 'models', 'models': models})
+
+    def submit(self, pic, mode, skip_boxes=(), iou_thresh=0.3):
+        """
+        Copy a frame into shared memory and request detection ('detect') or
+        detection plus recognition ('identify').
+        Returns False if a request is already in flight.
+        """
+        if self.busy or not self.ready:
+            return False
+        if pic.nbytes > self.frame_bytes:
+            print("[ERROR] Frame of shape {} is too large for the inference "
+                  "worker buffer.".format(pic.shape))
+            return False
+
+        self.frame_buf[:pic.nbytes] = pic.reshape(-1)
+        self.seq += 1
+        self.requests.put({'mode': mode,
+                           'seq': self.seq,
+                           'shape': pic.shape,
+                           'skip_boxes': np.asarray(skip_boxes, dtype=float).reshape(-1, 4),
+                           'iou_thresh': iou_thresh})
+        self.busy = True
+        return True
+
+    def poll(self):
+        """
+        Return the newest result without waiting, or None.
+        """
+        result = None
+        if not self.results_lock.acquire(blocking=False):
+            return None  # wait_ready is reading, nothing is sent before ready
+        try:
+            while True:
+                try:
+                    msg = self.results.get_nowait()
+                except queue.Empty:
+                    break
+                if msg['mode'] == 'ready':
+                    self.ready = True
+                    continue
+                if msg['mode'] == 'error':
+                    print("[ERROR] Inference worker failed on {}:".format(msg['request']))
+                    print(msg['error'])
+                    if msg['request'] != 'models':
+                        self.busy = False
+                    continue
+                result = msg
+                self.busy = False
+                observe_timings(msg)
+        finally:
+            self.results_lock.release()
+
+        if not (self.stopped or self.failed) and not self.process.is_alive():
+            self.restart()
+        return result
+
+    def stop(self):
+        """
+        Stop the worker process.
+        """
+        self.stopped = True
+        if self.process.is_alive():
+            self.requests.put({'mode': 'stop'})
+            self.process.join(timeout=2.0)
+            if self.process.is_alive():
+                self.process.terminate()
@@ -0,0 +1,289 @@
+# Latency histograms and counters for the sign-in pipeline
+
+from collections import deque
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+import re
+import threading
+import time
+
+import numpy as np
+
+quantiles = (50, 95, 99)
+
+
+class Histogram:
+    def __init__(self, max_samples=4096):
+        """
+        Rolling window of the newest max_samples observations, in seconds,
+        plus the count and sum of all observations.
+        """
+        self.samples = deque(maxlen=max_samples)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+        self.sum += seconds
+
+    def percentiles(self, qs=quantiles):
+        """
+        {q: seconds} over the rolling window, empty without samples.
+        """
+        if not self.samples:
+            return {}
+        values = np.percentile(np.fromiter(self.samples, dtype=np.float64), qs)
+        return dict(zip(qs, values.tolist()))
+
+
+class _Timer:
+    __slots__ = ('metrics', 'name', 'start')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_null_timer = _NullTimer()
+
+
+class Metrics:
+    def __init__(self, enabled=True):
+        """
+        Named latency histograms and counters, safe to update from any
+        thread. While disabled, timers are a shared no-op and nothing is
+        recorded.
+        """
+        self.enabled = enabled
+        self.histograms = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def observe(self, name, seconds):
+        if not self.enabled:
+            return
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    def timer(self, name):
+        """
+        Context manager timing its body into histogram name.
+        """
+        if not self.enabled:
+            return _null_timer
+        return _Timer(self, name)
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def _snapshot(self):
+        with self.lock:
+            histograms = {name: (histogram.count, histogram.sum, histogram.percentiles())
+                          for (name, histogram) in self.histograms.items()}
+            return histograms, dict(self.counters)
+
+    def summary(self):
+        """
+        {'latency_ms': {name: {count, mean, p50, p95, p99}}, 'counters':
+        {name: count}}, latencies in milliseconds.
+        """
+        (histograms, counters) = self._snapshot()
+        latency = {}
+        for (name, (count, total, percentiles)) in sorted(histograms.items()):
+            stats = {'count': count,
+                     'mean': round(total / max(count, 1) * 1000.0, 4)}
+            for (q, seconds) in percentiles.items():
+                stats['p{}'.format(q)] = round(seconds * 1000.0, 4)
+            latency[name] = stats
+        return {'latency_ms': latency, 'counters': counters}
+
+    def prometheus_text(self, prefix='biometric'):
+        """
+        Histograms as a summary of stage latencies and counters, in the
+        Prometheus text exposition format.
+        """
+        (histograms, counters) = self._snapshot()
+        lines = ['# HELP {}_stage_seconds Latency of sign-in pipeline stages.'.format(prefix),
+                 '# TYPE {}_stage_seconds summary'.format(prefix)]
+        for (name, (count, total, percentiles)) in sorted(histograms.items()):
+            for (q, seconds) in percentiles.items():
+                lines.append('{}_stage_seconds{{stage="{}",quantile="{}"}} {:.6g}'
+                             .format(prefix, name, q / 100.0, seconds))
+            lines.append('{}_stage_seconds_sum{{stage="{}"}} {:.6g}'.format(prefix, name, total))
+            lines.append('{}_stage_seconds_count{{stage="{}"}} {}'.format(prefix, name, count))
+        for (name, count) in sorted(counters.items()):
+            metric = '{}_{}_total'.format(prefix, re.sub(r'[^a-zA-Z0-9_]', '_', name))
+            lines.append('# TYPE {} counter'.format(metric))
+            lines.append('{} {}'.format(metric, count))
+        return '\n'.join(lines) + '\n'
+
+    def log_summary(self):
+        """
+        Print p50/p95/p99 of each stage and the counters.
+        """
+        summary = self.summary()
+        if not summary['latency_ms'] and not summary['counters']:
+            return
+        stages = ', '.join('{} {:.1f}/{:.1f}/{:.1f}'.format(name, stats['p50'],
+                                                            stats['p95'], stats['p99'])
+                           for (name, stats) in summary['latency_ms'].items())
+        print("[INFO] Latency p50/p95/p99 ms: {}".format(stages))
+        if summary['counters']:
+            print("[INFO] Counters: {}".format(', '.join(
+                '{} {}'.format(name, count)
+                for (name, count) in sorted(summary['counters'].items()))))
+
+
+# Registry the pipeline is instrumented with, enabled by configure_metrics()
+metrics = Metrics(enabled=False)
+
+
+class StartupTimer:
+    def __init__(self):
+        """
+        Wall time of named startup phases, which may run concurrently, and
+        of startup as a whole.
+        """
+        self.start_time = time.monotonic()
+        self.phases = {}  # name: (start, seconds) relative to startup
+
+    def _record(self, name, start):
+        end = time.monotonic()
+        self.phases[name] = (start - self.start_time, end - start)
+        metrics.observe('startup_' + name, end - start)
+
+    def run(self, name, func, *args, **kwargs):
+        """
+        Call func(*args, **kwargs) as phase name, e.g. on an executor.
+        """
+        start = time.monotonic()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self._record(name, start)
+
+    def phase(self, name):
+        """
+        Context manager timing its body as phase name.
+        """
+        return _Phase(self, name)
+
+    def report(self):
+        """
+        Print the total startup time and each phase, in order of starting.
+        """
+        print("[INFO] Started in {:.1f}s: {}".format(
+            time.monotonic() - self.start_time,
+            ', '.join('{} {:.1f}s (at {:.1f}s)'.format(name, seconds, start)
+                      for (name, (start, seconds))
+                      in sorted(self.phases.items(), key=lambda item: item[1][0]))))
+
+
+class _Phase:
+    def __init__(self, startup, name):
+        self.startup = startup
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.startup._record(self.name, self.start)
+        return False
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.metrics.prometheus_text().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes would flood the console
+
+
+def serve(metrics, port, host='127.0.0.1'):
+    """
+    Serve metrics at http://host:port/metrics from a daemon thread.
+    Returns the server.
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    server.metrics = metrics
+    threading.Thread(target=server.serve_forever,
+                     name='MetricsServer',
+                     daemon=True).start()
+    return server
+
+
+def log_periodically(metrics, interval):
+    """
+    Log a summary of metrics every interval seconds from a daemon thread.
+    """
+    def run():
+        while True:
+            time.sleep(interval)
+            metrics.log_summary()
+    threading.Thread(target=run, name='MetricsLog', daemon=True).start()
+
+
+_started = set()
+
+
+def configure_metrics(config):
+    """
+    Enable the registry, its HTTP endpoint and its periodic log summary
+    as set in a config, a registry enabled in code stays enabled. Servers
+    and loggers are started once per process.
+    """
+    if config['DEFAULT'].get('metrics_enabled', 'False') == 'True':
+        metrics.enabled = True
+    if not metrics.enabled:
+        return metrics
+    port = int(config['DEFAULT'].get('metrics_port', '0'))
+    if port and 'server' not in _started:
+        host = config['DEFAULT'].get('metrics_host', '127.0.0.1')
+        try:
+            serve(metrics, port, host)
+            _started.add('server')
+            print("[INFO] Serving metrics at http://{}:{}/metrics".format(host, port))
+        except OSError as e:
+            print("[ERROR] Unable to serve metrics on port {}:".format(port))
+            print(e)
+    interval = float(config['DEFAULT'].get('metrics_log_interval', '60'))
+    if interval > 0 and 'log' not in _started:
+        log_periodically(metrics, interval)
+        _started.add('log')
+    return metrics
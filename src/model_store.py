@@ -0,0 +1,311 @@
+#! /usr/bin/env python
+# Versioned, atomically published recognition models
+
+import argparse
+import configparser
+import importlib
+import json
+import os
+import pickle
+import shutil
+import time
+
+import numpy as np
+
+fn_config = 'biometric.cfg'
+fn_manifest = 'manifest.json'
+fn_latest = 'LATEST'
+
+
+class UnsupportedState(Exception):
+    """
+    An estimator attribute has no NumPy/JSON representation.
+    """
+
+
+def same_predictions(loaded, estimator, probe):
+    """
+    Whether loaded predicts as estimator on probe: class probabilities of
+    the probe samples for classifiers, the classes and the encoding of the
+    probe labels for label encoders.
+    """
+    if hasattr(estimator, 'predict_proba'):
+        return np.allclose(loaded.predict_proba(probe), estimator.predict_proba(probe))
+    return (np.array_equal(loaded.classes_, estimator.classes_)
+            and np.array_equal(loaded.transform(probe), estimator.transform(probe)))
+
+
+def encode_state(value, arrays, name):
+    """
+    Encode value as JSON, storing ndarrays in arrays under names derived
+    from name. Objects are stored by class and attributes.
+    """
+    if isinstance(value, np.ndarray):
+        is_object = value.dtype == object
+        if is_object:
+            if not all(isinstance(x, str) for x in value.flat):
+                raise UnsupportedState(name)
+            value = value.astype(str)
+        key = 'a{}'.format(len(arrays))
+        arrays[key] = value
+        return {'__npy__': key, 'object': is_object}
+    if isinstance(value, np.generic):
+        return value.item()
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, list):
+        return [encode_state(x, arrays, name) for x in value]
+    if isinstance(value, tuple):
+        return {'__tuple__': [encode_state(x, arrays, name) for x in value]}
+    if isinstance(value, dict):
+        if not all(isinstance(k, str) for k in value):
+            raise UnsupportedState(name)
+        return {'__dict__': {k: encode_state(v, arrays, '{}.{}'.format(name, k))
+                             for (k, v) in value.items()}}
+    if hasattr(value, '__dict__') and not callable(value):
+        cls = type(value)
+        return {'__object__': '{}:{}'.format(cls.__module__, cls.__qualname__),
+                'state': encode_state(vars(value), arrays, name)}
+    raise UnsupportedState(name)
+
+
+def decode_state(value, pn_arrays):
+    if isinstance(value, list):
+        return [decode_state(x, pn_arrays) for x in value]
+    if not isinstance(value, dict):
+        return value
+    if '__npy__' in value:
+        fn_array = os.path.join(pn_arrays, value['__npy__'] + '.npy')
+        try:
+            # Copy on write, so the estimator may modify its arrays in memory
+            array = np.load(fn_array, mmap_mode='c')
+        except ValueError:  # Empty arrays can't be mapped
+            array = np.load(fn_array)
+        return array.astype(object) if value['object'] else array
+    if '__tuple__' in value:
+        return tuple(decode_state(x, pn_arrays) for x in value['__tuple__'])
+    if '__dict__' in value:
+        return {k: decode_state(v, pn_arrays) for (k, v) in value['__dict__'].items()}
+    if '__object__' in value:
+        (module, qualname) = value['__object__'].split(':')
+        cls = importlib.import_module(module)
+        for attr in qualname.split('.'):
+            cls = getattr(cls, attr)
+        obj = cls.__new__(cls)
+        obj.__dict__.update(decode_state(value['state'], pn_arrays))
+        return obj
+    raise ValueError('Unknown model state {}'.format(value))
+
+
+class ModelStore:
+    def __init__(self, pn_models, keep=5):
+        """
+        Recognizer and label encoder versions, each in its own directory
+        written under a temporary name and renamed into place, with a
+        manifest of the version, training time and guest count. LATEST
+        names the version in use, rollback() points it at an older one.
+        Estimators are stored as .npy arrays, memory-mapped on load, plus
+        JSON attributes; estimators that don't round trip exactly are
+        pickled instead. The newest keep versions are kept.
+        """
+        self.pn_models = pn_models
+        self.keep = keep
+
+    def _pn_version(self, version):
+        return os.path.join(self.pn_models, 'v{:06d}'.format(version))
+
+    def versions(self):
+        """
+        Published versions, oldest first.
+        """
+        if not os.path.isdir(self.pn_models):
+            return []
+        return sorted(int(pn[1:]) for pn in os.listdir(self.pn_models)
+                      if pn.startswith('v') and pn[1:].isdigit()
+                      and os.path.isfile(os.path.join(self.pn_models, pn, fn_manifest)))
+
+    def latest_version(self):
+        """
+        The version in use, or None if none was published.
+        """
+        versions = self.versions()
+        try:
+            with open(os.path.join(self.pn_models, fn_latest), 'r') as f:
+                version = int(f.read().strip())
+        except (OSError, ValueError):
+            version = None
+        if version in versions:
+            return version
+        if not versions:
+            return None
+        # LATEST is missing, unreadable or names a removed version
+        print("[ERROR] No usable {} in {}, using the newest version v{}."
+              .format(fn_latest, self.pn_models, versions[-1]))
+        return versions[-1]
+
+    def _set_latest(self, version):
+        fn_tmp = os.path.join(self.pn_models, fn_latest + '.tmp')
+        with open(fn_tmp, 'w') as f:
+            f.write(str(version))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(fn_tmp, os.path.join(self.pn_models, fn_latest))
+
+    def manifest(self, version=None):
+        version = self.latest_version() if version is None else version
+        if version is None:
+            return None
+        with open(os.path.join(self._pn_version(version), fn_manifest), 'r') as f:
+            return json.load(f)
+
+    def _save_estimator(self, estimator, pn, name, probe=None):
+        """
+        Save an estimator in NumPy format, or pickle it if that fails or
+        it predicts differently on probe after loading. Returns the format.
+        """
+        arrays = {}
+        try:
+            state = encode_state(estimator, arrays, name)
+            pn_arrays = os.path.join(pn, name)
+            os.makedirs(pn_arrays)
+            for (key, array) in arrays.items():
+                np.save(os.path.join(pn_arrays, key + '.npy'), array)
+            with open(os.path.join(pn_arrays, 'state.json'), 'w') as f:
+                json.dump(state, f)
+            if probe is not None and len(probe):
+                loaded = decode_state(state, pn_arrays)
+                if not same_predictions(loaded, estimator, probe):
+                    raise UnsupportedState(name)
+            return 'npy'
+        except (UnsupportedState, TypeError, ValueError, AttributeError) as e:
+            print("[INFO] Storing {} as a pickle ({}).".format(name, e))
+            shutil.rmtree(os.path.join(pn, name), ignore_errors=True)
+            with open(os.path.join(pn, name + '.pickle'), 'wb') as f:
+                f.write(pickle.dumps(estimator))
+            return 'pickle'
+
+    def _load_estimator(self, pn, name, fmt):
+        if fmt == 'pickle':
+            with open(os.path.join(pn, name + '.pickle'), 'rb') as f:
+                return pickle.loads(f.read())
+        pn_arrays = os.path.join(pn, name)
+        with open(os.path.join(pn_arrays, 'state.json'), 'r') as f:
+            return decode_state(json.load(f), pn_arrays)
+
+    def publish(self, recognizer, label_encoder, n_guests, train_seconds=None,
+                probe=None):
+        """
+        Write a new version and make it the latest. probe is a sample of
+        embeddings used to check the stored recognizer predicts the same,
+        the label encoder is checked on all its classes.
+        Returns the version.
+        """
+        os.makedirs(self.pn_models, exist_ok=True)
+        versions = self.versions()
+        version = versions[-1] + 1 if versions else 1
+        pn_tmp = self._pn_version(version) + '.tmp'
+        shutil.rmtree(pn_tmp, ignore_errors=True)
+        os.makedirs(pn_tmp)
+
+        manifest = {'version': version,
+                    'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                    'train_seconds': train_seconds,
+                    'n_guests': n_guests,
+                    'recognizer': type(recognizer).__name__,
+                    'formats': {'recognizer': self._save_estimator(recognizer, pn_tmp,
+                                                                   'recognizer', probe),
+                                'label_encoder': self._save_estimator(label_encoder, pn_tmp,
+                                                                      'label_encoder',
+                                                                      label_encoder.classes_)}}
+        with open(os.path.join(pn_tmp, fn_manifest), 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.rename(pn_tmp, self._pn_version(version))
+        self._set_latest(version)
+        self.prune()
+        return version
+
+    def load(self, version=None):
+        """
+        Return (recognizer, label_encoder) of version, by default the
+        latest, or (None, None) if there is none.
+        """
+        version = self.latest_version() if version is None else version
+        if version is None:
+            return None, None
+        manifest = self.manifest(version)
+        pn = self._pn_version(version)
+        return (self._load_estimator(pn, 'recognizer', manifest['formats']['recognizer']),
+                self._load_estimator(pn, 'label_encoder', manifest['formats']['label_encoder']))
+
+    def import_pickles(self, fn_recognizer_model, fn_label_encoder):
+        """
+        Publish models pickled by earlier versions of train_model, if there
+        are any and nothing was published yet. Returns the version or None.
+        """
+        if self.versions() or not (os.path.isfile(fn_recognizer_model)
+                                   and os.path.isfile(fn_label_encoder)):
+            return None
+        print("[INFO] Importing pickled models into {}...".format(self.pn_models))
+        with open(fn_recognizer_model, "rb") as f:
+            recognizer = pickle.loads(f.read())
+        with open(fn_label_encoder, "rb") as f:
+            label_encoder = pickle.loads(f.read())
+        return self.publish(recognizer, label_encoder, len(label_encoder.classes_))
+
+    def rollback(self, version=None):
+        """
+        Make version, by default the one before the latest, the latest.
+        Returns the version now in use.
+        """
+        versions = self.versions()
+        latest = self.latest_version()
+        if version is None:
+            older = [v for v in versions if latest is None or v < latest]
+            if not older:
+                raise ValueError('No version before {} to roll back to'.format(latest))
+            version = older[-1]
+        if version not in versions:
+            raise ValueError('No model version {}'.format(version))
+        self._set_latest(version)
+        return version
+
+    def prune(self):
+        """
+        Remove all but the newest keep versions, never the latest.
+        """
+        latest = self.latest_version()
+        for version in self.versions()[:-self.keep]:
+            if version != latest:
+                shutil.rmtree(self._pn_version(version), ignore_errors=True)
+
+
+def default_model_store(config):
+    """
+    Model store directory from a config, next to the legacy pickles by
+    default.
+    """
+    return config['DEFAULT'].get(
+        'pn_model_store',
+        os.path.join(os.path.dirname(config['DEFAULT']['fn_recognizer_model']),
+                     'model_versions'))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='List or roll back recognition model versions.')
+    parser.add_argument('--rollback', nargs='?', type=int, const=0, default=None,
+                        metavar='VERSION',
+                        help='use VERSION, or the version before the latest')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(fn_config)
+    store = ModelStore(default_model_store(config))
+    if args.rollback is not None:
+        version = store.rollback(args.rollback or None)
+        print("[INFO] Rolled back to model version {}.".format(version))
+    latest = store.latest_version()
+    for version in store.versions():
+        manifest = store.manifest(version)
+        print("{} v{}: {}, {} guests, {} ({}s)".format(
+            '*' if version == latest else ' ', version, manifest['created'],
+            manifest['n_guests'], manifest['recognizer'], manifest['train_seconds']))
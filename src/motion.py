@@ -0,0 +1,70 @@
+# Motion gating for the identify loop
+
+import time
+
+import cv2
+import numpy as np
+
+
+class MotionGate:
+    def __init__(self, scale_width=64, pixel_thresh=25, area_thresh=0.01,
+                 idle_timeout=10.0, idle_detect_interval=2.0):
+        """
+        Decide whether the scene is active with cheap frame differencing on a
+        downscaled grayscale frame. After idle_timeout seconds without motion
+        or faces the gate goes idle and only allows a detection every
+        idle_detect_interval seconds.
+        """
+        self.scale_width = scale_width
+        self.pixel_thresh = pixel_thresh
+        self.area_thresh = area_thresh
+        self.idle_timeout = idle_timeout
+        self.idle_detect_interval = idle_detect_interval
+        self.reset()
+
+    def reset(self):
+        self.prev_gray = None
+        self.active_until = time.monotonic() + self.idle_timeout
+        self.last_idle_detect = 0.0
+
+    def motion(self, pic):
+        """
+        Return whether enough of the downscaled frame changed since the
+        previous call.
+        """
+        (pic_height, pic_width) = pic.shape[:2]
+        scale_height = max(1, int(pic_height * self.scale_width / pic_width))
+        small = cv2.resize(pic, (self.scale_width, scale_height),
+                           interpolation=cv2.INTER_AREA)
+        gray = cv2.GaussianBlur(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY), (3, 3), 0)
+
+        prev_gray, self.prev_gray = self.prev_gray, gray
+        if prev_gray is None or prev_gray.shape != gray.shape:
+            return True
+        changed = np.count_nonzero(cv2.absdiff(gray, prev_gray) > self.pixel_thresh)
+        return changed > self.area_thresh * gray.size
+
+    def wake(self):
+        """
+        Return to full rate, e.g. because a face was detected.
+        """
+        self.active_until = time.monotonic() + self.idle_timeout
+
+    def update(self, pic):
+        """
+        Check a frame for motion and return whether detection may run at
+        full rate.
+        """
+        if self.motion(pic):
+            self.wake()
+        return time.monotonic() < self.active_until
+
+    def idle_detection_due(self):
+        """
+        While idle, allow one detection every idle_detect_interval seconds.
+        """
+        now = time.monotonic()
+        if now - self.last_idle_detect >= self.idle_detect_interval:
+            self.last_idle_detect = now
+            return True
+        return False
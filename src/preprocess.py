@@ -0,0 +1,143 @@
+# Preallocated frame preprocessing
+
+import cv2
+import imutils
+import numpy as np
+
+# cv2.rotate equivalents of imutils.rotate, which is counterclockwise
+rotate_codes = {90: cv2.ROTATE_90_COUNTERCLOCKWISE,
+                180: cv2.ROTATE_180,
+                270: cv2.ROTATE_90_CLOCKWISE}
+
+
+def rotate_offsets(angle, width, height):
+    """
+    Offsets (row, col) such that imutils.rotate(pic, angle)[y, x] equals
+    cv2.rotate(pic, rotate_codes[angle])[y + row, x + col], with black
+    where that falls outside. imutils.rotate rotates about (w // 2, h // 2)
+    and keeps the frame size, so right-angle rotations crop and pad.
+    """
+    (c_x, c_y) = (width // 2, height // 2)
+    if angle == 90:
+        return (width - 1 - c_x - c_y, c_y - c_x)
+    if angle == 180:
+        return (height - 1 - 2 * c_y, width - 1 - 2 * c_x)
+    if angle == 270:
+        return (c_x - c_y, height - 1 - c_x - c_y)
+    return (0, 0)
+
+
+def paste_shifted(src, row, col, out):
+    """
+    Write out[y, x] = src[y + row, x + col] where that is inside src and
+    zero elsewhere, without allocating.
+    """
+    (out_height, out_width) = out.shape[:2]
+    (src_height, src_width) = src.shape[:2]
+    y_start, y_end = max(0, -row), min(out_height, src_height - row)
+    x_start, x_end = max(0, -col), min(out_width, src_width - col)
+    out.fill(0)
+    if y_start < y_end and x_start < x_end:
+        out[y_start:y_end, x_start:x_end] = src[y_start + row:y_end + row,
+                                                x_start + col:x_end + col]
+    return out
+
+
+class FramePreprocessor:
+    def __init__(self, camera_rot, image_width):
+        """
+        Rotate and resize camera frames into buffers that are reused across
+        frames. Right-angle camera_rot values use cv2.rotate instead of a
+        generic warpAffine, and the display image is resized before it is
+        rotated so only the small image is rotated.
+        Buffers are kept per slot, a frame stays valid until its slot is
+        handed to process again.
+        """
+        self.camera_rot = camera_rot % 360
+        self.image_width = image_width
+        self.buffers = {}  # slot: {name: array}
+
+    def _buffer(self, slot, name, shape):
+        slot_buffers = self.buffers.setdefault(slot, {})
+        buf = slot_buffers.get(name)
+        if buf is None or buf.shape != shape:
+            buf = slot_buffers[name] = np.empty(shape, dtype=np.uint8)
+        return buf
+
+    def _rotate(self, pic, slot, name, out):
+        """
+        Rotate pic into out with imutils.rotate semantics.
+        """
+        if self.camera_rot == 0:
+            np.copyto(out, pic)
+            return out
+        (pic_height, pic_width) = pic.shape[:2]
+        rotated_shape = ((pic_width, pic_height, 3) if self.camera_rot in (90, 270)
+                         else pic.shape)
+        rotated = cv2.rotate(pic, rotate_codes[self.camera_rot],
+                             dst=self._buffer('tmp', name, rotated_shape))
+        (row, col) = rotate_offsets(self.camera_rot, pic_width, pic_height)
+        return paste_shifted(rotated, row, col, out)
+
+    def process(self, raw_pic, slot=0, keep_orig=True):
+        """
+        Return (curr_pic, orig_pic): the rotated frame resized to
+        image_width, and the rotated full size frame if keep_orig.
+        """
+        if self.camera_rot not in (0, 90, 180, 270):  # No fast path
+            orig_pic = imutils.rotate(raw_pic, angle=self.camera_rot)
+            return imutils.resize(orig_pic, width=self.image_width), orig_pic
+
+        (raw_height, raw_width) = raw_pic.shape[:2]
+        curr_shape = (int(raw_height * self.image_width / float(raw_width)),
+                      self.image_width,
+                      3)
+
+        orig_pic = None
+        if keep_orig and self.camera_rot == 0:
+            orig_pic = raw_pic  # Each camera read is a new array
+        elif keep_orig:
+            orig_pic = self._rotate(raw_pic, slot, 'orig',
+                                    self._buffer(slot, 'orig', raw_pic.shape))
+
+        # Rotation keeps the frame size, so resizing first is equivalent
+        curr_pic = self._buffer(slot, 'curr', curr_shape)
+        if curr_shape == raw_pic.shape:
+            small = raw_pic
+        else:
+            small = cv2.resize(raw_pic,
+                               (curr_shape[1], curr_shape[0]),
+                               dst=self._buffer('tmp', 'small', curr_shape),
+                               interpolation=cv2.INTER_AREA)
+        self._rotate(small, slot, 'curr', curr_pic)
+        return curr_pic, orig_pic
+
+
+class DetectorBlob:
+    def __init__(self, trainRBGavg, size=300):
+        """
+        Reusable face detector blob, equivalent to cv2.dnn.blobFromImage
+        with scale 1.0, mean subtraction and no channel swap.
+        """
+        self.size = size
+        self.resized = np.empty((size, size, 3), dtype=np.uint8)
+        self.blob = np.empty((1, 3, size, size), dtype=np.float32)
+        self.mean = np.array(trainRBGavg, dtype=np.float32).reshape(3, 1, 1)
+
+    def __call__(self, pic):
+        cv2.resize(pic, (self.size, self.size), dst=self.resized)
+        np.subtract(self.resized.transpose(2, 0, 1), self.mean, out=self.blob[0])
+        return self.blob
+
+
+class DisplayConverter:
+    def __init__(self):
+        """
+        Reusable BGR to RGB conversion for display.
+        """
+        self.rgb = None
+
+    def __call__(self, pic):
+        if self.rgb is None or self.rgb.shape != pic.shape:
+            self.rgb = np.empty(pic.shape, dtype=np.uint8)
+        return cv2.cvtColor(pic, cv2.COLOR_BGR2RGB, dst=self.rgb)
@@ -0,0 +1,249 @@
+# Incremental face recognizers over embeddings
+
+import numpy as np
+
+from embedding_index import EmbeddingIndex
+from embedding_index import normalize_rows
+
+
+class CentroidRecognizer:
+    def __init__(self, temperature=0.05, radius_scale=2.0, min_sim=0.0,
+                 prior_count=2.0, prior_spread=0.2):
+        """
+        Cosine nearest-centroid classifier with the predict_proba/classes_
+        interface of the scikit-learn models used for recognition.
+        Each guest is kept as the running sum of their unit embeddings, so
+        guests are added (partial_fit) or removed (remove) in constant time
+        without retraining the others.
+        Class probabilities are a softmax over cosine similarities, damped
+        by how far a face falls outside the class's calibrated radius:
+        a guest's mean member similarity gives their spread, and faces
+        less similar than 1 - radius_scale times the spread expected of a
+        new face (at least min_sim) get low probabilities. Rows may sum to
+        less than one, the remainder being the chance the face is none of
+        the classes.
+        A guest with few images has a spread shrunk toward the spread
+        pooled over all guests, weighing the pooled spread as prior_count
+        extra images (prior_spread if no guest has two images), so a
+        single image doesn't make for a radius of zero.
+        """
+        self.temperature = temperature
+        self.radius_scale = radius_scale
+        self.min_sim = min_sim
+        self.prior_count = prior_count
+        self.prior_spread = prior_spread
+        self.classes_ = np.empty(0, dtype=object)
+        self.sums_ = np.empty((0, 0))
+        self.counts_ = np.empty(0, dtype=np.int64)
+        self.digests_ = {}  # guest_id: digest of the embeddings fitted
+
+    def fit(self, X, y):
+        """
+        Fit from scratch on embeddings X of guests y.
+        """
+        self.classes_ = np.empty(0, dtype=object)
+        self.sums_ = np.empty((0, np.shape(X)[1]))
+        self.counts_ = np.empty(0, dtype=np.int64)
+        self.digests_ = {}
+        return self.partial_fit(X, y)
+
+    def partial_fit(self, X, y):
+        """
+        Add embeddings X of guests y, guests new to the model are added.
+        """
+        X = normalize_rows(X)
+        y = np.asarray(y, dtype=object)
+        if len(X) == 0:
+            return self
+        if self.sums_.shape[1] != X.shape[1]:
+            self.sums_ = np.empty((0, X.shape[1]))
+
+        new_classes = np.setdiff1d(np.unique(y), self.classes_)
+        if len(new_classes):
+            classes = np.concatenate([self.classes_, new_classes])
+            order = np.argsort(classes, kind='stable')
+            self.classes_ = classes[order]
+            self.sums_ = np.concatenate([self.sums_,
+                                         np.zeros((len(new_classes), X.shape[1]))])[order]
+            self.counts_ = np.concatenate([self.counts_,
+                                           np.zeros(len(new_classes), dtype=np.int64)])[order]
+
+        class_inds = np.searchsorted(self.classes_, y)
+        np.add.at(self.sums_, class_inds, X)
+        np.add.at(self.counts_, class_inds, 1)
+        return self
+
+    def remove(self, guest_ids):
+        """
+        Drop guests from the model.
+        """
+        keep = ~np.isin(self.classes_, np.asarray(guest_ids, dtype=object))
+        self.classes_ = self.classes_[keep]
+        self.sums_ = self.sums_[keep]
+        self.counts_ = self.counts_[keep]
+        for guest_id in guest_ids:
+            self.digests_.pop(guest_id, None)
+        return self
+
+    def centroids(self):
+        return normalize_rows(self.sums_)
+
+    def thresholds(self):
+        """
+        Per class cosine similarity below which a face is outside the class.
+        The mean similarity of unit members to their unit centroid is
+        |sum| / count, so it is known from the running sums alone.
+        """
+        mean_sims = (np.linalg.norm(self.sums_, axis=1)
+                     / np.maximum(self.counts_, 1))
+        # Members pull the centroid toward themselves, so their spread
+        # around it is count - 1 / count of the spread around the guest's
+        # true center, and a new face of the guest is expected at
+        # 1 + 1 / count of it. A class's spread comes from its count - 1
+        # images beyond the first, shrunk toward the spread pooled over
+        # all classes
+        counts = np.maximum(self.counts_, 1).astype(np.float64)
+        dofs = counts - 1.0
+        spreads = (1.0 - mean_sims) * counts / np.maximum(dofs, 1.0)
+        pooled = (dofs @ spreads / dofs.sum()) if dofs.sum() else self.prior_spread
+        spreads = ((dofs * spreads + self.prior_count * pooled)
+                   / (dofs + self.prior_count))
+        expected = spreads * (1.0 + 1.0 / counts)
+        return np.maximum(1.0 - self.radius_scale * expected, self.min_sim)
+
+    def similarities(self, X):
+        return normalize_rows(X) @ self.centroids().T
+
+    def predict_proba(self, X):
+        sims = self.similarities(X)
+        logits = sims / self.temperature
+        logits -= logits.max(axis=1, keepdims=True)
+        probs = np.exp(logits)
+        probs /= probs.sum(axis=1, keepdims=True)
+        # Damp classes the face lies outside of
+        inside = 1.0 / (1.0 + np.exp(-(sims - self.thresholds()) / self.temperature))
+        return probs * inside
+
+    def predict(self, X):
+        return self.classes_[np.argmax(self.predict_proba(X), axis=1)]
+
+
+class KNNRecognizer:
+    def __init__(self, k=5, temperature=0.05, min_sim=0.5, index_mode='auto',
+                 int8=False, n_probe=8, ivfpq_min_size=20000):
+        """
+        k nearest neighbour classifier over an EmbeddingIndex, with the
+        predict_proba/classes_ interface of the scikit-learn models used
+        for recognition. Neighbours vote for their guest with weight
+        exp(similarity / temperature), and a guest's probability is damped
+        when even their nearest neighbour is less similar than min_sim.
+        index_mode 'auto' uses an exact index, or ivfpq from ivfpq_min_size
+        embeddings on. Guests are added (partial_fit) or removed (remove)
+        without rebuilding the index.
+        """
+        self.k = k
+        self.temperature = temperature
+        self.min_sim = min_sim
+        self.index_mode = index_mode
+        self.int8 = int8
+        self.n_probe = n_probe
+        self.ivfpq_min_size = ivfpq_min_size
+        self.classes_ = np.empty(0, dtype=object)
+        self.guest_ids_ = []  # Index label: guest_id, labels are never reused
+        self.index = None
+        self.digests_ = {}  # guest_id: digest of the embeddings fitted
+
+    def _new_index(self, n_vectors):
+        mode = self.index_mode
+        if mode == 'auto':
+            mode = 'ivfpq' if n_vectors >= self.ivfpq_min_size else 'exact'
+        return EmbeddingIndex(mode=mode, int8=self.int8, n_probe=self.n_probe)
+
+    def _labels(self, y):
+        id_labels = {guest_id: i for (i, guest_id) in enumerate(self.guest_ids_)}
+        for guest_id in y:
+            if guest_id not in id_labels:
+                id_labels[guest_id] = len(self.guest_ids_)
+                self.guest_ids_.append(guest_id)
+        return np.array([id_labels[guest_id] for guest_id in y], dtype=np.int32)
+
+    def _update_classes(self):
+        present = np.unique(self.index.labels) if self.index is not None else []
+        self.classes_ = np.array(sorted(self.guest_ids_[i] for i in present), dtype=object)
+
+    def fit(self, X, y):
+        """
+        Index embeddings X of guests y from scratch.
+        """
+        self.guest_ids_ = []
+        self.digests_ = {}
+        self.index = self._new_index(len(X)).build(X, self._labels(y))
+        self._update_classes()
+        return self
+
+    def partial_fit(self, X, y):
+        """
+        Add embeddings X of guests y. The index is rebuilt when it outgrows
+        its mode, or holds 4x the vectors its quantizers were trained on.
+        """
+        if self.index is None:
+            return self.fit(X, y) if len(X) else self
+        if len(X) == 0:
+            return self
+        self.index.add(X, self._labels(y))
+        if self._new_index(len(self.index)).mode != self.index.mode \
+           or (self.index.mode == 'ivfpq' and len(self.index) > 4 * self.index.n_trained):
+            self.rebuild()
+        self._update_classes()
+        return self
+
+    def rebuild(self):
+        """
+        Retrain the index on the embeddings it holds. Only exact indexes
+        keep the original vectors, so ivfpq indexes are rebuilt from their
+        decoded vectors.
+        """
+        index = self.index
+        if index.mode == 'exact':
+            vectors = index.vectors.astype(np.float32)
+        else:
+            residuals = index.codebooks[np.arange(index.n_subvectors), index.codes]
+            vectors = index.coarse[index.lists] + residuals.reshape(len(index), -1)
+        self.index = self._new_index(len(index)).build(vectors, index.labels)
+
+    def remove(self, guest_ids):
+        """
+        Drop guests from the model.
+        """
+        labels = [i for (i, guest_id) in enumerate(self.guest_ids_)
+                  if guest_id in set(guest_ids)]
+        if self.index is not None and labels:
+            self.index.remove(labels)
+        for guest_id in guest_ids:
+            self.digests_.pop(guest_id, None)
+        self._update_classes()
+        return self
+
+    def predict_proba(self, X):
+        probs = np.zeros((len(X), len(self.classes_)))
+        if self.index is None or len(self.classes_) == 0:
+            return probs
+        (sims, labels) = self.index.search(X, self.k)
+        found = labels >= 0
+        class_ids = np.array(self.guest_ids_, dtype=object)[np.maximum(labels, 0)]
+        cols = np.searchsorted(self.classes_, class_ids.ravel()).reshape(labels.shape)
+
+        best = np.where(found, sims, -np.inf).max(axis=1, keepdims=True)
+        weights = np.where(found, np.exp((sims - best) / self.temperature), 0.0)
+        rows = np.repeat(np.arange(len(X)), labels.shape[1]).reshape(labels.shape)
+        np.add.at(probs, (rows[found], cols[found]), weights[found])
+        probs /= np.maximum(probs.sum(axis=1, keepdims=True), 1e-12)
+
+        # Damp guests whose nearest neighbour is too far away
+        nearest = np.full(probs.shape, -np.inf)
+        np.maximum.at(nearest, (rows[found], cols[found]), sims[found])
+        inside = 1.0 / (1.0 + np.exp(-(nearest - self.min_sim) / self.temperature))
+        return probs * inside
+
+    def predict(self, X):
+        return self.classes_[np.argmax(self.predict_proba(X), axis=1)]
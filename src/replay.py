@@ -0,0 +1,136 @@
+#! /usr/bin/env python
+# Headless replay of recorded, video or synthetic frames through the
+# sign-in pipeline
+
+import argparse
+import configparser
+import json
+import time
+import uuid
+
+from camera import FacialCamera
+from camera import fn_config
+from metrics import metrics as pipeline_metrics
+from model_store import ModelStore
+from model_store import default_model_store
+
+fn_report = 'replay_report.json'
+
+
+class _ShowGuestIds(dict):
+    """
+    Guest info that shows each guest_id, for replays without the guest
+    database.
+    """
+    def __contains__(self, guest_id):
+        return True
+
+    def __missing__(self, guest_id):
+        return guest_id
+
+
+def replay(fc, mode='identify', max_frames=None, metrics=None):
+    """
+    Feed frames from fc's source through capture or identify (or only
+    display conversion with mode 'view') until the source ends.
+    Returns a report of achieved FPS, dropped frames, per stage latency
+    and the identities produced. Stages are timed into metrics, by
+    default the pipeline's registry, which must be enabled.
+    """
+    metrics = metrics or pipeline_metrics
+    identities = {}  # guest_id: {first_frame, last_frame, frames, max_prob}
+    identity_frames = []  # [frame_num, {guest_id: prob}] whenever they change
+    prev_ids = {}
+    n_frames = 0
+    start_time = time.monotonic()
+    while max_frames is None or n_frames < max_frames:
+        with metrics.timer('query'):
+            curr_pic, orig_pic = fc.query_camera(timeout=1.0)
+        if curr_pic is None:
+            if fc.grabber.ended:
+                break
+            continue
+
+        if mode == 'capture':
+            with metrics.timer('capture'):
+                curr_pic = fc.guest_capture_func(orig_pic, curr_pic)
+        elif mode == 'identify':
+            with metrics.timer('identify'):
+                curr_pic = fc.guest_identify_func(curr_pic)
+            guest_ids = {guest_id: round(float(prob), 4)
+                         for (guest_id, prob) in fc.guest_ids.items()}
+            for (guest_id, prob) in guest_ids.items():
+                identity = identities.setdefault(guest_id, {'first_frame': n_frames,
+                                                            'frames': 0,
+                                                            'max_prob': 0.0})
+                identity['last_frame'] = n_frames
+                identity['frames'] += 1
+                identity['max_prob'] = max(identity['max_prob'], prob)
+            if guest_ids != prev_ids:
+                identity_frames.append([n_frames, guest_ids])
+                prev_ids = guest_ids
+        fc.convert_imgpil(curr_pic)
+        n_frames += 1
+    elapsed = time.monotonic() - start_time
+
+    return {'mode': mode,
+            'frames': n_frames,
+            'source_frames': fc.grabber.frame_num,
+            'dropped_frames': fc.grabber.dropped,
+            'seconds': round(elapsed, 3),
+            'fps': round(n_frames / elapsed, 2) if elapsed > 0 else None,
+            'metrics': metrics.summary(),
+            'identities': identities,
+            'identity_frames': identity_frames}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Replay frames through capture or identify without a camera '
+                    'or display, and report FPS, latency and identities.')
+    parser.add_argument('source',
+                        help='frame recording (.frames), video file, image directory '
+                             'or synthetic[:WIDTHxHEIGHT[:FRAMES]]')
+    parser.add_argument('--mode', choices=('identify', 'capture', 'view'), default='identify')
+    parser.add_argument('--speed', choices=('realtime', 'max'), default='realtime',
+                        help='pace frames as recorded, or process every frame as '
+                             'fast as possible')
+    parser.add_argument('--max-frames', type=int, default=None)
+    parser.add_argument('--model-version', type=int, default=None)
+    parser.add_argument('--out', default=fn_report, help='JSON report')
+    args = parser.parse_args()
+
+    pipeline_metrics.enabled = True  # Before the camera starts its stages
+    # At max speed detection runs in process, on every due frame, so the
+    # identities don't depend on when the worker happens to be free
+    max_speed = args.speed == 'max'
+    fc = FacialCamera(source=args.source,
+                      max_speed=max_speed,
+                      inference_worker=False if max_speed else None)
+    try:
+        if not fc.wait_ready(timeout=120):
+            print("[ERROR] Inference worker not ready, replaying anyway.")
+        if args.mode == 'identify':
+            config = configparser.ConfigParser()
+            config.read(fn_config)
+            model_store = ModelStore(default_model_store(config))
+            fc.load_recognition_models(model_store.pn_models, args.model_version)
+            fc.known_guest_meta = _ShowGuestIds()
+            fc.gst_identify = True
+        elif args.mode == 'capture':
+            # Captures are discarded, never committed to the archive
+            fc.max_capture_length = float('inf')
+            fc.max_images = float('inf')
+            fc.start_capture('replay_{}'.format(uuid.uuid4()))
+        report = replay(fc, args.mode, args.max_frames)
+        report['inference'] = 'worker' if fc.worker is not None else 'in_process'
+    finally:
+        if fc.gst_capture:
+            fc.stop_capture(discard=True)
+        fc.destructor()
+
+    report.update(source=args.source, speed=args.speed)
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("[INFO] {} frames at {} FPS, {} dropped. Report written to {}.".format(
+        report['frames'], report['fps'], report['dropped_frames'], args.out))
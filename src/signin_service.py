@@ -0,0 +1,267 @@
+#! /usr/bin/env python
+# Headless guest identification and sign in
+
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import configparser
+import datetime
+import os
+import signal
+import sys
+import threading
+
+from metrics import metrics
+from metrics import StartupTimer
+from model_store import default_model_store
+from model_store import ModelStore
+from signin_writer import SignInWriter
+
+fn_config = 'biometric.cfg'
+unknown_guest_id = '00000000-0000-0000-0000-000000000000'
+# Environment variables holding the guest db password, or a file with it
+env_pw = 'BIOMETRIC_PW'
+env_pw_file = 'BIOMETRIC_PW_FILE'
+
+
+def read_password(config):
+    """
+    Guest db password from the BIOMETRIC_PW environment variable, the file
+    named by BIOMETRIC_PW_FILE or pw_guestdb_file, or pw_guestdb in the
+    config, in that order. Returns None if none is set.
+    """
+    if os.environ.get(env_pw):
+        return os.environ[env_pw]
+    fn_pw = os.environ.get(env_pw_file) or config['DEFAULT'].get('pw_guestdb_file')
+    if fn_pw:
+        try:
+            with open(fn_pw, 'r') as f:
+                return f.readline().rstrip('\r\n')
+        except OSError as e:
+            print("[ERROR] Unable to read password file {}:".format(fn_pw))
+            print(e)
+            return None
+    return config['DEFAULT'].get('pw_guestdb')
+
+
+class SignInService:
+    def __init__(self, fc, guestdb, config=None):
+        """
+        Capture or identify guests in frames from a FacialCamera and record
+        sign ins in the guest db, with no display. Guests identified are
+        kept in memory and written to the db every signin_flush_interval
+        seconds by a SignInWriter. The Tk application is a front end on
+        top of this service; run() drives it headless.
+        """
+        if config is None:
+            config = configparser.ConfigParser()
+            config.read(fn_config)
+        self.fc = fc
+        self.guestdb = guestdb
+        self.display_name = config['DEFAULT']['display_name']
+        self.fn_label_encoder = config['DEFAULT']['fn_label_encoder']
+        self.fn_recognizer_model = config['DEFAULT']['fn_recognizer_model']
+        self.model_store = ModelStore(default_model_store(config))
+        self.flush_interval = float(config['DEFAULT'].get('signin_flush_interval', '10'))
+        self.writer = SignInWriter(guestdb, self.flush_interval)
+        self.unknown_guest_id = unknown_guest_id
+
+        # Sign In
+        self.init_sign_in()
+        self.guest_ids = {}
+
+    def init_sign_in(self):
+        """
+        Forget who signed in, so guests may sign in again, and initialize
+        the start/stop record using columns from the SignSS table.
+        """
+        # sqlalchemy is slow to import, so only on first use
+        from database import SignSS
+
+        self.signed_in = set()  # guest_ids signed in since init_sign_in
+
+        self.signin_startstop = dict(zip(SignSS.__table__.columns.keys(),
+                                         [None for x in SignSS.__table__.columns.keys()]))
+
+    def add_sign_ins(self, guest_ids, first_time=0):
+        """
+        Sign in {guest_id: class_prob}, written by the writer within
+        flush_interval seconds or on the next update_signin.
+        """
+        now = datetime.datetime.now()
+        self.writer.add([{'fr_id': guest_id,
+                          'class_prob': float(class_prob),
+                          'time': now,
+                          'first_time': int(first_time)}
+                         for (guest_id, class_prob) in guest_ids.items()])
+        self.signed_in.update(guest_ids)
+
+    def update_signin(self, wait=False):
+        """
+        Have the writer update the database with those who have signed in
+        now, optionally waiting until it did.
+        """
+        self.writer.flush(wait)
+
+    def has_models(self):
+        """
+        Whether trained models are present, models pickled by earlier
+        versions are moved into the model store.
+        """
+        self.model_store.import_pickles(self.fn_recognizer_model,
+                                        self.fn_label_encoder)
+        return self.model_store.latest_version() is not None
+
+    def start_identify(self):
+        """
+        Load the models and guest metadata and start identifying.
+        Returns False if no models were trained yet.
+        """
+        if not self.has_models():
+            print('[INFO] No guest specific models present.')
+            return False
+
+        # Load prev captured guest metadata:
+        known_guest_meta = self.guestdb.query_allguestmeta()
+        if self.display_name in known_guest_meta.columns:
+            self.fc.known_guest_meta = known_guest_meta[self.display_name]
+        else:
+            print('[ERROR]: No user information corresponding to {}. '
+                  'Valid options are:\n{}'
+                  .format(self.display_name, known_guest_meta.columns))
+            self.fc.known_guest_meta = None
+
+        print('[INFO] Starting identification...')
+        self.fc.gst_identify = True
+        print('[INFO] Loading guests previously captured')
+        # load the actual face recognition model along with the label encoder
+        self.fc.load_recognition_models(self.model_store.pn_models)
+
+        self.fc.reset_tracking()
+        self.init_sign_in()
+        self.guest_ids = {}
+        self.signin_startstop['start_time'] = datetime.datetime.now()
+        self.guestdb.record_startstop(self.signin_startstop)
+        return True
+
+    def stop_identify(self):
+        """
+        Stop identifying, writing outstanding sign ins and the stop time.
+        """
+        print('[INFO] Stopped identification.')
+        self.fc.gst_identify = False
+        self.update_signin()
+        if self.signin_startstop['start_time']:
+            self.signin_startstop['stop_time'] = datetime.datetime.now()
+            self.guestdb.record_startstop(self.signin_startstop)
+
+    def process_frame(self, curr_pic, orig_pic):
+        """
+        Capture or identify guests in a frame from query_camera, signing
+        in newly identified guests. Returns the picture to display.
+        """
+        metrics.count('frames')
+        if self.fc.gst_capture:  # Capture images for training
+            curr_pic = self.fc.guest_capture_func(orig_pic, curr_pic)
+        elif self.fc.gst_identify:  # Identify individuals
+            curr_pic = self.fc.guest_identify_func(curr_pic)
+
+            # Append new guest ids:
+            self.guest_ids = dict(self.fc.guest_ids)
+            # Drop 'unknown' guest id:
+            self.guest_ids.pop(self.unknown_guest_id, None)
+            # Drop users already signed in:
+            for curr_id in self.signed_in.intersection(self.guest_ids):
+                self.guest_ids.pop(curr_id)
+
+            if self.guest_ids:
+                self.add_sign_ins(self.guest_ids)
+                # Signed in guests are no longer embedded
+                self.fc.signed_in_ids.update(self.guest_ids.keys())
+        return curr_pic
+
+    def run(self, stop_event=None):
+        """
+        Identify guests until stop_event is set or a non-live frame source
+        ends. Returns False if there are no models to identify with.
+        """
+        stop_event = stop_event or threading.Event()
+        if not self.start_identify():
+            return False
+        try:
+            while not stop_event.is_set():
+                curr_pic, orig_pic = self.fc.query_camera(timeout=1.0)
+                if curr_pic is None:
+                    if self.fc.grabber.ended:
+                        print('[INFO] Frame source ended.')
+                        break
+                    continue
+                self.process_frame(curr_pic, orig_pic)
+        finally:
+            self.stop_identify()
+        return True
+
+    def close(self):
+        """
+        Write outstanding sign ins and release the camera and the db
+        connections. Raises SignInWriteError with any sign ins that could
+        not be written.
+        """
+        if self.fc.gst_identify:
+            self.stop_identify()
+        try:
+            self.writer.close()  # Writes outstanding sign ins
+        finally:
+            self.guestdb.close()
+            self.fc.destructor()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Identify and sign in guests without a display. The guest db '
+                    'password is read from ${} or the file named by ${}.'
+                    .format(env_pw, env_pw_file))
+    parser.add_argument('--source', default=None,
+                        help='frame source overriding camera_source')
+    args = parser.parse_args()
+
+    from camera import FacialCamera as FC
+    import database
+
+    config = configparser.ConfigParser()
+    config.read(fn_config)
+    pw_guestdb = read_password(config)
+    if pw_guestdb is None:
+        print("[ERROR] No guest db password, set {} or {}.".format(env_pw, env_pw_file))
+        sys.exit(1)
+    fn_guestdb = config['DEFAULT']['fn_guestdb']
+    if not os.path.isfile(fn_guestdb):
+        print("[ERROR] No guest db {}, run start_gui.py once to create it."
+              .format(fn_guestdb))
+        sys.exit(1)
+    print("[INFO] starting...")
+    # The camera and models start while the db unlocks
+    startup = StartupTimer()
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix='Startup') as executor:
+        camera = executor.submit(startup.run, 'camera', FC, source=args.source)
+        guestdb = database.db(password=pw_guestdb, dbname=fn_guestdb)
+        if not startup.run('db_unlock', guestdb.test_db_connection):
+            print("[ERROR] Incorrect guest db password.")
+            camera.result().destructor()
+            sys.exit(1)
+        fc = camera.result()
+        startup.run('db_pool', guestdb.warm_pool)
+    # Guestdb password is used for guest images archive as well
+    fc.guest_archive.pw = pw_guestdb
+    startup.run('archive_index', fc.guest_archive.load_index)
+    fc.capture_writer.recover()
+    service = SignInService(fc, guestdb, config)
+    startup.run('models', fc.wait_ready)
+    startup.report()
+
+    stop_event = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stop_event.set())
+    try:
+        service.run(stop_event)
+    finally:
+        service.close()
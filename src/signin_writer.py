@@ -0,0 +1,118 @@
+# Background, batched writer for guest sign ins
+
+import threading
+import time
+
+from metrics import metrics
+
+
+class SignInWriteError(Exception):
+    def __init__(self, sign_ins):
+        """
+        Sign ins the writer couldn't write to the guest db, in sign_ins.
+        """
+        super().__init__("{} sign ins could not be written".format(len(sign_ins)))
+        self.sign_ins = sign_ins
+
+
+class SignInWriter:
+    def __init__(self, guestdb, flush_interval=10.0, close_retries=3, retry_delay=1.0):
+        """
+        Queue sign ins in memory and write them to the guest db on a
+        background thread, every flush_interval seconds or when flushed,
+        all pending rows in one executemany transaction. Adding a sign in
+        never touches the db. Rows that fail to write stay queued for the
+        next flush; on close they are retried close_retries times,
+        retry_delay seconds apart, before close raises SignInWriteError.
+        """
+        self.guestdb = guestdb
+        self.flush_interval = flush_interval
+        self.close_retries = close_retries
+        self.retry_delay = retry_delay
+        self.pending = []  # sign in rows not yet written
+        self.cond = threading.Condition()
+        self.requested = 0  # flushes requested, attempted and written
+        self.attempted = 0
+        self.flushed = 0
+        self.stopped = False
+        self.thread = threading.Thread(target=self._run,
+                                       name='SignInWriter',
+                                       daemon=True)
+        self.thread.start()
+
+    def add(self, sign_ins):
+        """
+        Queue sign in rows, dicts of signin table columns.
+        """
+        with self.cond:
+            self.pending.extend(sign_ins)
+
+    def flush(self, wait=False):
+        """
+        Write pending sign ins now. With wait, waits for the write and
+        returns whether it succeeded.
+        """
+        with self.cond:
+            self.requested += 1
+            target = self.requested
+            self.cond.notify_all()
+            if not wait:
+                return None
+            self.cond.wait_for(lambda: self.attempted >= target
+                               or not self.thread.is_alive())
+            return self.flushed >= target
+
+    def close(self):
+        """
+        Write pending sign ins and stop the writer. Raises
+        SignInWriteError with the rows still unwritten after retrying.
+        """
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        self.thread.join()
+        if self.pending:
+            raise SignInWriteError(self.pending)
+
+    def _write(self):
+        """
+        Write the pending rows, returns whether none are left unwritten.
+        """
+        with self.cond:
+            (sign_ins, self.pending) = (self.pending, [])
+        if not sign_ins:
+            return True
+        try:
+            with metrics.timer('db_flush'):
+                self.guestdb.record_sign_ins(sign_ins)
+        except Exception as e:
+            print("[ERROR] Writing {} sign ins failed, retrying on the next "
+                  "flush:".format(len(sign_ins)))
+            print(e)
+            with self.cond:
+                self.pending[:0] = sign_ins
+            return False
+        metrics.count('sign_ins_written', len(sign_ins))
+        return True
+
+    def _run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.stopped or self.requested > self.attempted,
+                                   timeout=self.flush_interval)
+                target = self.requested
+                stopped = self.stopped
+            written = self._write()
+            if stopped:
+                for _ in range(self.close_retries):
+                    if written:
+                        break
+                    time.sleep(self.retry_delay)
+                    written = self._write()
+            with self.cond:
+                self.attempted = target
+                if written:
+                    self.flushed = target
+                self.cond.notify_all()
+            if stopped:
+                break
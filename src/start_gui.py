@@ -1,5 +1,7 @@
 #! /usr/bin/env python
 
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from tkinter import filedialog
 from tkinter import simpledialog
@@ -7,9 +9,9 @@ import configparser
 import copy
 import datetime
 import glob
+import importlib
 import json
 import os
-import pickle
 import re
 import shutil
 import textwrap
@@ -18,13 +20,13 @@ import tkinter as tk
 import uuid
 
 from PIL import ImageTk
-import pandas as pd
 
-from camera import FacialCamera as FC
-from database import SignLog
-from database import SignSS
-from embeddings_train import ModelTrain as mt
-import database
+from metrics import metrics
+from metrics import StartupTimer
+from signin_service import read_password
+from signin_service import SignInService
+from signin_service import unknown_guest_id
+from train_worker import TrainWorker
 
 # Basic variables
 fn_config = 'biometric.cfg'
@@ -37,17 +39,22 @@ gst_identify_on_txt = 'Identifying...'
 
 gst_embed_train_off_txt = 'Embed &\nTrain'
 gst_embed_train_on_txt = 'Embedding &\nTraining...'
-fc = FC()
 
 
 class Application:
-    def __init__(self, pn_output="./"):
+    def __init__(self, fc, pn_output="./", executor=None, startup=None):
         """
         Initialize application which uses OpenCV + Tkinter. It displays
         a video stream in a Tkinter window and stores current snapshot on
-        disk.
+        disk. Capture, identification and sign in are done by a
+        SignInService on the FacialCamera fc, which may be a Future of one
+        still starting on executor while the password is entered. Startup
+        phases are timed by startup.
         """
-
+        self.executor = executor or ThreadPoolExecutor(max_workers=4,
+                                                       thread_name_prefix='Startup')
+        self.startup = startup or StartupTimer()
+        self.fc = fc
         self.pic_num = 0
         self.pn_gstcap_out = None
 
@@ -56,12 +63,9 @@ class Application:
         config.read(fn_config)
         self.pn_guest_images = config['DEFAULT']['pn_guest_images_archive']
         self.image_width = int(config['DEFAULT']['image_width'])
-        self.display_name = config['DEFAULT']['display_name']
-        self.fn_label_encoder = config['DEFAULT']['fn_label_encoder']
-        self.fn_recognizer_model = config['DEFAULT']['fn_recognizer_model']
         self.fn_meal_log_default = config['DEFAULT']['fn_meal_log_default']
         os.makedirs(os.path.dirname(self.fn_meal_log_default), exist_ok=True)
-        self.unknown_guest_id = '00000000-0000-0000-0000-000000000000'
+        self.unknown_guest_id = unknown_guest_id
 
         # Read in data dict:
         fn_datadict = config['DEFAULT']['fn_datadict']
@@ -73,62 +77,41 @@ class Application:
         self.datadict_rev = flip_dict(self.datadict)
         self.datadict_menu_rev = flip_dict(self.datadict_menu)
 
-        # Sign In
-        self.init_sign_in()
-        self.guest_ids = {}
-        self.signin_startstop = {'start_time': None, 'stop_time': None}
-
         # GUI Window initialization
         self.root = tk.Tk()  # initialize root window
         self.root.withdraw()
 
-        # Collect password if not specified in config
+        # Collect password if not specified in the environment or config
         clear_db_history()
         fn_guestdb = config['DEFAULT']['fn_guestdb']
-        if 'pw_guestdb' in config['DEFAULT']:
-            pw_guestdb = config['DEFAULT']['pw_guestdb']
+        pw_guestdb = read_password(config)
+        db_unlocked = False
+        if pw_guestdb is not None:
+            self.guestdb = open_guestdb(pw_guestdb, fn_guestdb)
         else:
-            if os.path.isfile(fn_guestdb):
-                for pw_attempt in range(1, 8):
-                    pw_guestdb = tk.simpledialog.askstring("Biometric Sign In Password",
-                                                           "Please enter the Biometric Sign In password "
-                                                           "(attempt {}/8):".format(pw_attempt),
-                                                           show='*')
-
-                    self.guestdb = database.db(password=pw_guestdb,
-                                               dbname=fn_guestdb)
-
-                    if self.guestdb.test_db_connection():
-                        break
-                    pw_attempt += 1
-            else:  # No db exists, just need two successive PW entries
-                pw_guestdb = ""
-                pw_guestdb_prev = " "
-                while (pw_guestdb != pw_guestdb_prev) or len(pw_guestdb) < 8:
-                    pw_guestdb_prev = tk.simpledialog.askstring("Biometric Sign In Password",
-                                                                "Creating a new database for Biometric Sign In.\n"
-                                                                "Please enter a new password "
-                                                                "(at least 8 characters):",
-                                                                show='*')
-
-                    pw_guestdb = tk.simpledialog.askstring("Biometric Sign In Password",
-                                                           "Please re-enter the same password:",
-                                                           show='*')
-                    if pw_guestdb != pw_guestdb_prev:
-                        tk.messagebox.showinfo(title="Biometric Sign In passwords don't match",
-                                               message="Passwords don't match.\nPlease retry.")
-                    if len(pw_guestdb) < 8:
-                        tk.messagebox.showinfo(title="Biometric Sign In password too short",
-                                               message="Password is less than 8 characters.\nPlease retry.")
-                self.guestdb = database.db(password=pw_guestdb,
-                                           dbname=fn_guestdb)
+            with self.startup.phase('password'):
+                (pw_guestdb, db_unlocked) = self.prompt_password(fn_guestdb)
 
         # Guestdb password is used for guest images archive as well
         self.pw_guestdb = pw_guestdb
-        fc.guest_archive.pw = self.pw_guestdb
+        if isinstance(self.fc, Future):
+            self.fc = self.fc.result()
+        self.fc.guest_archive.pw = self.pw_guestdb
+
+        # Unlock the db and index the guest images archive concurrently
+        # while the models warm up. A wrong password leaves no archive
+        # index behind, see p7zip.rebuild_index
+        db_exists = os.path.isfile(fn_guestdb)
+        if db_exists and not db_unlocked:
+            db_unlock = self.executor.submit(self.startup.run, 'db_unlock',
+                                             self.guestdb.test_db_connection)
+        archive_index = self.executor.submit(self.startup.run, 'archive_index',
+                                             self.fc.guest_archive.load_index)
+        self.models_ready = self.executor.submit(self.startup.run, 'models',
+                                                 self.fc.wait_ready)
 
         # Create db if it doesn't exist:
-        if not os.path.isfile(fn_guestdb):
+        if not db_exists:
             print('[INFO] No prior {} database found, re-initializing.'
                   .format(fn_guestdb))
             self.guestdb.create_db_tables()
@@ -141,17 +124,20 @@ class Application:
                              'ethnicity': 'Guest refused',
                              'gender': 'Guest refused',
                              'fr_id': self.unknown_guest_id}
+            import database
             guest_meta = database.hmisv17_newguestdiag(unknown_guest,
                                                        self.datadict_menu_rev)
             self.guestdb.add_guest(guest_meta)
-        else:  # Check db pw is correct before proceeding
-            if not self.guestdb.test_db_connection():
+        elif not db_unlocked:  # Check db pw is correct before proceeding
+            if not db_unlock.result():
                 tk.messagebox.showinfo(title="Incorrect Biometric Sign In Password", message="Incorrect Biometric Sign In password, closing.")
-                self.destructor
+                self.destructor()
                 exit(1)
+        self.executor.submit(self.startup.run, 'db_pool', self.guestdb.warm_pool)
+        archive_index.result()
 
         # Create guest_images archive if it doesn't exist:
-        if not os.path.isfile(fc.guest_archive.fn_archive):
+        if not os.path.isfile(self.fc.guest_archive.fn_archive):
             unknown_guest_img_path = tk.filedialog.askdirectory(parent=self.root,
                                                                 initialdir=os.getcwd(),
                                                                 title='Please select a directory for unknown guest images.')
@@ -160,18 +146,22 @@ class Application:
             # Create a temp directory for unknown guest images so the
             # archive is structured correctly:
             print('[INFO] Creating {} and storing unknown guest faces...'
-                  .format(fc.guest_archive.fn_archive))
+                  .format(self.fc.guest_archive.fn_archive))
             os.makedirs(self.unknown_guest_id,
                         exist_ok=True)
             [shutil.copy(x, os.path.join(self.unknown_guest_id,
                                          os.path.basename(x))) for x in pns_unknown_guest_img]
             pns_unknown_guest_img_copy = glob.glob(os.path.join(self.unknown_guest_id,
                                                                 '*'))
-            fc.guest_archive.add_file(pns_unknown_guest_img_copy)
+            self.fc.guest_archive.add_file(pns_unknown_guest_img_copy)
             shutil.rmtree(os.path.join(unknown_guest_img_path,
                                        self.unknown_guest_id),
                           ignore_errors=True)
 
+        # Save captures left unsaved by a previous run
+        self.fc.capture_writer.recover()
+        self.service = SignInService(self.fc, self.guestdb, config)
+
         # Refocus on main window
         self.root.deiconify()
         self.root.title("Biometric Sign In")  # set window title
@@ -180,9 +170,7 @@ class Application:
         self.root.protocol('WM_DELETE_WINDOW', self.destructor)
 
         # Check for faces in unknown folder
-        fns_unknown_guest = fc.guest_archive.list_files()
-        fns_unknown_guest = [x for x in fns_unknown_guest
-                             if os.path.dirname(x) == self.unknown_guest_id]
+        fns_unknown_guest = self.fc.guest_archive.guest_files(self.unknown_guest_id)
         if not fns_unknown_guest:
             tk.messagebox.showwarning(
                 "No Unknown Images",
@@ -198,6 +186,7 @@ class Application:
         self.b_capture_text = [gst_capture_off_txt]
         self.b_identify_text = [gst_identify_off_txt]
         self.b_encode_text = [gst_embed_train_off_txt]
+        self.train_worker = None  # Background Embed & Train
 
         # Buttons
         self.b_capture = tk.Button(self.root,
@@ -239,54 +228,86 @@ class Application:
         # Start a self.video_loop that constantly polls the video sensor
         # for the most recently read frame
         self.video_loop()
+        self.startup_poll()
+
+    def prompt_password(self, fn_guestdb):
+        """
+        Ask for the password of the existing guest db until it unlocks, or
+        twice for a new one. Returns (password, whether the db unlocked).
+        """
+        db_unlocked = False
+        if os.path.isfile(fn_guestdb):
+            for pw_attempt in range(1, 8):
+                pw_guestdb = tk.simpledialog.askstring("Biometric Sign In Password",
+                                                       "Please enter the Biometric Sign In password "
+                                                       "(attempt {}/8):".format(pw_attempt),
+                                                       show='*')
+
+                self.guestdb = open_guestdb(pw_guestdb, fn_guestdb)
+
+                with self.startup.phase('db_unlock'):
+                    db_unlocked = self.guestdb.test_db_connection()
+                if db_unlocked:
+                    break
+                pw_attempt += 1
+        else:  # No db exists, just need two successive PW entries
+            pw_guestdb = ""
+            pw_guestdb_prev = " "
+            while (pw_guestdb != pw_guestdb_prev) or len(pw_guestdb) < 8:
+                pw_guestdb_prev = tk.simpledialog.askstring("Biometric Sign In Password",
+                                                            "Creating a new database for Biometric Sign In.\n"
+                                                            "Please enter a new password "
+                                                            "(at least 8 characters):",
+                                                            show='*')
+
+                pw_guestdb = tk.simpledialog.askstring("Biometric Sign In Password",
+                                                       "Please re-enter the same password:",
+                                                       show='*')
+                if pw_guestdb != pw_guestdb_prev:
+                    tk.messagebox.showinfo(title="Biometric Sign In passwords don't match",
+                                           message="Passwords don't match.\nPlease retry.")
+                if len(pw_guestdb) < 8:
+                    tk.messagebox.showinfo(title="Biometric Sign In password too short",
+                                           message="Password is less than 8 characters.\nPlease retry.")
+            self.guestdb = open_guestdb(pw_guestdb, fn_guestdb)
+        return pw_guestdb, db_unlocked
+
+    def startup_poll(self):
+        """
+        Report the startup time breakdown once the models are warmed up.
+        """
+        if not self.models_ready.done():
+            self.root.after(100, self.startup_poll)
+            return
+        self.startup.report()
 
     def video_loop(self):
         """
         Get frame from the video stream and show it in Tkinter.
         """
-        curr_pic, orig_pic = fc.query_camera()
+        curr_pic, orig_pic = self.fc.query_camera()
 
         if curr_pic is not None:
-            if fc.gst_capture:  # Capture images for training
-                curr_pic = fc.guest_capture_func(orig_pic, curr_pic)
-            elif fc.gst_identify:  # Identify individuals
-                curr_pic = fc.guest_identify_func(curr_pic)
-
-                # Append new guest ids:
-                self.guest_ids = fc.guest_ids
-                # Drop 'unknown' guest id:
-                self.guest_ids.pop(self.unknown_guest_id, None)
-                # Drop users already signed in:
-                if not self.sign_in.empty:
-                    for curr_id in self.sign_in['fr_id']:
-                        self.guest_ids.pop(curr_id, None)
-
-                if self.guest_ids:
-                    self.sign_in = self.sign_in.append(pd.DataFrame({'fr_id': list(self.guest_ids.keys()),
-                                                                     'class_prob': list(self.guest_ids.values()),
-                                                                     'time': datetime.datetime.now(),
-                                                                     'first_time': 0}))
-            else:  # Not doing anything crazy or cool, just showing webcam
-                pass
+            # Capture or identify and sign in guests, otherwise just show
+            # the webcam
+            curr_pic = self.service.process_frame(curr_pic, orig_pic)
 
             # Reset buttons
-            if not fc.gst_capture:
+            if not self.fc.gst_capture:
                 self.b_capture['text'] = gst_capture_off_txt
-            if not fc.gst_identify:
+            if not self.fc.gst_identify:
                 self.b_identify['text'] = gst_identify_off_txt
 
             # Record ids in image:
-            self.curr_pic = fc.convert_imgpil(curr_pic)
-            imgtk = ImageTk.PhotoImage(image=self.curr_pic)  # convert image for tkinter
-            self.panel.imgtk = imgtk  # anchor imgtk so it does not be deleted by garbage-collector
-            self.panel.config(image=imgtk)  # show the image
-
-            # Poll every 10 seconds to write to db:
-            elap_seconds = time.time() - fc.save_time
-            if elap_seconds > 10 and fc.gst_identify:
-                self.update_signin()
-                #    #self.fps.update()
-                #    #print("[INFO] approx. FPS: {:.2f}".format(self.fps.fps()))
+            self.curr_pic = self.fc.convert_imgpil(curr_pic)
+            with metrics.timer('tk_display'):
+                imgtk = getattr(self.panel, 'imgtk', None)
+                if imgtk is not None and (imgtk.width(), imgtk.height()) == self.curr_pic.size:
+                    imgtk.paste(self.curr_pic)  # update the shown image in place
+                else:
+                    imgtk = ImageTk.PhotoImage(image=self.curr_pic)  # convert image for tkinter
+                    self.panel.imgtk = imgtk  # anchor imgtk so it does not be deleted by garbage-collector
+                    self.panel.config(image=imgtk)  # show the image
 
         self.root.after(30, self.video_loop)  # call the same function after 30 milliseconds
 
@@ -300,23 +321,16 @@ class Application:
         self.b_capture['text'] = self.b_capture_text[0]
         if self.b_capture['text'] == gst_capture_off_txt:
             print('[INFO] Stopped repetitive image capture.')
-            fc.gst_capture = False
+            self.fc.stop_capture()
 
         elif self.b_capture['text'] == gst_capture_on_txt:
             # Determine new guest ID for internal biometric purpose only
             gst_id = str(uuid.uuid4())
             print('[INFO] Starting new guest intake and repetitive image capture...')
-            fc.gst_capture = True
-
-            # Reset FacialCamera variables:
-            fc.start_time = time.time()
-            fc.pic_num = 0
-            fc.capture_time_prev = time.time()
-
-            fc.pn_gstcap_out = gst_id
+            self.fc.start_capture(gst_id)
 
             # Reset Sign In Dataframe Initialization:
-            self.init_sign_in()
+            self.service.init_sign_in()
 
             # Capture new guest information
             guest_meta = NewGuestDialog(self.root,
@@ -325,9 +339,11 @@ class Application:
 
             if not guest_meta:
                 print('[INFO] Canceled new guest intake.')
+                self.fc.stop_capture(discard=True)
                 self.guest_capture_init()
                 return
 
+            import database
             guest_meta = database.hmisv17_newguestdiag(guest_meta,
                                                        self.datadict_menu_rev)
             guest_meta['fr_id'] = gst_id
@@ -335,39 +351,9 @@ class Application:
             self.guestdb.add_guest(guest_meta)
             print('[INFO] User {} added to db.'.format(guest_meta['fr_id']))
             # Update SignLog
-            self.init_sign_in()
-            self.sign_in = self.sign_in.append(pd.DataFrame({'fr_id': [gst_id],
-                                                             'class_prob': [1.0],
-                                                             'time': [datetime.datetime.now()],
-                                                             'first_time': [first_time]}))
-            self.update_signin()
-
-    def init_sign_in(self):
-        """
-        Initialize the sign in dataframe using columns from the SignLog
-        table.
-        """
-        self.sign_in = pd.DataFrame(columns=SignLog.__table__.columns.keys()[1:])
-        self.sign_in_saved = self.sign_in.copy()
-
-        self.signin_startstop = dict(zip(SignSS.__table__.columns.keys(),
-                                         [None for x in SignSS.__table__.columns.keys()]))
-
-    def update_signin(self):
-        """
-        Update database with those who have signed in.
-        """
-        new_fr_id = (set(self.sign_in['fr_id'])
-                     - set(self.sign_in_saved['fr_id']))
-        sign_in_tosave = self.sign_in[self.sign_in['fr_id'].isin(new_fr_id)]
-
-        if not sign_in_tosave.empty:
-            print("[INFO] Updating db with signed in guests...", end='')
-            self.guestdb.record_guest(sign_in_tosave)
-            self.sign_in_saved = self.sign_in
-            print('done.')
-
-        fc.save_time = time.time()
+            self.service.init_sign_in()
+            self.service.add_sign_ins({gst_id: 1.0}, first_time=first_time)
+            self.service.update_signin()
 
     def guest_identify_init(self):
         """
@@ -378,49 +364,19 @@ class Application:
         self.b_identify_text[0] = b_identify_idx_dict[self.b_identify_text[0]]
         self.b_identify['text'] = self.b_identify_text[0]
         if self.b_identify['text'] == gst_identify_off_txt:
-            print('[INFO] Stopped identification.')
-            fc.gst_identify = False
-            self.update_signin()
-            if self.signin_startstop['start_time']:
-                self.signin_startstop['stop_time'] = datetime.datetime.now()
-                self.guestdb.record_startstop(self.signin_startstop)
+            self.service.stop_identify()
         elif self.b_identify['text'] == gst_identify_on_txt:
             # Check for trained models first
-            if (not os.path.exists(self.fn_label_encoder)
-                    or not os.path.exists(self.fn_recognizer_model)):
+            if not self.service.start_identify():
                 tk.messagebox.showwarning(
                     "Embed & Train Needed",
                     "No guests specific models present.\n"
                     "Please run \"Embed & Train\" on precaptured guests.",
                     parent=self.root
                 )
-                print('[INFO] No guest specific models present.')
                 self.guest_identify_init()
                 return
 
-            # Load prev captured guest metadata:
-            known_guest_meta = self.guestdb.query_allguestmeta()
-            if self.display_name in known_guest_meta.columns:
-                fc.known_guest_meta = known_guest_meta[self.display_name]
-            else:
-                print('[ERROR]: No user information corresponding to {}. '
-                      'Valid options are:\n{}'
-                      .format(self.display_name, known_guest_meta.columns))
-                fc.known_guest_meta = None
-
-            print('[INFO] Starting identification...')
-            fc.gst_identify = True
-            print('[INFO] Loading guests previously captured')
-            # load the actual face recognition model along with the label encoder
-            fc.recognizer = pickle.loads(open(self.fn_recognizer_model, "rb").read())
-            fc.label_encoder = pickle.loads(open(self.fn_label_encoder, "rb").read())
-
-            fc.save_time = time.time()
-            self.init_sign_in()
-            self.guest_ids = {}
-            self.signin_startstop['start_time'] = datetime.datetime.now()
-            self.guestdb.record_startstop(self.signin_startstop)
-
     def remove_guestcapture_notindb(self):
         """
         Remove folders for users that don't have entries in the db.
@@ -444,30 +400,71 @@ class Application:
         Users are effectively anonymous.
         """
         db_guest_ids = self.guestdb.query_allguestmeta().index
-        id_folders = [os.path.dirname(x) for x in
-                      fc.guest_archive.list_files()]
-        id_folders = [x for x in id_folders if x not in ['']]
+        id_folders = self.fc.guest_archive.guest_ids()
 
         del_folders = set(id_folders) - set(db_guest_ids)
         if del_folders:
             print('[INFO] removing {} capture folder(s) that don\'t correspond '
                   'to guests captured in the "clients" db table.'
                   .format(len(del_folders)))
-            [fc.guest_archive.remove_folder(pn) for pn in del_folders]
+            [self.fc.guest_archive.remove_folder(pn) for pn in del_folders]
 
     def embed_train_init(self):
         """
-        Obtain image embeddings and train model.
+        Obtain image embeddings and train model in a background process,
+        or offer to cancel a run in progress.
         """
+        if self.train_worker is not None:
+            if tk.messagebox.askyesno("Cancel Embed & Train",
+                                      "Cancel embedding and training?\n"
+                                      "Images embedded so far are kept.",
+                                      parent=self.root):
+                print('[INFO] Cancelling image embeddings and training...')
+                self.train_worker.cancel()
+            return
+
         print('[INFO] Checking for guests not in db...')
         self.remove_guestcapture_notindb_archive()
-        print('[INFO] Running image embeddings...')
-        embed_train = mt()
-        embed_train.guest_archive.pw = self.pw_guestdb
-        embed_train.extract_embeddings()
-        print('[INFO] Training SVM model over embeddings...')
-        embed_train.train_model()
-        print('[INFO] Image embeddings and SVM model training complete.')
+        self.fc.capture_writer.flush()  # Include captures still being saved
+        print('[INFO] Running image embeddings and model training...')
+        self.train_worker = TrainWorker().start(self.pw_guestdb)
+        self.b_encode['text'] = gst_embed_train_on_txt
+        self.embed_train_poll()
+
+    def embed_train_poll(self):
+        """
+        Show Embed & Train progress on its button and swap in the new models
+        once it finishes.
+        """
+        status = self.train_worker.poll()
+        elapsed = time.strftime('%M:%S', time.gmtime(self.train_worker.elapsed()))
+        if status is None or status['stage'] == 'embed':
+            pct = (100 * status['done'] // status['total']
+                   if status and status['total'] else 0)
+            self.b_encode['text'] = 'Embedding {}%\n{}'.format(pct, elapsed)
+        elif status['stage'] == 'train':
+            self.b_encode['text'] = 'Training...\n{}'.format(elapsed)
+
+        if not self.train_worker.finished():
+            self.root.after(500, self.embed_train_poll)
+            return
+
+        if status['stage'] == 'done':
+            print('[INFO] Image embeddings and model training complete in {}.'
+                  .format(elapsed))
+            if self.fc.gst_identify:
+                print('[INFO] Loading the new models...')
+                self.fc.swap_recognition_models(*status['models'])
+        elif status['stage'] == 'cancelled':
+            print('[INFO] Image embeddings and model training cancelled.')
+        else:
+            print('[ERROR] Image embeddings and model training failed:')
+            print(status['error'])
+            tk.messagebox.showerror("Embed & Train Failed",
+                                    "Embedding and training failed, "
+                                    "see the log for details.",
+                                    parent=self.root)
+        self.train_worker = None
         self.b_encode['text'] = gst_embed_train_off_txt
 
     def init_meal_log(self):
@@ -484,9 +481,14 @@ class Application:
         Destroy the root object and release all resources.
         """
         print("[INFO] closing...")
+        if getattr(self, 'train_worker', None) is not None:
+            self.train_worker.stop()
         clear_db_history()
         self.root.destroy()
-        fc.destructor()
+        if hasattr(self, 'service'):
+            self.service.close()  # Writes outstanding sign ins
+        else:
+            self.fc.destructor()
 
 
 def flip_dict(data_dict):
@@ -698,6 +700,8 @@ class ExportMealLogDialog(simpledialog.Dialog):
     Define a pop up window that collects new guest information.
     """
     def __init__(self, *args, guestdb, fn_meal_log_default, **kwargs):
+        import pandas as pd
+
         self.guestdb = guestdb
         self.df_startstop = guestdb.query_startstop()
         self.df_startstop['start_time_opt'] = self.df_startstop['start_time'].apply(lambda x: x.strftime('%m/%d/%Y %I:%M %p')
@@ -850,6 +854,32 @@ class ExportMealLogDialog(simpledialog.Dialog):
         return 1
 
 
+def open_guestdb(password, fn_guestdb):
+    """
+    Guest db at fn_guestdb. database imports pandas and sqlalchemy, which
+    are slow to import, so it is imported on first use and preloaded on a
+    startup thread meanwhile.
+    """
+    import database
+    return database.db(password=password, dbname=fn_guestdb)
+
+
+def open_camera():
+    """
+    FacialCamera, imported here as cv2 and numpy are slow to import too.
+    """
+    from camera import FacialCamera
+    return FacialCamera()
+
+
+def preload_modules(names=('pandas', 'sqlalchemy', 'database')):
+    """
+    Import modules ahead of their first use, e.g. on a startup thread.
+    """
+    for name in names:
+        importlib.import_module(name)
+
+
 def clear_db_history():
     """
     Clear database history (secure pw and user info).
@@ -864,5 +894,12 @@ def clear_db_history():
 if __name__ == "__main__":
     # Run script
     print("[INFO] starting...")
-    app = Application()
+    # Created here rather than on import so spawned worker processes,
+    # which re-import this module, don't open the camera. The camera and
+    # models start and the db modules import while the password is entered
+    startup = StartupTimer()
+    executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='Startup')
+    fc = executor.submit(startup.run, 'camera', open_camera)
+    executor.submit(startup.run, 'imports', preload_modules)
+    app = Application(fc, executor=executor, startup=startup)
     app.root.mainloop()
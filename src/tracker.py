@@ -0,0 +1,185 @@
+# Cheap face tracking between detections
+
+from collections import Counter
+from collections import deque
+import itertools
+
+import numpy as np
+
+
+def box_iou(boxes_a, boxes_b):
+    """
+    Pairwise intersection over union of (x_start, y_start, x_end, y_end)
+    boxes. Returns a (len(boxes_a), len(boxes_b)) array.
+    """
+    boxes_a = np.asarray(boxes_a, dtype=float).reshape(-1, 4)
+    boxes_b = np.asarray(boxes_b, dtype=float).reshape(-1, 4)
+    x_start = np.maximum(boxes_a[:, None, 0], boxes_b[None, :, 0])
+    y_start = np.maximum(boxes_a[:, None, 1], boxes_b[None, :, 1])
+    x_end = np.minimum(boxes_a[:, None, 2], boxes_b[None, :, 2])
+    y_end = np.minimum(boxes_a[:, None, 3], boxes_b[None, :, 3])
+    inter = np.clip(x_end - x_start, 0, None) * np.clip(y_end - y_start, 0, None)
+    area_a = (boxes_a[:, 2] - boxes_a[:, 0]) * (boxes_a[:, 3] - boxes_a[:, 1])
+    area_b = (boxes_b[:, 2] - boxes_b[:, 0]) * (boxes_b[:, 3] - boxes_b[:, 1])
+    union = area_a[:, None] + area_b[None, :] - inter
+    return inter / np.maximum(union, 1e-9)
+
+
+class FaceTrack:
+    def __init__(self, track_id, bound_box, frame_num, vote_len):
+        """
+        A face followed across frames, with the recognizer votes
+        collected for it so far.
+        """
+        self.track_id = track_id
+        self.bound_box = np.asarray(bound_box, dtype=float)
+        self.det_box = self.bound_box.copy()  # Box at the last detection
+        self.det_frame = frame_num
+        self.velocity = np.zeros(4)  # Box change per frame
+        self.votes = deque(maxlen=vote_len)
+        self.guest_id = None  # Set once confidently identified
+        self.prob = 0.0
+        self.misses = 0
+
+    def predict(self, frame_num):
+        """
+        Extrapolate the box for a frame without a detection.
+        """
+        self.bound_box = self.det_box + self.velocity * (frame_num - self.det_frame)
+
+    def update(self, bound_box, frame_num):
+        """
+        Move the track to a newly detected box.
+        """
+        bound_box = np.asarray(bound_box, dtype=float)
+        frames_elapsed = max(frame_num - self.det_frame, 1)
+        self.velocity = (bound_box - self.det_box) / frames_elapsed
+        self.bound_box = bound_box
+        self.det_box = bound_box.copy()
+        self.det_frame = frame_num
+        self.misses = 0
+
+    @property
+    def needs_embedding(self):
+        return self.guest_id is None
+
+    @property
+    def voting(self):
+        """
+        Still collecting the first round of votes.
+        """
+        return self.guest_id is None and len(self.votes) < self.votes.maxlen
+
+
+class FaceTracker:
+    def __init__(self, iou_thresh=0.3, max_misses=2, vote_len=5, vote_min=3,
+                 min_recog_prob=0.0):
+        """
+        Follow faces between detections with an IoU tracker that falls back
+        to centroid distance, and cache each track's identity once enough
+        recognizer votes agree.
+        """
+        self.iou_thresh = iou_thresh
+        self.max_misses = max_misses
+        self.vote_len = vote_len
+        self.vote_min = vote_min
+        self.min_recog_prob = min_recog_prob
+        self.reset()
+
+    def reset(self):
+        self.tracks = []
+        self.frame_num = 0
+        self.track_ids = itertools.count()
+
+    def step(self):
+        """
+        Advance one frame, extrapolating every track's box.
+        """
+        self.frame_num += 1
+        for track in self.tracks:
+            track.predict(self.frame_num)
+
+    def update(self, bound_boxes):
+        """
+        Match detected boxes to tracks, greedily by IoU then by centroid
+        distance. Unmatched detections start new tracks and tracks missed
+        more than max_misses detections in a row are dropped.
+        Returns the tracks matched to bound_boxes, in the same order.
+        """
+        bound_boxes = np.asarray(bound_boxes, dtype=float).reshape(-1, 4)
+        matches = {}  # detection index: track
+        free_tracks = list(self.tracks)
+
+        if free_tracks and len(bound_boxes):
+            ious = box_iou(bound_boxes,
+                           [track.bound_box for track in free_tracks])
+            for det_ind, track_ind in zip(*np.unravel_index(np.argsort(-ious, axis=None),
+                                                            ious.shape)):
+                if ious[det_ind, track_ind] < self.iou_thresh:
+                    break
+                track = free_tracks[track_ind]
+                if det_ind in matches or track in matches.values():
+                    continue
+                matches[det_ind] = track
+
+            # Fall back to centroid distance for fast moving faces
+            for det_ind in range(len(bound_boxes)):
+                if det_ind in matches:
+                    continue
+                det_center = (bound_boxes[det_ind, :2] + bound_boxes[det_ind, 2:]) / 2
+                best_track, best_dist = None, None
+                for track in free_tracks:
+                    if track in matches.values():
+                        continue
+                    track_center = (track.bound_box[:2] + track.bound_box[2:]) / 2
+                    track_size = np.max(track.bound_box[2:] - track.bound_box[:2])
+                    dist = np.linalg.norm(det_center - track_center)
+                    if dist < 0.5 * track_size and (best_dist is None or dist < best_dist):
+                        best_track, best_dist = track, dist
+                if best_track is not None:
+                    matches[det_ind] = best_track
+
+        matched_tracks = []
+        for det_ind, bound_box in enumerate(bound_boxes):
+            if det_ind in matches:
+                track = matches[det_ind]
+                track.update(bound_box, self.frame_num)
+            else:
+                track = FaceTrack(next(self.track_ids),
+                                  bound_box,
+                                  self.frame_num,
+                                  self.vote_len)
+                self.tracks.append(track)
+            matched_tracks.append(track)
+
+        for track in self.tracks:
+            if track not in matched_tracks:
+                track.misses += 1
+        self.tracks = [track for track in self.tracks
+                       if track.misses <= self.max_misses]
+        return matched_tracks
+
+    def add_vote(self, track, guest_id, prob, signed_in_ids=()):
+        """
+        Record a recognizer prediction for a track. The track's identity is
+        fixed once vote_min confident votes agree, or as soon as the leading
+        identity has already signed in.
+        """
+        track.votes.append((guest_id, prob))
+        confident = [(vote_id, vote_prob) for (vote_id, vote_prob) in track.votes
+                     if vote_prob >= self.min_recog_prob]
+        if not confident:
+            return
+
+        lead_id, count = Counter(vote_id for (vote_id, _) in confident).most_common(1)[0]
+        if count >= self.vote_min or lead_id in signed_in_ids:
+            track.guest_id = lead_id
+            track.prob = float(np.mean([vote_prob for (vote_id, vote_prob) in confident
+                                        if vote_id == lead_id]))
+
+    def identities(self):
+        """
+        Return {guest_id: prob} for identified tracks.
+        """
+        return {track.guest_id: round(track.prob, 4) for track in self.tracks
+                if track.guest_id is not None}
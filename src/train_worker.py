@@ -0,0 +1,106 @@
+# Out-of-process embedding and model training
+
+import multiprocessing as mp
+import queue
+import time
+import traceback
+
+
+def _train_main(pw, status, cancel):
+    """
+    Training process: embed archived images and train the recognizer,
+    reporting progress on the status queue.
+    """
+    # Imported here so the GUI process never loads scikit-learn for this
+    from embeddings_train import ModelTrain
+    from embeddings_train import TrainCancelled
+
+    try:
+        embed_train = ModelTrain()
+        embed_train.guest_archive.pw = pw
+        status.put({'stage': 'embed', 'done': 0, 'total': 0})
+        embed_train.extract_embeddings(
+            progress=lambda done, total: status.put({'stage': 'embed',
+                                                     'done': done,
+                                                     'total': total}),
+            cancel=cancel)
+        status.put({'stage': 'train'})
+        version = embed_train.train_model(cancel=cancel)
+        status.put({'stage': 'done',
+                    'models': (embed_train.pn_model_store, version)})
+    except TrainCancelled:
+        status.put({'stage': 'cancelled'})
+    except Exception:
+        status.put({'stage': 'error', 'error': traceback.format_exc()})
+
+
+class TrainWorker:
+    def __init__(self):
+        """
+        Run Embed & Train in a separate process so the camera and GUI keep
+        running. poll() returns the latest status: a dict with 'stage' of
+        'embed' (with 'done' and 'total' images), 'train', 'done' (with
+        'models', the model store and version trained), 'cancelled' or
+        'error'.
+        """
+        ctx = mp.get_context('spawn')  # Don't fork the Tk/camera threads
+        self.status = ctx.Queue()
+        self.cancel_event = ctx.Event()
+        self.ctx = ctx
+        self.process = None
+        self.start_time = None
+        self.latest = None
+
+    def start(self, pw):
+        # Not a daemon, which couldn't start the embedding pool; the
+        # application's destructor ends it with stop()
+        self.process = self.ctx.Process(target=_train_main,
+                                        args=(pw, self.status, self.cancel_event),
+                                        name='TrainWorker')
+        self.start_time = time.monotonic()
+        self.process.start()
+        return self
+
+    def elapsed(self):
+        return time.monotonic() - self.start_time
+
+    def cancel(self):
+        """
+        Ask the worker to stop, images embedded so far stay cached.
+        """
+        self.cancel_event.set()
+
+    def finished(self):
+        return (self.latest is not None
+                and self.latest['stage'] in ('done', 'cancelled', 'error'))
+
+    def poll(self):
+        """
+        Return the newest status without waiting.
+        """
+        while True:
+            try:
+                self.latest = self.status.get_nowait()
+            except queue.Empty:
+                break
+        if not self.finished() and not self.process.is_alive():
+            try:  # Pick up a final status still in flight
+                self.latest = self.status.get(timeout=1.0)
+                return self.poll()
+            except queue.Empty:
+                pass
+            self.latest = {'stage': 'error',
+                           'error': 'Training process exited with code {}'
+                                    .format(self.process.exitcode)}
+        return self.latest
+
+    def stop(self, timeout=10.0):
+        """
+        Cancel and wait for the worker, terminating it if it doesn't stop.
+        """
+        if self.process is None:
+            return
+        self.cancel()
+        self.process.join(timeout=timeout)
+        if self.process.is_alive():
+            self.process.terminate()
@@ -0,0 +1,91 @@
+import os
+
+import numpy as np
+
+from embedding_cache import EmbeddingCache
+
+
+class PlainArchive:
+    """
+    Stands in for p7zip's blob storage, without encryption.
+    """
+    def write_bytes(self, fn_blob, name, data):
+        with open(fn_blob + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(fn_blob + '.tmp', fn_blob)
+        return True
+
+    def read_bytes(self, fn_blob, name):
+        if not os.path.isfile(fn_blob):
+            return None
+        with open(fn_blob, 'rb') as f:
+            return f.read()
+
+
+def make_cache(tmp_path, settings=None):
+    return EmbeddingCache(PlainArchive(), str(tmp_path / 'cache.npz.7z'),
+                          settings or {'resize_width': 600})
+
+
+def add_entries(cache, keys):
+    for key in keys:
+        cache.add(key, np.array([1, 2, 3, 4]), 0.9, np.full(128, len(key), dtype=np.float32))
+
+
+def test_resume_from_checkpoints(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.load()
+    add_entries(cache, ['a:1', 'b:2'])
+    assert cache.save()
+    add_entries(cache, ['c:3'])
+    assert cache.checkpoint()
+    add_entries(cache, ['d:4'])
+    assert cache.checkpoint()
+
+    resumed = make_cache(tmp_path)
+    resumed.load()
+    assert set(resumed.entries) == {'a:1', 'b:2', 'c:3', 'd:4'}
+    assert not resumed.pending
+    # Nothing new, so no new part file
+    assert resumed.checkpoint()
+    assert len(resumed.part_files()) == 2
+
+    assert resumed.save()
+    assert resumed.part_files() == []
+    reloaded = make_cache(tmp_path)
+    reloaded.load()
+    assert set(reloaded.entries) == {'a:1', 'b:2', 'c:3', 'd:4'}
+    np.testing.assert_array_equal(reloaded.get('c:3')[2], np.full(128, 3))
+
+
+def test_resume_after_settings_change(tmp_path):
+    old = make_cache(tmp_path, {'resize_width': 600})
+    old.load()
+    add_entries(old, ['a:1'])
+    assert old.save()
+
+    # An interrupted re-embed with new settings
+    new = make_cache(tmp_path, {'resize_width': 800})
+    new.load()
+    assert len(new) == 0
+    add_entries(new, ['b:2'])
+    assert new.checkpoint()
+
+    resumed = make_cache(tmp_path, {'resize_width': 800})
+    resumed.load()
+    assert set(resumed.entries) == {'b:2'}
+    assert resumed.save()
+    assert resumed.part_files() == []
+
+
+def test_save_keeps_parts_of_other_settings(tmp_path):
+    other = make_cache(tmp_path, {'resize_width': 800})
+    other.load()
+    add_entries(other, ['b:2'])
+    assert other.checkpoint()
+
+    cache = make_cache(tmp_path, {'resize_width': 600})
+    cache.load()
+    add_entries(cache, ['a:1'])
+    assert cache.save()
+    assert len(cache.part_files()) == 1
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+from embedding_index import EmbeddingIndex, normalize_rows
+
+
+def brute_force(X, labels, Q, k):
+    sims = normalize_rows(Q) @ normalize_rows(X).T
+    rows = np.argsort(-sims, axis=1)[:, :k]
+    return np.take_along_axis(sims, rows, axis=1), labels[rows]
+
+
+@pytest.mark.parametrize('int8', [False, True])
+def test_exact_matches_brute_force(int8):
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(1000, 32))
+    labels = np.arange(len(X), dtype=np.int32)
+    Q = rng.normal(size=(20, 32))
+    index = EmbeddingIndex(int8=int8, block_size=128)
+    index.build(X, labels)
+    sims, found = index.search(Q, k=5)
+    expected_sims, expected = brute_force(X, labels, Q, 5)
+    tol = 0.02 if int8 else 1e-5
+    assert np.allclose(sims, expected_sims, atol=tol)
+    if not int8:
+        assert np.array_equal(found, expected)
+    else:
+        assert np.mean(found[:, 0] == expected[:, 0]) >= 0.9
+
+
+def test_int8_view_follows_add_and_remove():
+    rng = np.random.default_rng(1)
+    X = rng.normal(size=(300, 16))
+    index = EmbeddingIndex(int8=True, block_size=64)
+    index.build(X[:200], np.arange(200, dtype=np.int32))
+    index.search(X[:1], k=1)
+    index.add(X[200:], np.arange(200, 300, dtype=np.int32))
+    _, found = index.search(X[250:260], k=1)
+    assert np.array_equal(found[:, 0], np.arange(250, 260))
+    index.remove(np.arange(250, 260))
+    _, found = index.search(X[250:260], k=1)
+    assert not np.isin(found[:, 0], np.arange(250, 260)).any()
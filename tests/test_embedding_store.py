@@ -0,0 +1,23 @@
+import os
+
+import numpy as np
+
+from embedding_store import EmbeddingStore, fn_meta
+
+
+def test_delete_guests_writes_meta_once(tmp_path):
+    store = EmbeddingStore(str(tmp_path / 'store'), dim=4)
+    store.append(['a', 'a', 'b', 'c'], np.eye(4),
+                 guest_digests={'a': '1', 'b': '2', 'c': '3'})
+    fn = os.path.join(store.pn_store, fn_meta)
+    os.utime(fn, ns=(0, 0))
+
+    assert store.delete_guests(['x']) == 0
+    assert os.stat(fn).st_mtime_ns == 0
+
+    assert store.delete_guests(['a', 'c']) == 3
+    assert os.stat(fn).st_mtime_ns != 0
+    (vectors, guest_ids) = EmbeddingStore(store.pn_store, dim=4).arrays()
+    assert list(guest_ids) == ['b']
+    assert np.array_equal(vectors, np.eye(4)[2:3])
+    assert store.guest_digest('a') is None
@@ -0,0 +1,51 @@
+import os
+
+import numpy as np
+import pytest
+from sklearn.preprocessing import LabelEncoder
+
+from embedding_index import normalize_rows
+from model_store import fn_latest
+from model_store import ModelStore
+from recognizers import CentroidRecognizer
+from recognizers import KNNRecognizer
+
+
+def make_models(recognizer, n_guests=6, per_guest=4):
+    rng = np.random.default_rng(0)
+    centers = normalize_rows(rng.normal(size=(n_guests, 16)))
+    X = normalize_rows(np.repeat(centers, per_guest, axis=0)
+                       + 0.1 * rng.normal(size=(n_guests * per_guest, 16)))
+    guest_ids = np.array(['guest{}'.format(i) for i in range(n_guests)
+                          for _ in range(per_guest)], dtype=object)
+    recognizer.fit(X, guest_ids)
+    label_encoder = LabelEncoder().fit(recognizer.classes_)
+    return recognizer, label_encoder, X
+
+
+@pytest.mark.parametrize('recognizer', [CentroidRecognizer(), KNNRecognizer(k=3)])
+def test_round_trip(tmp_path, recognizer):
+    (recognizer, label_encoder, X) = make_models(recognizer)
+    store = ModelStore(str(tmp_path / 'models'))
+    version = store.publish(recognizer, label_encoder, len(label_encoder.classes_),
+                            probe=X[::4])
+    formats = store.manifest(version)['formats']
+    assert formats == {'recognizer': 'npy', 'label_encoder': 'npy'}
+
+    (loaded, loaded_encoder) = store.load()
+    assert np.allclose(loaded.predict_proba(X), recognizer.predict_proba(X))
+    assert np.array_equal(loaded_encoder.classes_, label_encoder.classes_)
+    assert np.array_equal(loaded_encoder.transform(label_encoder.classes_),
+                          label_encoder.transform(label_encoder.classes_))
+
+
+def test_missing_latest_falls_back_to_newest(tmp_path):
+    (recognizer, label_encoder, X) = make_models(CentroidRecognizer())
+    store = ModelStore(str(tmp_path / 'models'))
+    store.publish(recognizer, label_encoder, 6)
+    store.publish(recognizer, label_encoder, 6)
+    with open(os.path.join(store.pn_models, fn_latest), 'w') as f:
+        f.write('7')
+    assert store.latest_version() == 2
+    os.remove(os.path.join(store.pn_models, fn_latest))
+    assert store.latest_version() == 2
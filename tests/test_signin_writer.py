@@ -0,0 +1,66 @@
+import datetime
+
+import pytest
+
+from signin_writer import SignInWriteError
+from signin_writer import SignInWriter
+
+
+class FlakyDb:
+    """
+    Guest db whose record_sign_ins fails the first n_failures times.
+    """
+    def __init__(self, n_failures=0):
+        self.n_failures = n_failures
+        self.batches = []
+
+    def record_sign_ins(self, sign_ins):
+        if self.n_failures:
+            self.n_failures -= 1
+            raise OSError('database is locked')
+        self.batches.append(list(sign_ins))
+
+
+def sign_ins(*guest_ids):
+    return [{'fr_id': guest_id, 'class_prob': 0.9,
+             'time': datetime.datetime(2020, 1, 1), 'first_time': 0}
+            for guest_id in guest_ids]
+
+
+def test_flush_writes_one_batch():
+    db = FlakyDb()
+    writer = SignInWriter(db, flush_interval=60)
+    writer.add(sign_ins('a', 'b'))
+    writer.add(sign_ins('c'))
+    assert writer.flush(wait=True)
+    assert [[row['fr_id'] for row in batch] for batch in db.batches] == [['a', 'b', 'c']]
+    writer.close()
+
+
+def test_failed_flush_is_reported_and_retried():
+    db = FlakyDb(n_failures=1)
+    writer = SignInWriter(db, flush_interval=60)
+    writer.add(sign_ins('a'))
+    assert not writer.flush(wait=True)
+    assert db.batches == []
+    writer.add(sign_ins('b'))
+    assert writer.flush(wait=True)
+    assert [row['fr_id'] for row in db.batches[0]] == ['a', 'b']
+    writer.close()
+
+
+def test_close_retries_pending():
+    db = FlakyDb(n_failures=2)
+    writer = SignInWriter(db, flush_interval=60, close_retries=3, retry_delay=0)
+    writer.add(sign_ins('a'))
+    writer.close()
+    assert [row['fr_id'] for row in db.batches[0]] == ['a']
+
+
+def test_close_raises_unwritten():
+    db = FlakyDb(n_failures=10)
+    writer = SignInWriter(db, flush_interval=60, close_retries=2, retry_delay=0)
+    writer.add(sign_ins('a', 'b'))
+    with pytest.raises(SignInWriteError) as e:
+        writer.close()
+    assert [row['fr_id'] for row in e.value.sign_ins] == ['a', 'b']